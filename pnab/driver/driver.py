@@ -12,14 +12,16 @@ from __future__ import division, absolute_import, print_function
 import os
 import yaml
 import itertools
-from io import StringIO
 import multiprocessing as mp
+import threading
+from concurrent import futures
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 import datetime
 import time
 import numpy as np
 import copy
+import heapq
 
 from pnab import __path__
 from pnab import bind
@@ -27,8 +29,53 @@ from pnab.driver import options
 
 # Catch interruption; does not work properly for windows
 import signal
-def init_worker():
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
+def init_worker(ignore_interrupt=True, energy_threshold=None):
+    if ignore_interrupt:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    global _energy_threshold
+    _energy_threshold = energy_threshold
+
+# The highest total energy of the structures kept across all the helical configurations when
+# only the structures with the lowest total energies are written (RuntimeParameters.num_best)
+_energy_threshold = None
+
+# Serializes appends to the output files when helical configurations run in threads
+_output_lock = threading.Lock()
+
+def read_structure(prefix, index):
+    """!@brief Read the structure of an accepted candidate.
+
+    The structure is read from its own PDB file, "prefix_index.pdb". If the structures of the helical
+    configuration are written to a multi-model file (RuntimeParameters.multi_model_file), the model is read
+    from "prefix_models.pdb" using its offset and size in the index file, "prefix_models.csv".
+
+    @param prefix (str) The prefix of the helical configuration
+    @param index (int) The conformer index of the candidate
+
+    @returns The PDB contents of the structure, or None if the structure is not written
+    """
+
+    file_name = '%s_%i.pdb' %(prefix, int(index))
+    if os.path.isfile(file_name):
+        with open(file_name, 'r') as f:
+            return f.read()
+
+    models = '%s_models' %prefix
+    if not os.path.isfile(models + '.csv'):
+        return None
+
+    # Find the offset and the size of the model in the index
+    with open(models + '.csv', 'r') as f:
+        for line in f:
+            if line.startswith(file_name + ','):
+                offset, size = [int(i) for i in line.split(',')[2:]]
+                break
+        else:
+            return None
+
+    with open(models + '.pdb', 'rb') as f:
+        f.seek(offset)
+        return f.read(size).decode()
 
 class pNAB(object):
     """!@brief The proto-Nucleic Acid Builder main python class
@@ -40,10 +87,14 @@ class pNAB(object):
     Use the code to get RNA and DNA candidates. This uses the provided example files
     in the "pnab/data" directory. The results are in three files:
 
-    1) results.csv: Contains all the results for all the helical configurations
-        requested in the run.
+    1) results.dat: Contains all the results for all the helical configurations
+        requested in the run, as 64-bit floats in binary format with a row for each
+        accepted candidate and the columns in @a pNAB.pNAB.header.
 
-    2) prefix.yaml: Containts a dictionary of the sequence of the run and the 
+    2) results_index.csv: Contains the names of the columns, and the prefix, the first row,
+        and the number of rows in "results.dat" of each helical configuration with results.
+
+    3) prefix.yaml: Containts a dictionary of the sequence of the run and the 
         corresponding helical configuration (useful when a range of values is
         given for the helical parameters).
 
@@ -96,14 +147,15 @@ class pNAB(object):
         """!@brief Function to run one helical configuration.
 
         Setup the options to call the C++ code using the pybind11 bind class in @a binder.cpp.
-        After the run finishes, it writes the results.
-        Two files are written: 
-            "prefix.yaml" contains a dictionary of the sequence of the run and the corresponding helical configuration
-            "results.csv" contains the information on the accepted candidates for all of configurations
+        After the run finishes, it writes the helical configuration to "prefix.yaml", which contains a
+        dictionary of the sequence of the run and the corresponding helical configuration. The results
+        are written to the results store by the main process, @a _save_results.
 
         @param config (list) a list containing two entries: the list of helical parameter values for this
             configuration, and a string index for the sequnce of the run
 
+        @returns A list of the prefix, the header of the helical parameters, and the results (or None)
+
         @sa run
         """
         config, prefix = config[0], config[1]
@@ -122,6 +174,12 @@ class pNAB(object):
         runtime_parameters = bind.RuntimeParameters()
         [runtime_parameters.__setattr__(k, val) for k, val in self._options['RuntimeParameters'].items()]
 
+        # Reject the candidates whose total energies are higher than those of the structures kept so far
+        if _energy_threshold is not None:
+            energy_filter = runtime_parameters.energy_filter
+            energy_filter[4] = min(energy_filter[4], _energy_threshold.value)
+            runtime_parameters.energy_filter = energy_filter
+
         # Set backbone parameters
         backbone = bind.Backbone()
         [backbone.__setattr__(k, val) for k, val in self._options['Backbone'].items()]
@@ -138,49 +196,167 @@ class pNAB(object):
         [helical_parameters.__setattr__(k, val) for k, val in zip(self._options['HelicalParameters'], config)]
         helical_parameters.is_helical = self._is_helical
 
-        # Run code
+        # Run code; the results have a row for each accepted candidate
         
-        result = bind.run(runtime_parameters, backbone, bases, helical_parameters, prefix, self._verbose)
-
-        # Get results from the comma-separated output string
-        result = np.genfromtxt(StringIO(result), delimiter=',')
+        callback = None if self._callback is None else lambda batch: self._stream(prefix, batch)
+        result = bind.run(runtime_parameters, backbone, bases, helical_parameters, prefix, self._verbose, callback,
+                          stop_token=self._stop_token)
 
         if result.size == 0:
             result = None
-        elif result.ndim == 1:
-            result = result.reshape(1, len(result))
-
-        if result is not None:
+        else:
+            # Add the prefix as the first column
+            result = np.insert(result, 0, int(prefix), axis=1)
             result = result[result[:, 7].argsort()]
 
         results = [prefix, header, result]
 
         # Write prefix and helical configuration
-        with open('prefix.yaml', 'ab') as f:
+        with _output_lock, open('prefix.yaml', 'ab') as f:
             f.write(str.encode(yaml.dump({results[0]:results[1]})))
 
-        # If there are no results, return
-        if results[2] is None:
+        return results
+
+    def _save_results(self, results):
+        """!@brief Append the results of a helical configuration to the results store.
+
+        The results are appended to "results.dat" as 64-bit floats in binary format, and the position of the
+        rows of the helical configuration is appended to "results_index.csv". This is only called by the main
+        process, so the files have a single writer. It then keeps the structures with the lowest total energies, @a _keep_best.
+
+        @param results (list) The prefix, the header, and the results of a helical configuration
+
+        @sa _run
+        """
+
+        if results is None:
             return
 
-        # Update header
-        header = results[1] + '\n'
+        if results[2] is not None:
+            with open('results.dat', 'ab') as f:
+                np.ascontiguousarray(results[2], dtype=np.float64).tofile(f)
 
-        header2 = self.header
-        ## Add header entries for the dihedral angles
-        for i in range(results[2].shape[1] - 8):
-            header2 += ", Dihedral " + str(i+1) + " (degrees)"
+            with open('results_index.csv', 'a') as f:
+                # Add the names of the columns before the first results
+                if self._num_rows == 0:
+                    header = self.header + ''.join([", Dihedral " + str(i+1) + " (degrees)"
+                                                    for i in range(results[2].shape[1] - 8)])
+                    f.write('# ' + header + '\n')
+                f.write('%s,%i,%i\n' %(results[0], self._num_rows, len(results[2])))
+
+            self._num_rows += len(results[2])
+            self._num_columns = results[2].shape[1]
+
+        self._keep_best(results)
 
-        header += header2
+    def _keep_best(self, results):
+        """!@brief Keep the structures with the lowest total energies across the helical configurations.
 
-        # Write results to file
-        fmt = "%i,%i"
-        for i in range(results[2].shape[1] - 2):
-            fmt += ",%.6f"
-        with open('results.csv', 'ab') as f:
-            np.savetxt(f, results[2], header=header, fmt=fmt)
+        Each helical configuration writes at most RuntimeParameters.num_best structures. The structures
+        that are no longer among those with the lowest total energies of the run are deleted, and the
+        highest total energy of the kept structures is shared with the next helical configurations.
+
+        @param results (list) The prefix, the header, and the results of a helical configuration
+
+        @sa _run
+        """
+
+        num_best = self._options['RuntimeParameters']['num_best']
+        if num_best == 0 or results is None or results[2] is None:
+            return
+
+        # The results are sorted by total energy; only the first num_best candidates have structures
+        for row in results[2][:num_best]:
+            # Keep a heap of the highest total energy
+            heapq.heappush(self._best, (-row[7], results[0], int(row[1])))
+            if len(self._best) > num_best:
+                structure = heapq.heappop(self._best)
+                try:
+                    os.remove('%s_%i.pdb' %(structure[1], structure[2]))
+                except OSError:
+                    pass
+
+        if len(self._best) == num_best:
+            _energy_threshold.value = -self._best[0][0]
+
+    def _stream(self, prefix, batch):
+        """!@brief Pass a batch of accepted candidates streamed from the C++ code to the user's callback.
+
+        If the callback returns True, all the searches of the run are stopped through the stop token of the run.
+
+        @param prefix (str) The prefix of the helical configuration
+        @param batch (numpy.ndarray) The accepted candidates, without the prefix column
+
+        @returns Whether the run should stop
+
+        @sa run
+        """
 
-    def run(self, number_of_cpus=None, verbose=True, interrupt=False):
+        if not self._stop and self._callback(np.insert(batch, 0, int(prefix), axis=1)):
+            self._stop = True
+            self._stop_token.stop()
+        return self._stop
+
+    def _stop_threads(self, pool, jobs):
+        """!@brief Stop the helical configurations running in a pool of threads, and cancel the pending ones.
+
+        @param pool (concurrent.futures.ThreadPoolExecutor) The pool of threads
+        @param jobs (list) The futures of the configurations that are not processed yet
+
+        @sa _run_threads
+        """
+
+        for job in jobs:
+            job.cancel()
+        self._stop_token.stop()
+        pool.shutdown(wait=True)
+        # The stopped searches still write their structures
+        for job in jobs:
+            if not job.cancelled() and job.exception() is None:
+                self._save_results(job.result())
+
+    def _run_threads(self, pool, configs):
+        """!@brief Run the helical configurations in a pool of threads.
+
+        The threads share the options and the library of bases; nothing is pickled.
+        On keyboard interruption, or if the callback requests to stop, the running searches are stopped
+        through the stop token of the run, the pending configurations are cancelled, and the results found so far are kept.
+        The searches of other runs in the same process are not affected.
+
+        @param pool (concurrent.futures.ThreadPoolExecutor) The pool of threads
+        @param configs (iterable) The helical configurations and their prefixes
+
+        @sa run
+        """
+
+        jobs = [pool.submit(self._run, c) for c in configs]
+
+        try:
+            for job in futures.as_completed(jobs):
+                # Raises errors in the C++ code
+                self._save_results(job.result())
+                jobs.remove(job)
+                if self._stop:
+                    # The callback requested to stop the run
+                    self._stop_threads(pool, jobs)
+                    break
+
+        except KeyboardInterrupt:
+            # If interuption is catched, stop the running searches and proceed
+            print("Caught interruption; stopping ...")
+            self._stop_threads(pool, jobs)
+
+        except Exception:
+            # Error raised in the C++ code; stop the other configurations
+            for job in jobs:
+                job.cancel()
+            self._stop_token.stop()
+            raise
+
+        finally:
+            pool.shutdown(wait=True)
+
+    def run(self, number_of_cpus=None, verbose=True, interrupt=False, backend='processes', callback=None):
         """!@brief Prepare helical configurations and run them in parallel.
 
         This function first copies the user-defined options to an internal options dictionary (self._options).
@@ -197,16 +373,34 @@ class pNAB(object):
         third value in @a pNAB.pNAB.options. The various helical configurations
         are run in parallel using the multiprocessing library. 
 
-        This function writes three output files: "results.csv" and "prefix.yaml".
+        Alternatively, the helical configurations can be run in a pool of threads within
+        the current process (backend='threads'). The C++ code releases the python global
+        interpreter lock while searching, so the threads run concurrently. This avoids
+        starting new processes and pickling the options for every configuration,
+        which is beneficial for runs with many short helical configurations.
+
+        This function writes three output files: "results.dat", "results_index.csv", and "prefix.yaml".
         It renames any existing files with these names by prepending enough "_".
 
+        The accepted candidates can also be passed to a callback as they are found, so that they can be
+        analyzed before the run is complete. The callback receives 2D numpy arrays with the columns in
+        @a pNAB.pNAB.header. With the threads backend, the candidates are streamed in batches while each
+        helical configuration is searched. With the processes backend, the candidates of each helical
+        configuration are passed when its search is complete. If the callback returns True, the run stops.
+
         @param number_of_cpus Number of CPUs to use for parallel computations of different helical configurations, defaults to all cores
         @param verbose Whether to print progress report to the screen, default to True
         @param interrupt How to handle keyboard interrupt in multiprocessing
+        @param backend Whether to run the helical configurations in a pool of processes ('processes', default)
+            or in a pool of threads ('threads')
+        @param callback A function receiving the accepted candidates as they are found, default to None
 
         @returns None; output files are written
         """
 
+        if backend not in ['processes', 'threads']:
+            raise ValueError("backend must be either 'processes' or 'threads'")
+
         self._options = copy.deepcopy(self.options)
         options.validate_all_options(self._options)
 
@@ -222,6 +416,12 @@ class pNAB(object):
         ##@brief Whether to print progress report to the screen
         self._verbose = verbose
 
+        # The callback is only called from the C++ code in the threads backend; the processes cannot share it
+        self._callback = callback if backend == 'threads' else None
+        self._stop = False
+        # Stops the searches of this run only; the processes are terminated instead
+        self._stop_token = bind.StopToken() if backend == 'threads' else None
+
         self._is_helical = self._options['HelicalParameters'].pop('is_helical')
         hp = self._options['HelicalParameters'].copy()
         if self._is_helical:
@@ -239,20 +439,34 @@ class pNAB(object):
         num_config = np.prod([val[2] for val in hp.values()])
         prefix = (str(i) for i in range(1, num_config + 1))
 
+        # Create the directory where the weighted distributions are shared by the helical configurations.
+        # If it cannot be created, the distributions are computed for each configuration
+        weights_cache = self._options['RuntimeParameters']['weights_cache']
+        if weights_cache and not os.path.isdir(weights_cache):
+            try:
+                os.makedirs(weights_cache)
+            except OSError:
+                pass
+
         number_of_cpus = mp.cpu_count() if number_of_cpus is None else number_of_cpus
 
+        # Share the highest total energy of the kept structures with the helical configurations
+        global _energy_threshold
+        _energy_threshold = mp.Value('d', np.inf) if self._options['RuntimeParameters']['num_best'] > 0 else None
+        self._best = []
+
         # I cannot handle keyboard interrupt in jupyter notebook and still get results
         # I need init_worker function to gracefully terminate Jupyter notebook run
         # For command line, I can extract the results even when ctrl+c is applied,
         # in which case interrupt variable is false
         # Use maxtasksperchild=1 to free memory after each run
-        if interrupt:
-            pool = mp.Pool(number_of_cpus, init_worker, maxtasksperchild=1)
+        if backend == 'threads':
+            pool = futures.ThreadPoolExecutor(number_of_cpus)
         else:
-            pool = mp.Pool(number_of_cpus, maxtasksperchild=1)
+            pool = mp.Pool(number_of_cpus, init_worker, (interrupt, _energy_threshold), maxtasksperchild=1)
 
         # Rename output files that have the same name
-        for f in ['results.csv', 'prefix.yaml']:
+        for f in ['results.dat', 'results_index.csv', 'prefix.yaml']:
             file_path = f
             while True:
                 if os.path.isfile(file_path):
@@ -264,33 +478,43 @@ class pNAB(object):
 
         # Write time stamps
         current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with open('results.csv', 'w') as f: f.write('# ' + current_time + '\n')
+        open('results.dat', 'wb').close()
+        with open('results_index.csv', 'w') as f: f.write('# ' + current_time + '\n')
         with open('prefix.yaml', 'w') as f: f.write('# ' + current_time + '\n')
+        self._num_rows, self._num_columns = 0, 8
 
-        try:
-            # Run the different helical configurations in parallel and process results
-            for results in pool.imap_unordered(self._run, zip(config, prefix)):
-                pass
-
-        except KeyboardInterrupt:
-            # If interuption is catched, terminate run and proceed
-            print("Caught interruption; stopping ...")
-            time.sleep(1) # Sleep one second to allow all running processes to finish
-            pool.terminate()
-
-        except RuntimeError as e:
-            # Error raised in the C++ code
-            raise RuntimeError(e)
-
-        pool.close()
-        pool.join()
+        if backend == 'threads':
+            self._run_threads(pool, zip(config, prefix))
+        else:
+            try:
+                # Run the different helical configurations in parallel and process results
+                for results in pool.imap_unordered(self._run, zip(config, prefix)):
+                    self._save_results(results)
+                    if callback is not None and results[2] is not None and callback(results[2]):
+                        # The callback requested to stop the run
+                        pool.terminate()
+                        break
+
+            except KeyboardInterrupt:
+                # If interuption is catched, terminate run and proceed
+                print("Caught interruption; stopping ...")
+                time.sleep(1) # Sleep one second to allow all running processes to finish
+                pool.terminate()
+
+            except RuntimeError as e:
+                # Error raised in the C++ code
+                raise RuntimeError(e)
+
+            pool.close()
+            pool.join()
 
         # Write time stamps
         current_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with open('results.csv', 'a') as f: f.write('# ' + current_time + '\n')
+        with open('results_index.csv', 'a') as f: f.write('# ' + current_time + '\n')
         with open('prefix.yaml', 'a') as f: f.write('# ' + current_time + '\n')
 
-        del self._is_helical
+        del self._is_helical, self._best, self._callback, self._stop, self._stop_token
+        _energy_threshold = None
 
         #Extract the results from the run
 
@@ -304,12 +528,16 @@ class pNAB(object):
         ##@brief A numpy array containing the results of all the candidates
         #
         # The columns in the array correspond to the entries in @a pNAB.pNAB.header
-        # and the helical configurations correspond to those in @a pNAB.pNAB.prefix
-        self.results = np.loadtxt('results.csv', delimiter=',')
+        # and the helical configurations correspond to those in @a pNAB.pNAB.prefix.
+        # The array is memory-mapped to "results.dat", so the rows are only read when they are used.
+        # Changes to the array are not written to the file.
+        if self._num_rows > 0:
+            self.results = np.memmap('results.dat', dtype=np.float64, mode='c', shape=(self._num_rows, self._num_columns))
+        else:
+            self.results = np.empty((0, self._num_columns))
+        del self._num_rows, self._num_columns
 
-        if self.results.ndim == 1:
-            self.results = self.results.reshape((1, len(self.results)))
-        ## Add header entries for the dihedral angles; it does not get added in self._run
+        ## Add header entries for the dihedral angles
         for i in range(self.results.shape[1] - 8):
             self.header += ", Dihedral " + str(i+1) + " (degrees)"
 
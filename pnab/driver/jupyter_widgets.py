@@ -34,7 +34,7 @@ import yaml
 import ipywidgets as widgets
 from IPython.display import display, Javascript, Image
 
-from pnab.driver.driver import pNAB
+from pnab.driver.driver import pNAB, read_structure
 from pnab.driver.options import _options_dict
 from pnab import __path__
 
@@ -515,18 +515,36 @@ def helical_parameters(param):
 def algorithm(chosen_algorithm, param):
     """!@brief Display search parameters based on the chosen algorithm
 
-    There are six search algorithms and each one has a set of input parameters.
+    There are fifteen search algorithms and each one has a set of input parameters.
     The search algorithms are:
 
     - Systematic Search: Requires specifying the dihedral angle step size, @a dihedral_step.
+        The range of grid points, @a start_index and @a stop_index, can be used to split the search.
+    - Pruned Systematic Search: Requires the same parameters as the systematic search.
     - Monte Carlo Search: Requires specifying the number of steps, @a num_steps, 
         and the Monte Carlo temperature, @a monte_carlo_temperature.
+        The dihedral angles can be drawn from the whole range or perturbed locally, @a proposal_mode, and the number of
+        dihedral angles changed at every step, @a num_rotations, can be specified. Local steps require specifying the
+        initial step size, @a proposal_step, and the target acceptance rate, @a target_acceptance.
     - Weighted Monte Carlo Search: Also requires specifying the weighting temperature, @a weighting_temperature.
+    - Replica Exchange Monte Carlo Search: Also requires specifying the number of replicas, @a num_replicas,
+        the temperature of the hottest replica, @a max_replica_temperature, and the exchange interval, @a exchange_interval.
+    - Weighted Replica Exchange Monte Carlo Search: Also requires specifying the weighting temperature, @a weighting_temperature.
     - Random Search: Requires specifying the number of steps, @a num_steps.
     - Weighted Random Search: Also requires specifying the weighting temperature, @a weighting_temperature.
+    - Quasi-Random Search: Requires specifying the number of steps, @a num_steps.
+    - Weighted Quasi-Random Search: Also requires specifying the weighting temperature, @a weighting_temperature.
+    - Adaptive Sampling Search: Requires specifying the number of steps, @a num_steps, the number of steps between the refits
+        of the distributions, @a adaptation_interval, the fraction of elite samples, @a elite_fraction, and the adaptation rate,
+        @a adaptation_rate.
+    - Weighted Adaptive Sampling Search: Also requires specifying the weighting temperature, @a weighting_temperature.
+    - Kinematic Closure Search: Requires specifying the number of steps, @a num_steps, and the number of starting points
+        of the closure dihedral angles for each step, @a closure_attempts.
+    - Weighted Kinematic Closure Search: Also requires specifying the weighting temperature, @a weighting_temperature.
     - Genetic Algorithm Search: Requires specifying the number of generations, @a num_steps,
         the population size, @a population_size, the mutation_rate, @a mutation_rate,
-        and the crossover rate, @a crossover_rate.
+        and the crossover rate, @a crossover_rate. Several populations can evolve in parallel
+        with @a num_islands and exchange individuals every @a migration_interval generations.
 
     @param chosen_algorithm (str) The chosen algorithm
     @param param (dict) @a options._options_dict['RuntimeParameters']
@@ -544,7 +562,7 @@ def algorithm(chosen_algorithm, param):
     input_options['RuntimeParameters']['search_algorithm'] = chosen_algorithm
 
     # Systematic search algorithm needs a dihedral step size
-    if chosen_algorithm == 'systematic search':
+    if 'systematic search' in chosen_algorithm:
         dihedral_step = widgets.BoundedFloatText(value=param['dihedral_step']['default'],
                                                  min=0.0,
                                                  max=360.0,
@@ -555,6 +573,16 @@ def algorithm(chosen_algorithm, param):
         display(widgets.HBox([help_box, dihedral_step]))
         input_options['RuntimeParameters']['dihedral_step'] = dihedral_step
 
+        # The range of grid points searched; used to split the search into shards
+        for k in ['start_index', 'stop_index']:
+            index = widgets.BoundedIntText(value=param[k]['default'], min=0, max=1e100,
+                                           description=param[k]['glossory'],
+                                           style={'description_width': 'initial'},
+                                           layout={'width': '75%'})
+            help_box = widgets.Button(description='?', tooltip=param[k]['long_glossory'], layout=widgets.Layout(width='3%'))
+            display(widgets.HBox([help_box, index]))
+            input_options['RuntimeParameters'][k] = index
+
     # The other five algorithms require specifying the random number seed and the number of steps or generation
     else:
         # Random number generator seed
@@ -596,6 +624,100 @@ def algorithm(chosen_algorithm, param):
         display(widgets.HBox([help_box, monte_carlo_temperature]))
         input_options['RuntimeParameters']['monte_carlo_temperature'] = monte_carlo_temperature
 
+        proposal_mode = widgets.Dropdown(value=param['proposal_mode']['default'], options=['global', 'local'],
+                                         description=param['proposal_mode']['glossory'],
+                                         style={'description_width': 'initial'},
+                                         layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['proposal_mode']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, proposal_mode]))
+        input_options['RuntimeParameters']['proposal_mode'] = proposal_mode
+
+        num_rotations = widgets.BoundedIntText(value=param['num_rotations']['default'], min=1, max=1024,
+                                               description=param['num_rotations']['glossory'],
+                                               style={'description_width': 'initial'},
+                                               layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['num_rotations']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, num_rotations]))
+        input_options['RuntimeParameters']['num_rotations'] = num_rotations
+
+        proposal_step = widgets.BoundedFloatText(value=param['proposal_step']['default'], min=0, max=360,
+                                                 description=param['proposal_step']['glossory'],
+                                                 style={'description_width': 'initial'},
+                                                 layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['proposal_step']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, proposal_step]))
+        input_options['RuntimeParameters']['proposal_step'] = proposal_step
+
+        target_acceptance = widgets.BoundedFloatText(value=param['target_acceptance']['default'], min=0, max=1,
+                                                     description=param['target_acceptance']['glossory'],
+                                                     style={'description_width': 'initial'},
+                                                     layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['target_acceptance']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, target_acceptance]))
+        input_options['RuntimeParameters']['target_acceptance'] = target_acceptance
+
+    # Specify the temperature ladder of the replicas
+    if "replica exchange monte carlo search" in chosen_algorithm:
+        num_replicas = widgets.BoundedIntText(value=param['num_replicas']['default'], min=1, max=1024,
+                                              description=param['num_replicas']['glossory'],
+                                              style={'description_width': 'initial'},
+                                              layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['num_replicas']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, num_replicas]))
+        input_options['RuntimeParameters']['num_replicas'] = num_replicas
+
+        max_replica_temperature = widgets.BoundedFloatText(value=param['max_replica_temperature']['default'], min=1, max=1e100,
+                                                           description=param['max_replica_temperature']['glossory'],
+                                                           style={'description_width': 'initial'},
+                                                           layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['max_replica_temperature']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, max_replica_temperature]))
+        input_options['RuntimeParameters']['max_replica_temperature'] = max_replica_temperature
+
+        exchange_interval = widgets.BoundedIntText(value=param['exchange_interval']['default'], min=0, max=1e100,
+                                                   description=param['exchange_interval']['glossory'],
+                                                   style={'description_width': 'initial'},
+                                                   layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['exchange_interval']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, exchange_interval]))
+        input_options['RuntimeParameters']['exchange_interval'] = exchange_interval
+
+    # Specify how the adaptive sampling search refits the distributions
+    if "adaptive sampling search" in chosen_algorithm:
+        adaptation_interval = widgets.BoundedIntText(value=param['adaptation_interval']['default'], min=1, max=1e100,
+                                                     description=param['adaptation_interval']['glossory'],
+                                                     style={'description_width': 'initial'},
+                                                     layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['adaptation_interval']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, adaptation_interval]))
+        input_options['RuntimeParameters']['adaptation_interval'] = adaptation_interval
+
+        elite_fraction = widgets.BoundedFloatText(value=param['elite_fraction']['default'], min=0, max=1,
+                                                  description=param['elite_fraction']['glossory'],
+                                                  style={'description_width': 'initial'},
+                                                  layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['elite_fraction']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, elite_fraction]))
+        input_options['RuntimeParameters']['elite_fraction'] = elite_fraction
+
+        adaptation_rate = widgets.BoundedFloatText(value=param['adaptation_rate']['default'], min=0, max=1,
+                                                   description=param['adaptation_rate']['glossory'],
+                                                   style={'description_width': 'initial'},
+                                                   layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['adaptation_rate']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, adaptation_rate]))
+        input_options['RuntimeParameters']['adaptation_rate'] = adaptation_rate
+
+    # Specify the number of starting points of the closure dihedral angles
+    if "kinematic closure search" in chosen_algorithm:
+        closure_attempts = widgets.BoundedIntText(value=param['closure_attempts']['default'], min=1, max=1e100,
+                                                  description=param['closure_attempts']['glossory'],
+                                                  style={'description_width': 'initial'},
+                                                  layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['closure_attempts']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, closure_attempts]))
+        input_options['RuntimeParameters']['closure_attempts'] = closure_attempts
+
     # Specify population size, mutation rate, and crossover rate for genetic algorithm
     if 'genetic algorithm search' in chosen_algorithm:
         population_size = widgets.BoundedIntText(value=param['population_size']['default'], min=1, max=1e100,
@@ -622,6 +744,23 @@ def algorithm(chosen_algorithm, param):
         display(widgets.HBox([help_box, crossover_rate]))
         input_options['RuntimeParameters']['crossover_rate'] = crossover_rate
 
+        # Several populations (islands) that exchange their fittest individuals
+        num_islands = widgets.BoundedIntText(value=param['num_islands']['default'], min=1, max=1024,
+                                             description=param['num_islands']['glossory'],
+                                             style={'description_width': 'initial'},
+                                             layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['num_islands']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, num_islands]))
+        input_options['RuntimeParameters']['num_islands'] = num_islands
+
+        migration_interval = widgets.BoundedIntText(value=param['migration_interval']['default'], min=0, max=1e100,
+                                                    description=param['migration_interval']['glossory'],
+                                                    style={'description_width': 'initial'},
+                                                    layout={'width': '75%'})
+        help_box = widgets.Button(description='?', tooltip=param['migration_interval']['long_glossory'], layout=widgets.Layout(width='3%'))
+        display(widgets.HBox([help_box, migration_interval]))
+        input_options['RuntimeParameters']['migration_interval'] = migration_interval
+
 
 def runtime_parameters(param):
     """!@brief Runtime parameter widget for use in Jupyter notebook
@@ -645,7 +784,11 @@ def runtime_parameters(param):
     # Search algorithm
     display(widgets.HTML(value='<H4>Search Algorithm</H4>'))
     dropdown = widgets.Dropdown(value=param['search_algorithm']['default'].title(),
-                                options=['Weighted Monte Carlo Search', 'Monte Carlo Search', 'Weighted Random Search', 'Random Search', 'Genetic Algorithm Search', 'Systematic Search'],
+                                options=['Weighted Monte Carlo Search', 'Monte Carlo Search', 'Weighted Replica Exchange Monte Carlo Search', 'Replica Exchange Monte Carlo Search',
+                                         'Weighted Random Search', 'Random Search', 'Weighted Quasi-Random Search', 'Quasi-Random Search',
+                                         'Weighted Adaptive Sampling Search', 'Adaptive Sampling Search',
+                                         'Weighted Kinematic Closure Search', 'Kinematic Closure Search',
+                                         'Genetic Algorithm Search', 'Systematic Search', 'Pruned Systematic Search'],
                                 description=param['search_algorithm']['glossory'],
                                 style={'description_width': 'initial'},
                                 layout={'width': '75%'})
@@ -663,6 +806,42 @@ def runtime_parameters(param):
     display(widgets.HBox([help_box, num_candidates]))
     input_options['RuntimeParameters']['num_candidates'] = num_candidates
 
+    # Number of candidates with the lowest total energies whose structures are written
+    num_best = widgets.BoundedIntText(value=param['num_best']['default'], min=0, max=2**32-1,
+                                      description=param['num_best']['glossory'],
+                                      style={'description_width': 'initial'},
+                                      layout={'width': '75%'})
+    help_box = widgets.Button(description='?', tooltip=param['num_best']['long_glossory'], layout=widgets.Layout(width='3%'))
+    display(widgets.HBox([help_box, num_best]))
+    input_options['RuntimeParameters']['num_best'] = num_best
+
+    # Number of threads for searching each helical configuration
+    num_threads = widgets.BoundedIntText(value=param['num_threads']['default'], min=1, max=1024,
+                                         description=param['num_threads']['glossory'],
+                                         style={'description_width': 'initial'},
+                                         layout={'width': '75%'})
+    help_box = widgets.Button(description='?', tooltip=param['num_threads']['long_glossory'], layout=widgets.Layout(width='3%'))
+    display(widgets.HBox([help_box, num_threads]))
+    input_options['RuntimeParameters']['num_threads'] = num_threads
+
+    # Number of structures waiting to be written by the writer thread
+    write_queue_size = widgets.BoundedIntText(value=param['write_queue_size']['default'], min=0, max=2**32-1,
+                                              description=param['write_queue_size']['glossory'],
+                                              style={'description_width': 'initial'},
+                                              layout={'width': '75%'})
+    help_box = widgets.Button(description='?', tooltip=param['write_queue_size']['long_glossory'], layout=widgets.Layout(width='3%'))
+    display(widgets.HBox([help_box, write_queue_size]))
+    input_options['RuntimeParameters']['write_queue_size'] = write_queue_size
+
+    # Write the structures of each helical configuration to a multi-model file
+    multi_model_file = widgets.Checkbox(value=param['multi_model_file']['default'], indent=False,
+                                        description=param['multi_model_file']['glossory'],
+                                        style={'description_width': 'initial'},
+                                        layout={'width': '75%'})
+    help_box = widgets.Button(description='?', tooltip=param['multi_model_file']['long_glossory'], layout=widgets.Layout(width='3%'))
+    display(widgets.HBox([help_box, multi_model_file]))
+    input_options['RuntimeParameters']['multi_model_file'] = multi_model_file
+
     display(widgets.HTML(value='<H4>Distance and Energy Thresholds</H4>'))
 
     # Distance and energy thresholds
@@ -676,6 +855,23 @@ def runtime_parameters(param):
     display(widgets.HBox([help_box, max_distance]))
     input_options['RuntimeParameters']['max_distance'] = max_distance
 
+    # Refinement of the near misses
+    refinement_distance = widgets.BoundedFloatText(value=param['refinement_distance']['default'], min=0.0,
+                                                   description=param['refinement_distance']['glossory'],
+                                                   style={'description_width': 'initial'},
+                                                   layout={'width': '75%'})
+    help_box = widgets.Button(description='?', tooltip=param['refinement_distance']['long_glossory'], layout=widgets.Layout(width='3%'))
+    display(widgets.HBox([help_box, refinement_distance]))
+    input_options['RuntimeParameters']['refinement_distance'] = refinement_distance
+
+    refinement_iterations = widgets.BoundedIntText(value=param['refinement_iterations']['default'], min=0, max=1e100,
+                                                   description=param['refinement_iterations']['glossory'],
+                                                   style={'description_width': 'initial'},
+                                                   layout={'width': '75%'})
+    help_box = widgets.Button(description='?', tooltip=param['refinement_iterations']['long_glossory'], layout=widgets.Layout(width='3%'))
+    display(widgets.HBox([help_box, refinement_iterations]))
+    input_options['RuntimeParameters']['refinement_iterations'] = refinement_iterations
+
     # Force field
     ff_type = widgets.Dropdown(value=param['ff_type']['default'], options=['GAFF', 'MMFF94', 'MMFF94s', 'UFF', 'GHEMICAL'],
                                description=param['ff_type']['glossory'],
@@ -685,6 +881,24 @@ def runtime_parameters(param):
     display(widgets.HBox([help_box, ff_type]))
     input_options['RuntimeParameters']['ff_type'] = ff_type
 
+    # Energy mode for the nonbonded interactions
+    energy_mode = widgets.Dropdown(value=param['energy_mode']['default'], options=['openbabel', 'cell list', 'helical symmetry'],
+                                   description=param['energy_mode']['glossory'],
+                                   style={'description_width': 'initial'},
+                                   layout={'width': '75%'})
+    help_box = widgets.Button(description='?', tooltip=param['energy_mode']['long_glossory'], layout=widgets.Layout(width='3%'))
+    display(widgets.HBox([help_box, energy_mode]))
+    input_options['RuntimeParameters']['energy_mode'] = energy_mode
+
+    # Cutoff for the nonbonded interactions
+    nonbonded_cutoff = widgets.BoundedFloatText(value=param['nonbonded_cutoff']['default'], min=0.0, max=1e10,
+                                                description=param['nonbonded_cutoff']['glossory'],
+                                                style={'description_width': 'initial'},
+                                                layout={'width': '75%'})
+    help_box = widgets.Button(description='?', tooltip=param['nonbonded_cutoff']['long_glossory'], layout=widgets.Layout(width='3%'))
+    display(widgets.HBox([help_box, nonbonded_cutoff]))
+    input_options['RuntimeParameters']['nonbonded_cutoff'] = nonbonded_cutoff
+
     # Energy filters
     input_options['RuntimeParameters']['energy_filter'] = []
     for i in range(5):
@@ -914,12 +1128,16 @@ def run(button):
     if run.results.size == 0:
         return
 
-    # Get output files
-    files = [str(int(conformer[0])) + '_' + str(int(conformer[1])) + '.pdb' for conformer in run.results]
+    # Get output files; the structures of candidates that are not among the lowest energies are not kept
+    if run.options['RuntimeParameters']['multi_model_file']:
+        files = [p + '_models' + ext for p in run.prefix for ext in ['.pdb', '.csv']]
+    else:
+        files = [str(int(conformer[0])) + '_' + str(int(conformer[1])) + '.pdb' for conformer in run.results]
+    files = [f for f in files if os.path.isfile(f)]
 
     time = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
     with ZipFile('output' + time + '.zip', 'w') as z:
-        for f in ['options.yaml', 'results.csv', 'prefix.yaml']:
+        for f in ['options.yaml', 'results.dat', 'results_index.csv', 'prefix.yaml']:
             z.write(f)
         for f in files:
             z.write(f)
@@ -1003,6 +1221,13 @@ def single_result(result, header, results, prefix):
     # Get the name of the PDB file containing the conformer
     conformer = str(int(result[0])) + '_' + str(int(result[1])) + '.pdb'
 
+    # Extract the conformer from the multi-model file to display it
+    if not os.path.isfile(conformer):
+        structure = read_structure(int(result[0]), result[1])
+        if structure is not None:
+            with open(conformer, 'w') as f:
+                f.write(structure)
+
     # Print information
     print(conformer)
     print("Helical Parameter Set %i: " %result[0], prefix['%i' %result[0]])
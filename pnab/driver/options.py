@@ -65,6 +65,10 @@ def validate_all_options(options):
             if i in options['RuntimeParameters']['strand']:
                 raise Exception("Cannot build hexads for canonical nucleobases")
 
+    # Structures in a multi-model file cannot be deleted once they are no longer among the lowest total energies
+    if options['RuntimeParameters']['num_best'] > 0 and options['RuntimeParameters']['multi_model_file']:
+        raise Exception("Cannot keep the lowest energy structures (num_best) in multi-model files")
+
 def _align_nucleobase(base_options):
     """!@brief Aligns the provided nucleobase to purine or pyrimidine in the nucleic acid base pair standard reference frame
 
@@ -617,12 +621,23 @@ _options_dict['HelicalParameters']['is_helical'] = {
 _options_dict['RuntimeParameters'] = {}
 _options_dict['RuntimeParameters']['search_algorithm'] = {
                                                          'glossory': 'Search algorithm',
-                                                         'long_glossory': ('There are six search algorithms comprising four classes:\n' +
-                                                                           '1) Monte Carlo search, 2) Random Search, 3) Genetic Algorithm Search, and 4) Systematic Search\n'
-                                                                           'The first three algorithms are not deterministic. Weighted algorithms do not use' + 
+                                                         'long_glossory': ('There are fifteen search algorithms comprising six classes:\n' +
+                                                                           '1) Monte Carlo search, 2) Random Search, 3) Genetic Algorithm Search, 4) Systematic Search,' +
+                                                                           ' 5) Adaptive Sampling Search, and 6) Kinematic Closure Search\n'
+                                                                           'All but the systematic searches are not deterministic. Weighted algorithms do not use' + 
                                                                            ' uniform distributions for generating random dihedral angles. Instead, the probability' +
                                                                            ' distribution for each dihedral angle is weighted by exp(-Ei/kT)/sum(exp(-Ei/kT) where' +
-                                                                           ' Ei is the torsional energy at dihedral angle i.'
+                                                                           ' Ei is the torsional energy at dihedral angle i. The pruned systematic search gives the same' +
+                                                                           ' results as the systematic search, but skips the blocks of grid points whose first' +
+                                                                           ' dihedral angles cannot bring the backbone within the distance threshold. The replica exchange' +
+                                                                           ' Monte Carlo search runs several Monte Carlo searches at increasing temperatures and' +
+                                                                           ' exchanges their dihedral angles. The adaptive sampling search is a random search that' +
+                                                                           ' periodically refits the distribution of each dihedral angle to the samples with the lowest' +
+                                                                           ' distances. The kinematic closure search samples the dihedral angles of all but the' +
+                                                                           ' last three rotors that move the head or the tail atoms, and solves the dihedral angles of' +
+                                                                           ' these three rotors so that the two atoms coincide. The quasi-random search is a random' +
+                                                                           ' search that draws the dihedral angles from a scrambled Halton sequence, which covers the' +
+                                                                           ' space of the dihedral angles more evenly than pseudo-random numbers.'
                                                                           ),
                                                          'default': 'systematic search',
                                                          'validation': lambda x: x.lower(),
@@ -649,18 +664,132 @@ _options_dict['RuntimeParameters']['dihedral_step'] = {
                                                       'default': 2,
                                                       'validation': lambda x: float(x),
                                                       }
+_options_dict['RuntimeParameters']['start_index'] = {
+                                                    'glossory': 'Index of the first grid point for systematic search',
+                                                    'long_glossory': ('The grid points are numbered with the first rotatable bond changing fastest.' +
+                                                                      ' Use the start and stop indices to split a large systematic search into shards' +
+                                                                      ' that run in separate processes or computers. The candidates are named after' +
+                                                                      ' the index of their grid point, so the results of the shards can be merged.'),
+                                                    'default': 0,
+                                                    'validation': lambda x: int(x),
+                                                    }
+_options_dict['RuntimeParameters']['stop_index'] = {
+                                                   'glossory': 'One past the index of the last grid point for systematic search',
+                                                   'long_glossory': ('The systematic search stops before this grid point. If it is zero,' +
+                                                                     ' the search continues to the last grid point.'),
+                                                   'default': 0,
+                                                   'validation': lambda x: int(x),
+                                                   }
 _options_dict['RuntimeParameters']['weighting_temperature'] = {
                                                               'glossory': 'Weighting temperature (K)',
                                                               'long_glossory': ('Temperature used for weighting the probability of each dihedral angle.'),
                                                               'default': 300.0,
                                                               'validation': lambda x: float(x),
                                                               }
+_options_dict['RuntimeParameters']['weights_cache'] = {
+                                                      'glossory': 'Cache directory for the weighted distributions',
+                                                      'long_glossory': ('The weighted probability distributions of the dihedral angles only depend on' +
+                                                                        ' the backbone, the nucleobase, the fixed bonds, the force field, and the weighting' +
+                                                                        ' temperature. They are computed once and saved in this directory, so that the' +
+                                                                        ' weighted searches of all the helical configurations and of later runs reuse them.' +
+                                                                        ' If empty (default), the distributions are not saved. For example, use "~/.cache/pnab"' +
+                                                                        ' to share them between the runs of a user.'),
+                                                      'default': '',
+                                                      'validation': lambda x: os.path.expanduser(str(x)) if x else '',
+                                                      }
 _options_dict['RuntimeParameters']['monte_carlo_temperature'] = {
                                                                 'glossory': 'Temperature used in the Monte Carlo procedure (K)',
                                                                 'long_glossory': ('This temperature controls the acceptance and rejection ratio of the Monte Carlo steps.'),
                                                                 'default': 300.0,
                                                                 'validation': lambda x: float(x),
                                                                 }
+_options_dict['RuntimeParameters']['num_replicas'] = {
+                                                     'glossory': 'Number of replicas',
+                                                     'long_glossory': ('The number of replicas in the replica exchange Monte Carlo search. Each replica' +
+                                                                       ' runs on its own thread for all the steps, using its own random number stream' +
+                                                                       ' derived from the seed. The replicas replace the threads for the replica' +
+                                                                       ' exchange Monte Carlo search.'),
+                                                     'default': 4,
+                                                     'validation': lambda x: max(1, int(x)),
+                                                     }
+_options_dict['RuntimeParameters']['max_replica_temperature'] = {
+                                                                'glossory': 'Temperature of the hottest replica (K)',
+                                                                'long_glossory': ('The temperatures of the replicas in the replica exchange Monte Carlo' +
+                                                                                  ' search are spaced geometrically between the Monte Carlo temperature' +
+                                                                                  ' and this temperature.'),
+                                                                'default': 1000.0,
+                                                                'validation': lambda x: float(x),
+                                                                }
+_options_dict['RuntimeParameters']['exchange_interval'] = {
+                                                          'glossory': 'Exchange interval',
+                                                          'long_glossory': ('The number of steps between the exchanges of the replicas in the replica' +
+                                                                            ' exchange Monte Carlo search. If zero, the replicas are not exchanged.'),
+                                                          'default': 100,
+                                                          'validation': lambda x: int(x),
+                                                          }
+_options_dict['RuntimeParameters']['proposal_mode'] = {
+                                                      'glossory': 'Monte Carlo proposal mode',
+                                                      'long_glossory': ('How the Monte Carlo steps change the dihedral angles. In the "global" mode,' +
+                                                                        ' the new dihedral angles are drawn from the whole range, or from the weighted' +
+                                                                        ' distributions. In the "local" mode, the dihedral angles are perturbed by normally' +
+                                                                        ' distributed steps, whose size grows after accepted steps and shrinks after rejected' +
+                                                                        ' steps to reach the target acceptance rate. Local steps are rarely rejected near a' +
+                                                                        ' closed backbone. The weighted distributions are not used for the local steps.' +
+                                                                        ' The global steps shuffle the indices of all the dihedral angles to pick the ones' +
+                                                                        ' that change, so a given seed gives the same structures as earlier versions; the' +
+                                                                        ' local steps only draw the indices that change.'),
+                                                      'default': 'global',
+                                                      'validation': lambda x: str(x).lower(),
+                                                      }
+_options_dict['RuntimeParameters']['num_rotations'] = {
+                                                      'glossory': 'Number of dihedral angles changed at every step',
+                                                      'long_glossory': ('The number of dihedral angles changed at every Monte Carlo step.'),
+                                                      'default': 2,
+                                                      'validation': lambda x: max(1, int(x)),
+                                                      }
+_options_dict['RuntimeParameters']['proposal_step'] = {
+                                                      'glossory': 'Initial local step size (degree)',
+                                                      'long_glossory': ('The initial standard deviation of the local Monte Carlo steps.'),
+                                                      'default': 30.0,
+                                                      'validation': lambda x: float(x),
+                                                      }
+_options_dict['RuntimeParameters']['target_acceptance'] = {
+                                                          'glossory': 'Target acceptance rate of the local steps',
+                                                          'long_glossory': ('The size of the local Monte Carlo steps adapts to reach this acceptance rate.'),
+                                                          'default': 0.3,
+                                                          'validation': lambda x: float(x),
+                                                          }
+_options_dict['RuntimeParameters']['adaptation_interval'] = {
+                                                            'glossory': 'Adaptation interval',
+                                                            'long_glossory': ('The number of steps between the refits of the distributions of the dihedral' +
+                                                                              ' angles in the adaptive sampling search.'),
+                                                            'default': 1000,
+                                                            'validation': lambda x: max(1, int(x)),
+                                                            }
+_options_dict['RuntimeParameters']['elite_fraction'] = {
+                                                       'glossory': 'Elite fraction',
+                                                       'long_glossory': ('The number of samples with the lowest distances, as a fraction of the' +
+                                                                         ' adaptation interval, to which the distributions are refitted in the adaptive' +
+                                                                         ' sampling search. The elite samples are the lowest distances seen so far.'),
+                                                       'default': 0.1,
+                                                       'validation': lambda x: float(x),
+                                                       }
+_options_dict['RuntimeParameters']['adaptation_rate'] = {
+                                                        'glossory': 'Adaptation rate',
+                                                        'long_glossory': ('The fraction by which the distributions move toward the histograms of the' +
+                                                                          ' elite samples at every refit in the adaptive sampling search. If one, the' +
+                                                                          ' distributions are replaced by the histograms.'),
+                                                        'default': 0.7,
+                                                        'validation': lambda x: min(1.0, max(0.0, float(x))),
+                                                        }
+_options_dict['RuntimeParameters']['closure_attempts'] = {
+                                                         'glossory': 'Closure attempts per step',
+                                                         'long_glossory': ('The number of random starting points of the closure dihedral angles for each' +
+                                                                           ' step of the kinematic closure search. Each starting point is refined for at most' +
+                                                                           ' the maximum number of refinement sweeps, and the distinct closures are kept.'),
+                                                         'default': 8,
+                                                         'validation': lambda x: max(1, int(x)),
+                                                         }
 _options_dict['RuntimeParameters']['population_size'] = {
                                                         'glossory': 'The size of the population',
                                                         'long_glossory': ('The size of the population in the genetic algorithm search.'),
@@ -681,12 +810,54 @@ _options_dict['RuntimeParameters']['crossover_rate'] = {
                                                        'default': 0.25,
                                                        'validation': lambda x: float(x),
                                                        }
+_options_dict['RuntimeParameters']['num_islands'] = {
+                                                    'glossory': 'Number of islands',
+                                                    'long_glossory': ('The number of populations (islands) in the genetic algorithm search.' +
+                                                                      ' If larger than one, each island evolves on its own thread for all the generations,' +
+                                                                      ' using its own random number stream derived from the seed. The islands replace' +
+                                                                      ' the threads for the genetic algorithm search.'),
+                                                    'default': 1,
+                                                    'validation': lambda x: max(1, int(x)),
+                                                    }
+_options_dict['RuntimeParameters']['migration_interval'] = {
+                                                           'glossory': 'Migration interval',
+                                                           'long_glossory': ('The number of generations between migrations in the genetic algorithm search' +
+                                                                             ' with more than one island. At each migration, every island sends a copy of its' +
+                                                                             ' fittest individual to the next island, where it replaces the least fit individual.' +
+                                                                             ' If zero, the islands do not exchange individuals.'),
+                                                           'default': 10,
+                                                           'validation': lambda x: int(x),
+                                                           }
 _options_dict['RuntimeParameters']['ff_type'] = {
                                                 'glossory': 'Force field type',
                                                 'long_glossory': 'Force field for computing the energy of the system.', 
                                                 'default': 'MMFF94',
                                                 'validation': lambda x: str(x).upper(),
                                                 }
+_options_dict['RuntimeParameters']['energy_mode'] = {
+                                                    'glossory': 'Energy mode for the nonbonded interactions',
+                                                    'long_glossory': ('How the van der Waals and electrostatic energies are computed. In the' +
+                                                                      ' "openbabel" mode, all the pairs of atoms are evaluated by the force field.' +
+                                                                      ' In the "cell list" mode, the atoms are binned in a neighbor grid and only the' +
+                                                                      ' pairs within the nonbonded cutoff are evaluated for the van der Waals energy, which is faster' +
+                                                                      ' for long strands and hexads. The electrostatic energy is not truncated; the nucleotides farther' +
+                                                                      ' apart than the cutoff interact through their multipoles. In the "helical symmetry"' +
+                                                                      ' mode, which requires the same nucleobase in all the nucleotides, the pairs of atoms' +
+                                                                      ' related by the helical symmetry are evaluated once and weighted by their number. It' +
+                                                                      ' gives the same energies as the "openbabel" mode at a cost that grows linearly with the' +
+                                                                      ' length of the strand.'),
+                                                    'default': 'openbabel',
+                                                    'validation': lambda x: str(x).lower(),
+                                                    }
+_options_dict['RuntimeParameters']['nonbonded_cutoff'] = {
+                                                         'glossory': 'Cutoff for the nonbonded interactions (Angstrom)',
+                                                         'long_glossory': ('The van der Waals interactions between atoms farther apart than this' +
+                                                                           ' distance are neglected in the "cell list" energy mode. The electrostatic' +
+                                                                           ' interactions between nucleotides farther apart than this distance are computed' +
+                                                                           ' from the charges, dipoles, and quadrupoles of the nucleotides.'),
+                                                         'default': 12.0,
+                                                         'validation': lambda x: float(x),
+                                                         }
 _options_dict['RuntimeParameters']['max_distance'] = {
                                                      'glossory': 'The maximum distance between atom linkers in backbone (Angstrom)',
                                                      'long_glossory': ('This is the distance between the head atom in one backbone' +
@@ -698,6 +869,24 @@ _options_dict['RuntimeParameters']['max_distance'] = {
                                                      'default': 0.8,
                                                      'validation': lambda x: float(x),
                                                      }
+_options_dict['RuntimeParameters']['refinement_distance'] = {
+                                                            'glossory': 'Maximum distance of the refined near misses (Angstrom)',
+                                                            'long_glossory': ('Conformers whose distance is above the maximum distance but below this' +
+                                                                              ' distance are refined by cyclic coordinate descent: the dihedral angles that' +
+                                                                              ' move the head or the tail atoms are set in turn to the angles that minimize' +
+                                                                              ' the distance, before the energy filters run. This turns many near misses into' +
+                                                                              ' candidates. If not larger than the maximum distance, the conformers are not refined.'),
+                                                            'default': 0.0,
+                                                            'validation': lambda x: float(x),
+                                                            }
+_options_dict['RuntimeParameters']['refinement_iterations'] = {
+                                                              'glossory': 'Maximum number of refinement sweeps',
+                                                              'long_glossory': ('The maximum number of sweeps over the dihedral angles in the' +
+                                                                                ' refinement of the near misses and in the kinematic closure search. The' +
+                                                                                ' refinement stops when the distance is below the maximum distance.'),
+                                                              'default': 10,
+                                                              'validation': lambda x: max(0, int(x)),
+                                                              }
 _options_dict['RuntimeParameters']['energy_filter'] = {
                                                       'glossory': ('Maximum energy for newly formed bond in the backbone (kcal/mol)\n' +
                                                                    'Maximum energy for newly formed angles in the backbone (kcal/mol)\n' +
@@ -768,3 +957,45 @@ _options_dict['RuntimeParameters']['num_candidates'] = {
                                                        'default': 1,
                                                        'validation': lambda x: int(x),
                                                        }
+_options_dict['RuntimeParameters']['num_best'] = {
+                                                 'glossory': 'Number of structures with the lowest total energies to write (0 writes all)',
+                                                 'long_glossory': ('Keep only the accepted candidates with the lowest total energies across all the' +
+                                                                   ' helical configurations, and write their structures. Candidates whose total' +
+                                                                   ' energies are not lower than those of the kept structures are rejected, so the' +
+                                                                   ' maximum accepted total energy tightens as the run goes. The results file lists' +
+                                                                   ' all the accepted candidates, including those whose structures were discarded.' +
+                                                                   ' If zero, the structures of all the accepted candidates are written.'),
+                                                 'default': 0,
+                                                 'validation': lambda x: max(0, int(x)),
+                                                 }
+_options_dict['RuntimeParameters']['write_queue_size'] = {
+                                                         'glossory': 'Number of structures waiting to be written (0 writes on the search threads)',
+                                                         'long_glossory': ('The structures of the accepted candidates are written to files on a' +
+                                                                           ' background thread, so that the search does not wait for the file system.' +
+                                                                           ' The search waits if this many structures are waiting to be written.' +
+                                                                           ' If zero, the structures are written by the search threads.'),
+                                                         'default': 64,
+                                                         'validation': lambda x: max(0, int(x)),
+                                                         }
+_options_dict['RuntimeParameters']['multi_model_file'] = {
+                                                         'glossory': 'Write the structures of each helical configuration to one file',
+                                                         'long_glossory': ('Check box if you want to append the structures of all the accepted candidates' +
+                                                                           ' of a helical configuration as models to a single multi-model PDB file,' +
+                                                                           ' "prefix_models.pdb", instead of writing a file for each candidate.' +
+                                                                           ' The index file, "prefix_models.csv", has the name, the model number, the offset,' +
+                                                                           ' and the size in bytes of each structure, so any structure can be read' +
+                                                                           ' without reading the whole file. This option cannot be combined with' +
+                                                                           ' keeping the structures with the lowest total energies (num_best).'),
+                                                         'default': False,
+                                                         'validation': lambda x: bool(eval(x.title())) if isinstance(x, str) else bool(x),
+                                                         }
+_options_dict['RuntimeParameters']['num_threads'] = {
+                                                    'glossory': 'Number of threads for searching a helical configuration',
+                                                    'long_glossory': ('The number of threads used to search a single helical configuration.' +
+                                                                      ' The number of steps is split evenly across the threads, and each thread' +
+                                                                      ' uses its own random number stream derived from the seed. The search stops in all' +
+                                                                      ' threads once the requested number of candidates is found. Results with more than' +
+                                                                      ' one thread differ from those of a single thread for the same seed.'),
+                                                    'default': 1,
+                                                    'validation': lambda x: max(1, int(x)),
+                                                    }
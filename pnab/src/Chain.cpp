@@ -2,15 +2,304 @@
  * @brief A file for defining various methods for building and evaluating nucleic acid strands
  */
 
+#include <memory>
+#include <tuple>
+#include <functional>
+#include <unordered_map>
+#include <set>
+#include <Eigen/Dense>
 #include "Chain.h"
 
 using namespace std;
 using namespace PNAB;
 using namespace OpenBabel;
 
-Chain::Chain(Bases bases, const Backbone &backbone, std::vector<std::string> strand, std::string ff_type,
+// Reference values and sizes of the expansions used in BondedTerms
+#define BOND_REFERENCE 1.5 // Angstrom
+#define ANGLE_REFERENCE (109.5 * DEG_TO_RAD)
+#define POLYNOMIAL_ORDER 4
+#define TORSION_MAX_PERIODICITY 6
+
+BondedTerms::BondedTerms(unsigned n_atoms) : n_atoms(n_atoms) {
+    if (n_atoms == 4)
+        n_basis = 2 * TORSION_MAX_PERIODICITY + 1;
+    else
+        n_basis = POLYNOMIAL_ORDER + 1;
+}
+
+size_t BondedTerms::numFitSamples() const {
+    size_t n_keys = keys.empty() ? 0 : *max_element(keys.begin(), keys.end()) + 1;
+    return 2 * n_keys * n_basis + 20;
+}
+
+void BondedTerms::computeBasis(const double *xyz, const unsigned *atoms, double *basis) const {
+
+    basis[0] = 1.0;
+
+    if (n_atoms == 4) {
+        // Torsion; cos(n phi) and sin(n phi) are computed from the normals of the two planes
+        const double *a = xyz + atoms[0], *b = xyz + atoms[1], *c = xyz + atoms[2], *d = xyz + atoms[3];
+        double b1[3], b2[3], b3[3], n1[3], n2[3];
+        for (int k = 0; k < 3; k++) {
+            b1[k] = b[k] - a[k];
+            b2[k] = c[k] - b[k];
+            b3[k] = d[k] - c[k];
+        }
+        n1[0] = b1[1]*b2[2] - b1[2]*b2[1]; n1[1] = b1[2]*b2[0] - b1[0]*b2[2]; n1[2] = b1[0]*b2[1] - b1[1]*b2[0];
+        n2[0] = b2[1]*b3[2] - b2[2]*b3[1]; n2[1] = b2[2]*b3[0] - b2[0]*b3[2]; n2[2] = b2[0]*b3[1] - b2[1]*b3[0];
+        double b2_norm = sqrt(b2[0]*b2[0] + b2[1]*b2[1] + b2[2]*b2[2]);
+        double x = n1[0]*n2[0] + n1[1]*n2[1] + n1[2]*n2[2];
+        double y = ((n1[1]*n2[2] - n1[2]*n2[1]) * b2[0] + (n1[2]*n2[0] - n1[0]*n2[2]) * b2[1] +
+                    (n1[0]*n2[1] - n1[1]*n2[0]) * b2[2]) / b2_norm;
+        double r = sqrt(x*x + y*y);
+        double cos_phi = 1.0, sin_phi = 0.0;
+        if (r > 0) {
+            cos_phi = x / r;
+            sin_phi = y / r;
+        }
+        double cos_n = 1.0, sin_n = 0.0;
+        for (int n = 1; n <= TORSION_MAX_PERIODICITY; n++) {
+            double tmp = cos_n * cos_phi - sin_n * sin_phi;
+            sin_n = sin_n * cos_phi + cos_n * sin_phi;
+            cos_n = tmp;
+            basis[2*n - 1] = cos_n;
+            basis[2*n] = sin_n;
+        }
+        return;
+    }
+
+    double x;
+    if (n_atoms == 2) {
+        // Bond; polynomial in the bond length
+        const double *a = xyz + atoms[0], *b = xyz + atoms[1];
+        x = sqrt((a[0]-b[0])*(a[0]-b[0]) + (a[1]-b[1])*(a[1]-b[1]) + (a[2]-b[2])*(a[2]-b[2])) - BOND_REFERENCE;
+    }
+    else {
+        // Angle; polynomial in the angle in radians. The second atom is the vertex
+        const double *a = xyz + atoms[0], *b = xyz + atoms[1], *c = xyz + atoms[2];
+        double u[3] = {a[0]-b[0], a[1]-b[1], a[2]-b[2]}, v[3] = {c[0]-b[0], c[1]-b[1], c[2]-b[2]};
+        double cos_theta = (u[0]*v[0] + u[1]*v[1] + u[2]*v[2]) /
+                           sqrt((u[0]*u[0] + u[1]*u[1] + u[2]*u[2]) * (v[0]*v[0] + v[1]*v[1] + v[2]*v[2]));
+        cos_theta = std::max(-1.0, std::min(1.0, cos_theta));
+        x = acos(cos_theta) - ANGLE_REFERENCE;
+    }
+    for (unsigned k = 1; k < n_basis; k++)
+        basis[k] = basis[k-1] * x;
+}
+
+double BondedTerms::energy(const double *xyz) const {
+    double energy = 0.0;
+    double basis[2 * TORSION_MAX_PERIODICITY + 1];
+    std::size_t n_terms = atoms.size() / n_atoms;
+    for (std::size_t t = 0; t < n_terms; t++) {
+        computeBasis(xyz, &atoms[t * n_atoms], basis);
+        const double *p = &params[keys[t] * n_basis];
+        for (unsigned k = 0; k < n_basis; k++)
+            energy += p[k] * basis[k];
+    }
+    return energy;
+}
+
+double NonbondedTerms::vdwPairEnergy(double r, const double *params) const {
+    if (buffered) {
+        // Buffered 14-7 potential as in MMFF94
+        // The powers are computed by multiplication, as pow is slow
+        double R = params[0], R2 = R * R, R7 = R2 * R2 * R2 * R, r2 = r * r, r7 = r2 * r2 * r2 * r;
+        double erep = (1.07 * R) / (r + 0.07 * R), erep2 = erep * erep, erep7 = erep2 * erep2 * erep2 * erep;
+        return params[1] * erep7 * ((1.12 * R7) / (r7 + 0.12 * R7) - 2.0);
+    }
+    // Lennard-Jones 12-6 potential
+    double inv6 = 1.0 / (r * r * r * r * r * r);
+    return (params[0] * inv6 - params[1]) * inv6;
+}
+
+double NonbondedTerms::electrostaticEnergy(const double *xyz) const {
+
+    std::size_t num_atoms = types.size(), num_groups = group_offsets.size() - 1;
+    double energy = 0.0;
+
+    // The center, radius, and multipoles of each nucleotide
+    multipoles_.assign(14 * num_groups, 0.0);
+    for (std::size_t g=0; g < num_groups; g++) {
+        double *m = &multipoles_[14 * g];
+        double size = group_offsets[g + 1] - group_offsets[g];
+        for (unsigned k=group_offsets[g]; k < group_offsets[g + 1]; k++) {
+            for (int d=0; d < 3; d++)
+                m[d] += xyz[3 * group_atoms[k] + d] / size;
+        }
+        for (unsigned k=group_offsets[g]; k < group_offsets[g + 1]; k++) {
+            unsigned i = group_atoms[k];
+            double q = charges[i], s[3] = {xyz[3*i] - m[0], xyz[3*i + 1] - m[1], xyz[3*i + 2] - m[2]};
+            double s2 = s[0]*s[0] + s[1]*s[1] + s[2]*s[2];
+            m[3] = std::max(m[3], sqrt(s2));
+            m[4] += q;
+            for (int d=0; d < 3; d++) {
+                m[5 + d] += q * s[d];
+                m[8 + d] += q * (3.0 * s[d] * s[d] - s2);
+            }
+            m[11] += 3.0 * q * s[0] * s[1];
+            m[12] += 3.0 * q * s[0] * s[2];
+            m[13] += 3.0 * q * s[1] * s[2];
+        }
+    }
+
+    relation_of_.assign(num_atoms, -1);
+    vector<unsigned> nearby;
+    for (std::size_t a=0; a < num_groups; a++) {
+        const double *ma = &multipoles_[14 * a];
+
+        // The nucleotides closer than the cutoff. The others interact through their multipoles; the buffer is neglected
+        nearby.assign(1, a);
+        for (std::size_t b=a+1; b < num_groups; b++) {
+            const double *mb = &multipoles_[14 * b];
+            double d[3] = {mb[0] - ma[0], mb[1] - ma[1], mb[2] - ma[2]};
+            double R = sqrt(d[0]*d[0] + d[1]*d[1] + d[2]*d[2]);
+            if (R - ma[3] - mb[3] < cutoff) {
+                nearby.push_back(b);
+                continue;
+            }
+            double u[3] = {d[0] / R, d[1] / R, d[2] / R};
+            double ua = ma[5]*u[0] + ma[6]*u[1] + ma[7]*u[2], ub = mb[5]*u[0] + mb[6]*u[1] + mb[7]*u[2];
+            double uQa = ma[8]*u[0]*u[0] + ma[9]*u[1]*u[1] + ma[10]*u[2]*u[2] + 2.0 * (ma[11]*u[0]*u[1] + ma[12]*u[0]*u[2] + ma[13]*u[1]*u[2]);
+            double uQb = mb[8]*u[0]*u[0] + mb[9]*u[1]*u[1] + mb[10]*u[2]*u[2] + 2.0 * (mb[11]*u[0]*u[1] + mb[12]*u[0]*u[2] + mb[13]*u[1]*u[2]);
+            double ab = ma[5]*mb[5] + ma[6]*mb[6] + ma[7]*mb[7];
+            energy += electrostatic_constant * (ma[4] * mb[4] / R + (mb[4] * ua - ma[4] * ub) / (R * R)
+                                                + (ab - 3.0 * ua * ub + 0.5 * (ma[4] * uQb + mb[4] * uQa)) / (R * R * R));
+        }
+
+        // The pairs of atoms in the nearby nucleotides, with the excluded and 1-4 pairs as in the cell list
+        for (unsigned k=group_offsets[a]; k < group_offsets[a + 1]; k++) {
+            unsigned i = group_atoms[k];
+            if (charges[i] == 0.0)
+                continue;
+            for (auto &r: relations[i])
+                relation_of_[r.first] = r.second;
+            const double *xi = xyz + 3*i;
+            for (auto b: nearby) {
+                for (unsigned l=(b == a ? k + 1 : group_offsets[b]); l < group_offsets[b + 1]; l++) {
+                    unsigned j = group_atoms[l];
+                    if (relation_of_[j] == 0 || charges[j] == 0.0)
+                        continue;
+                    const double *xj = xyz + 3*j;
+                    double r = sqrt((xi[0]-xj[0])*(xi[0]-xj[0]) + (xi[1]-xj[1])*(xi[1]-xj[1]) + (xi[2]-xj[2])*(xi[2]-xj[2]));
+                    energy += electrostatic_constant * charges[i] * charges[j] * (relation_of_[j] == 1 ? electrostatic_scale_14 : 1.0) / (r + electrostatic_buffer);
+                }
+            }
+            for (auto &r: relations[i])
+                relation_of_[r.first] = -1;
+        }
+    }
+
+    return energy;
+}
+
+void NonbondedTerms::energy(const double *xyz, double &vdw, double &electrostatic) const {
+
+    vdw = 0.0;
+    electrostatic = 0.0;
+
+    // Sum over the unique pairs
+    if (symmetric) {
+        for (std::size_t k=0; k < pair_weights.size(); k++) {
+            const double *xi = xyz + 3 * pair_atoms[2*k], *xj = xyz + 3 * pair_atoms[2*k + 1];
+            double r = sqrt((xi[0]-xj[0])*(xi[0]-xj[0]) + (xi[1]-xj[1])*(xi[1]-xj[1]) + (xi[2]-xj[2])*(xi[2]-xj[2]));
+            vdw += pair_weights[k] * vdwPairEnergy(r, &vdw_params[pair_vdw_params[k]]);
+            electrostatic += pair_electrostatic[k] / (r + electrostatic_buffer);
+        }
+        return;
+    }
+
+    std::size_t num_atoms = types.size();
+    if (num_atoms == 0)
+        return;
+
+    // The bounding box of the system
+    double lo[3] = {xyz[0], xyz[1], xyz[2]}, hi[3] = {xyz[0], xyz[1], xyz[2]};
+    for (std::size_t i=1; i < num_atoms; i++) {
+        for (int k=0; k < 3; k++) {
+            lo[k] = std::min(lo[k], xyz[3*i + k]);
+            hi[k] = std::max(hi[k], xyz[3*i + k]);
+        }
+    }
+    if (!(std::isfinite(lo[0] + lo[1] + lo[2] + hi[0] + hi[1] + hi[2]))) {
+        vdw = electrostatic = std::numeric_limits<double>::quiet_NaN();
+        return;
+    }
+
+    // Cells at least as large as the cutoff; enlarged if there are many more cells than atoms
+    double cell = cutoff;
+    std::size_t dims[3], num_cells;
+    while (true) {
+        for (int k=0; k < 3; k++)
+            dims[k] = static_cast<std::size_t>((hi[k] - lo[k]) / cell) + 1;
+        num_cells = dims[0] * dims[1] * dims[2];
+        if (num_cells <= 4 * num_atoms + 27)
+            break;
+        cell *= 1.5;
+    }
+
+    // Bin the atoms in linked lists
+    head_.assign(num_cells, -1);
+    next_.resize(num_atoms);
+    auto cell_index = [&](std::size_t i, std::size_t *c) {
+        for (int k=0; k < 3; k++)
+            c[k] = std::min(dims[k] - 1, static_cast<std::size_t>((xyz[3*i + k] - lo[k]) / cell));
+    };
+    std::size_t c[3];
+    for (std::size_t i=0; i < num_atoms; i++) {
+        cell_index(i, c);
+        std::size_t index = c[0] + dims[0] * (c[1] + dims[1] * c[2]);
+        next_[i] = head_[index];
+        head_[index] = static_cast<int>(i);
+    }
+
+    // Loop over the pairs in the same and neighboring cells
+    double cutoff2 = cutoff * cutoff;
+    relation_of_.assign(num_atoms, -1);
+    for (std::size_t i=0; i < num_atoms; i++) {
+        cell_index(i, c);
+        const double *xi = xyz + 3*i;
+        for (auto &r: relations[i])
+            relation_of_[r.first] = r.second;
+        for (std::size_t z = (c[2] > 0 ? c[2] - 1 : 0); z <= std::min(dims[2] - 1, c[2] + 1); z++) {
+        for (std::size_t y = (c[1] > 0 ? c[1] - 1 : 0); y <= std::min(dims[1] - 1, c[1] + 1); y++) {
+        for (std::size_t x = (c[0] > 0 ? c[0] - 1 : 0); x <= std::min(dims[0] - 1, c[0] + 1); x++) {
+            for (int j = head_[x + dims[0] * (y + dims[1] * z)]; j != -1; j = next_[j]) {
+                if (j <= static_cast<int>(i))
+                    continue;
+                const double *xj = xyz + 3*j;
+                double r2 = (xi[0]-xj[0])*(xi[0]-xj[0]) + (xi[1]-xj[1])*(xi[1]-xj[1]) + (xi[2]-xj[2])*(xi[2]-xj[2]);
+                if (r2 >= cutoff2)
+                    continue;
+
+                // Excluded and 1-4 pairs
+                if (relation_of_[j] == 0)
+                    continue;
+                int is14 = relation_of_[j] == 1;
+
+                vdw += vdwPairEnergy(sqrt(r2), &vdw_params[4 * (types[i] * n_types + types[j]) + 2 * is14]);
+            }
+        }
+        }
+        }
+        for (auto &r: relations[i])
+            relation_of_[r.first] = -1;
+    }
+
+    electrostatic = electrostaticEnergy(xyz);
+}
+
+Chain::Chain(Bases &bases, const Backbone &backbone, std::vector<std::string> strand, std::string ff_type,
              std::array<unsigned, 2> &range, bool hexad, std::vector<bool> build_strand, std::vector<bool> strand_orientation,
-             double glycosidic_bond_distance) {
+             double glycosidic_bond_distance, std::string energy_mode, double nonbonded_cutoff) {
+
+    if (energy_mode != "openbabel" && energy_mode != "cell list" && energy_mode != "helical symmetry")
+        throw std::runtime_error(energy_mode + " is unrecognized energy mode");
+    if (energy_mode == "helical symmetry" && std::adjacent_find(strand.begin(), strand.end(), std::not_equal_to<std::string>()) != strand.end())
+        throw std::runtime_error("The helical symmetry energy mode requires the same nucleobase in all the nucleotides of the strand");
+
+    // Setting up the molecules and the force field is not thread-safe in openbabel
+    lock_guard<mutex> lock(openbabelMutex());
 
     // Set some variables
     glycosidic_bond_distance_ = glycosidic_bond_distance;
@@ -18,17 +307,28 @@ Chain::Chain(Bases bases, const Backbone &backbone, std::vector<std::string> str
     strand_orientation_ = strand_orientation;
     hexad_ = hexad;
     ff_type_ = ff_type;
+    energy_mode_ = energy_mode;
+    nonbonded_terms_.cutoff = nonbonded_cutoff;
     monomer_bb_index_range_ = range;
     chain_length_ = static_cast<unsigned>(strand.size());
 
     // Get the openbabel force field
-    pFF_ = OBForceField::FindForceField(ff_type_);
+    OBForceField *pFF = OBForceField::FindForceField(ff_type_);
     // Make sure we have a valid pointer
-    if (!pFF_) {
+    if (!pFF) {
         throw std::runtime_error("Cannot find force field.");
     }
+    // Use separate instances of the force field so that several chains can be evaluated at the same time.
+    // Each energy term has its own instance so that the setup is only performed once per chain
+    pFFBond_ = pFF->MakeNewInstance();
+    pFFAngle_ = pFF->MakeNewInstance();
+    pFFTorsion_ = pFF->MakeNewInstance();
+    pFFTotal_ = pFF->MakeNewInstance();
+    // New instances do not initialize the log level
+    for (auto ff: {pFFBond_, pFFAngle_, pFFTorsion_, pFFTotal_})
+        ff->SetLogLevel(OBFF_LOGLVL_NONE);
     // Check whether the force field uses kcal/mol or kJ/mol
-    isKCAL_ = pFF_->GetUnit().find("kcal") != string::npos;
+    isKCAL_ = pFF->GetUnit().find("kcal") != string::npos;
 
     // Get the bases for the strand and the complimentary strand for duplexed and hexads
     auto bases_A = bases.getBasesFromStrand(strand);
@@ -59,8 +359,608 @@ Chain::Chain(Bases bases, const Backbone &backbone, std::vector<std::string> str
             combined_chain_ += v_chain_[i];
         }
     }
+
+    // Set up the force fields once; only the coordinates change between candidates
+    setupForceFields();
+    setupBondedTerms();
+    if (energy_mode_ != "openbabel")
+        setupNonbondedTerms(pFF);
+    if (energy_mode_ == "helical symmetry")
+        setupSymmetricPairs();
+}
+
+void Chain::setupForceFields() {
+
+    // Angle energy. We use energy groups to compute the energy only between
+    // the first and second nucleotides in the first strand
+    OBBitVec bit = OBBitVec();
+    pFFAngle_->AddIntraGroup(bit); // Add empty bit in case only one nucleotide per strand is requested
+    for (auto i: all_angles_) {
+        OBBitVec bit = OBBitVec();
+        for (auto j: i)
+            bit.SetBitOn(j);
+        pFFAngle_->AddIntraGroup(bit);
+    }
+
+    // Torsion energy. Add interaction groups for the rotatable torsions that are not fixed
+    for (size_t i=0; i < all_torsions_.size(); i++) {
+        if (is_fixed_bond[i])
+            continue;
+        OBBitVec bit = OBBitVec();
+        for (auto j: all_torsions_[i]) {
+            bit.SetBitOn(j);
+        }
+        pFFTorsion_->AddIntraGroup(bit);
+    }
+
+    // In the cell list and helical symmetry modes, the nonbonded interactions are computed separately. A group
+    // containing all the atoms includes all the bonded terms but no van der Waals or electrostatic pairs
+    if (energy_mode_ != "openbabel") {
+        OBBitVec all_atoms = OBBitVec();
+        FOR_ATOMS_OF_MOL(a, combined_chain_)
+            all_atoms.SetBitOn(a->GetIdx());
+        pFFTotal_->AddIntraGroup(all_atoms);
+    }
+
+    // Bond energy. We set the constraint to ignore all bonds except the
+    // one bond between the first and second nucleotides in the first strand.
+    // The other constraints are empty; van der Waals and total energies have no groups
+    std::vector<std::pair<OBForceField*, OBFFConstraints*>> setups = {{pFFBond_, &constraintsBond_},
+                                                                       {pFFAngle_, &constraintsAng_},
+                                                                       {pFFTorsion_, &constraintsTor_},
+                                                                       {pFFTotal_, &constraintsTot_}};
+    for (auto &s: setups) {
+        // The constraints are shared by all the openbabel force fields. They are used when the interactions
+        // are set up, but not when the energy is computed. The first setup of a new instance also
+        // initializes its internal arrays
+        s.first->GetConstraints() = *s.second;
+        if (!s.first->Setup(combined_chain_))
+            throw std::runtime_error("Cannot set up the force field.");
+    }
+}
+
+
+void Chain::setupBondedTerms() {
+
+    // Use a copy of the molecule; the perceived angles and torsions should not be copied with the candidates
+    OBMol mol = combined_chain_;
+
+    // Check whether all the atoms of a term are in one energy group, as done in openbabel
+    auto in_group = [](const vector<vector<unsigned>> &groups, const vector<unsigned> &term) {
+        for (auto &group: groups) {
+            bool found = true;
+            for (auto i: term) {
+                if (find(group.begin(), group.end(), i) == group.end()) {
+                    found = false;
+                    break;
+                }
+            }
+            if (found)
+                return true;
+        }
+        return false;
+    };
+
+    // Bond terms; the atoms that are not ignored
+    vector<vector<unsigned>> bonds, angles, torsions;
+    FOR_BONDS_OF_MOL(b, mol) {
+        unsigned i = b->GetBeginAtomIdx(), j = b->GetEndAtomIdx();
+        if (!constraintsBond_.IsIgnored(i) && !constraintsBond_.IsIgnored(j))
+            bonds.push_back({i, j});
+    }
+
+    // Angle terms; all the atoms are in one of the angle groups. The vertex is the second atom
+    FOR_ANGLES_OF_MOL(angle, mol) {
+        vector<unsigned> term = {(*angle)[1] + 1, (*angle)[0] + 1, (*angle)[2] + 1};
+        if (in_group(all_angles_, term))
+            angles.push_back(term);
+    }
+
+    // Torsion terms; all the atoms are in one of the groups of the rotatable torsions that are not fixed
+    vector<vector<unsigned>> torsion_groups;
+    for (size_t i=0; i < all_torsions_.size(); i++) {
+        if (!is_fixed_bond[i])
+            torsion_groups.push_back(all_torsions_[i]);
+    }
+    FOR_TORSIONS_OF_MOL(t, mol) {
+        vector<unsigned> term = {(*t)[0] + 1, (*t)[1] + 1, (*t)[2] + 1, (*t)[3] + 1};
+        if (in_group(torsion_groups, term))
+            torsions.push_back(term);
+    }
+    // Openbabel computes all the torsions if there are no energy groups
+    if (torsion_groups.empty())
+        torsions.clear();
+
+    // The parameters of a term depend on the atom types, the bonds, and the rings the term is part of
+    if (!pFFTotal_->GetAtomTypes(mol))
+        return;
+    vector<OBRing*> rings = mol.GetSSSR();
+    auto term_key = [&](const vector<unsigned> &term) {
+        string key;
+        for (unsigned k=0; k < term.size(); k++) {
+            OBAtom *atom = mol.GetAtom(term[k]);
+            key += atom->GetData("FFAtomType")->GetValue() + " ";
+            if (k > 0) {
+                OBBond *bond = mol.GetBond(mol.GetAtom(term[k-1]), atom);
+                if (bond)
+                    key += to_string(bond->GetBondOrder()) + (bond->IsAromatic() ? "a " : " ");
+            }
+        }
+        for (auto ring: rings) {
+            bool member = true;
+            for (auto i: term)
+                member = member && ring->IsMember(mol.GetAtom(i));
+            if (member)
+                key += "r" + to_string(ring->Size()) + " ";
+        }
+        return key;
+    };
+
+    for (auto terms: {make_pair(&bond_terms_, &bonds), make_pair(&angle_terms_, &angles), make_pair(&torsion_terms_, &torsions)}) {
+        map<string, unsigned> key_index;
+        for (auto &term: *terms.second) {
+            for (auto i: term)
+                terms.first->atoms.push_back(3 * (i - 1));
+            terms.first->keys.push_back(key_index.emplace(term_key(term), key_index.size()).first->second);
+        }
+    }
+}
+
+bool Chain::fitBondedTerms(BondedTerms &terms, OBForceField *pFF, double (OBForceField::*term_energy)(bool)) {
+
+    // No terms are computed, or openbabel computes all the torsions without energy groups
+    std::size_t n_terms = terms.keys.size();
+    if (n_terms == 0)
+        return false;
+
+    unsigned num_atoms = combined_chain_.NumAtoms();
+    const double *coords = combined_chain_.GetCoordinates();
+    vector<double> reference(coords, coords + 3 * num_atoms), xyz = reference;
+    std::mt19937 rng(0);
+    std::uniform_real_distribution<double> uniform(0.0, 1.0);
+    double basis[2 * TORSION_MAX_PERIODICITY + 1];
+
+    // The bonds along the terms; the atoms are placed one after the other along a spanning tree of these bonds
+    map<unsigned, vector<unsigned>> neighbors;
+    for (std::size_t t=0; t < n_terms; t++) {
+        for (unsigned k=1; k < terms.n_atoms; k++) {
+            neighbors[terms.atoms[t * terms.n_atoms + k - 1]].push_back(terms.atoms[t * terms.n_atoms + k]);
+            neighbors[terms.atoms[t * terms.n_atoms + k]].push_back(terms.atoms[t * terms.n_atoms + k - 1]);
+        }
+    }
+    vector<pair<unsigned, int>> order;
+    set<unsigned> placed;
+    for (auto &root: neighbors) {
+        if (!placed.insert(root.first).second)
+            continue;
+        order.emplace_back(root.first, -1);
+        for (std::size_t k=order.size() - 1; k < order.size(); k++) {
+            for (auto j: neighbors[order[k].first]) {
+                if (placed.insert(j).second)
+                    order.emplace_back(j, order[k].first);
+            }
+        }
+    }
+
+    // Twice as many samples as parameters for the fit, and a few more samples to check it
+    std::size_t n_params = (*max_element(terms.keys.begin(), terms.keys.end()) + 1) * terms.n_basis;
+    std::size_t n_samples = terms.numFitSamples(), n_fit = n_samples - 10;
+    Eigen::MatrixXd A = Eigen::MatrixXd::Zero(n_samples, n_params);
+    Eigen::VectorXd energies(n_samples);
+    for (std::size_t s=0; s < n_samples; s++) {
+        // Bonds between 0.9 and 2.5 Angstrom in random directions, so the angles and the torsions take all the values
+        for (auto &atom: order) {
+            double z = 2.0 * uniform(rng) - 1.0, phi = 2.0 * M_PI * uniform(rng), length = 0.9 + 1.6 * uniform(rng);
+            double direction[3] = {sqrt(1.0 - z * z) * cos(phi), sqrt(1.0 - z * z) * sin(phi), z};
+            for (int k=0; k < 3; k++)
+                xyz[atom.first + k] = (atom.second == -1 ? reference[atom.first + k] : xyz[atom.second + k]) + length * direction[k];
+        }
+        combined_chain_.SetCoordinates(xyz.data());
+        pFF->SetCoordinates(combined_chain_);
+        energies(s) = (pFF->*term_energy)(false);
+        for (std::size_t t=0; t < n_terms; t++) {
+            terms.computeBasis(xyz.data(), &terms.atoms[t * terms.n_atoms], basis);
+            for (unsigned k=0; k < terms.n_basis; k++)
+                A(s, terms.keys[t] * terms.n_basis + k) += basis[k];
+        }
+    }
+
+    // Restore the coordinates of the candidate
+    combined_chain_.SetCoordinates(reference.data());
+
+    // The terms with the same index share their parameters. The parameters that do not change the energy
+    // (e.g. the constant terms of all but one index) are set to zero
+    Eigen::VectorXd p = A.topRows(n_fit).colPivHouseholderQr().solve(energies.head(n_fit));
+    Eigen::VectorXd error = A * p - energies;
+    for (std::size_t s=0; s < n_samples; s++) {
+        if (!(std::abs(error(s)) <= 1e-6 * std::max(1.0, std::abs(energies(s)))))
+            return false;
+    }
+    terms.params.assign(p.data(), p.data() + p.size());
+    return true;
+}
+
+void Chain::setupNonbondedTerms(OBForceField *pFF) {
+
+    // Use a copy of the molecule; the atoms are moved to compute the energies of the representative pairs
+    OBMol mol = combined_chain_;
+    unsigned num_atoms = mol.NumAtoms();
+    NonbondedTerms &terms = nonbonded_terms_;
+
+    // The atom types and partial charges of the force field instance of the total energy
+    if (!pFFTotal_->GetAtomTypes(mol) || !pFFTotal_->GetPartialCharges(mol))
+        throw std::runtime_error("Cannot set up the force field for the nonbonded interactions.");
+
+    // Atom types and partial charges
+    map<string, unsigned> type_index;
+    vector<string> type_names;
+    terms.types.resize(num_atoms);
+    terms.charges.resize(num_atoms);
+    FOR_ATOMS_OF_MOL(a, mol) {
+        string type = a->GetData("FFAtomType")->GetValue();
+        if (!type_index.count(type)) {
+            type_index[type] = type_names.size();
+            type_names.push_back(type);
+        }
+        terms.types[a->GetIdx() - 1] = type_index[type];
+        terms.charges[a->GetIdx() - 1] = atof(a->GetData("FFPartialCharge")->GetValue().c_str());
+    }
+    unsigned n_types = terms.n_types = type_names.size();
+
+    // Excluded (1-2 and 1-3) and 1-4 pairs, as in openbabel
+    terms.relations.assign(num_atoms, {});
+    FOR_ATOMS_OF_MOL(a, mol) {
+        map<unsigned, int> rel;
+        FOR_NBORS_OF_ATOM(nbr, &*a) {
+            rel[nbr->GetIdx() - 1] = 0;
+            FOR_NBORS_OF_ATOM(nbr2, &*nbr) {
+                if (nbr2->GetIdx() != a->GetIdx())
+                    rel[nbr2->GetIdx() - 1] = 0;
+            }
+        }
+        FOR_NBORS_OF_ATOM(nbr, &*a) {
+            FOR_NBORS_OF_ATOM(nbr2, &*nbr) {
+                FOR_NBORS_OF_ATOM(nbr3, &*nbr2) {
+                    if (nbr3->GetIdx() != a->GetIdx() && !rel.count(nbr3->GetIdx() - 1))
+                        rel[nbr3->GetIdx() - 1] = 1;
+                }
+            }
+        }
+        terms.relations[a->GetIdx() - 1] = vector<pair<unsigned, int>>(rel.begin(), rel.end());
+    }
+
+    // The atoms of each nucleotide for the electrostatic energy
+    vector<unsigned> atom_strand, atom_residue, atom_index;
+    findAtomNucleotides(atom_strand, atom_residue, atom_index);
+    map<pair<unsigned, unsigned>, vector<unsigned>> nucleotide_atoms;
+    for (unsigned i=0; i < num_atoms; i++)
+        nucleotide_atoms[{atom_strand[i], atom_residue[i]}].push_back(i);
+    terms.group_atoms.clear();
+    terms.group_offsets.assign(1, 0);
+    for (auto &nucleotide: nucleotide_atoms) {
+        terms.group_atoms.insert(terms.group_atoms.end(), nucleotide.second.begin(), nucleotide.second.end());
+        terms.group_offsets.push_back(terms.group_atoms.size());
+    }
+
+    // A representative pair of atoms for each pair of atom types and 1-4 flag
+    vector<pair<unsigned, unsigned>> representative(2 * n_types * n_types);
+    vector<bool> found(2 * n_types * n_types, false);
+    vector<int> rel_of(num_atoms, -1);
+    int charged_pair[2][2] = {{-1, -1}, {-1, -1}};
+    for (unsigned i=0; i < num_atoms; i++) {
+        for (auto &r: terms.relations[i])
+            rel_of[r.first] = r.second;
+        for (unsigned j=i+1; j < num_atoms; j++) {
+            if (rel_of[j] == 0)
+                continue;
+            int is14 = rel_of[j] == 1;
+            unsigned key = 2 * (terms.types[i] * n_types + terms.types[j]) + is14;
+            if (!found[key]) {
+                unsigned swapped = 2 * (terms.types[j] * n_types + terms.types[i]) + is14;
+                found[key] = found[swapped] = true;
+                representative[key] = {i, j};
+                representative[swapped] = {j, i};
+            }
+            if (charged_pair[is14][0] == -1 && terms.charges[i] != 0.0 && terms.charges[j] != 0.0) {
+                charged_pair[is14][0] = i;
+                charged_pair[is14][1] = j;
+            }
+        }
+        for (auto &r: terms.relations[i])
+            rel_of[r.first] = -1;
+    }
+
+    // The fitted parameters are kept for all the chains; the cache is protected by the openbabel lock
+    static map<string, array<double, 2>> fitted;
+    static map<string, bool> buffered;
+    static map<string, array<double, 3>> electrostatics;
+    auto pair_key = [&](unsigned key) {
+        return ff_type_ + " " + type_names[key / 2 / n_types] + " " + type_names[(key / 2) % n_types] + (key % 2 ? " 1-4" : "");
+    };
+
+    // The atoms of the representative pairs that are not fitted yet, and of the charged pairs
+    // if the electrostatic constants are not determined yet
+    bool fit_electrostatics = !electrostatics.count(ff_type_) && charged_pair[0][0] != -1;
+    vector<unsigned> keys, atoms;
+    auto include = [&](unsigned i) {
+        if (find(atoms.begin(), atoms.end(), i) == atoms.end())
+            atoms.push_back(i);
+    };
+    for (unsigned key=0; key < found.size(); key++) {
+        if (found[key] && !fitted.count(pair_key(key))) {
+            keys.push_back(key);
+            include(representative[key].first);
+            include(representative[key].second);
+        }
+    }
+    for (int is14=0; fit_electrostatics && is14 < 2; is14++) {
+        if (charged_pair[is14][0] != -1) {
+            include(charged_pair[is14][0]);
+            include(charged_pair[is14][1]);
+        }
+    }
+
+    // A force field instance for computing the energy of these atoms only. All the other atoms are ignored.
+    // The atoms are placed far apart along the x axis, so that only the pair being considered interacts
+    unique_ptr<OBForceField> probe;
+    double background = 0.0;
+    if (!atoms.empty()) {
+        probe.reset(pFF->MakeNewInstance());
+        probe->SetLogLevel(OBFF_LOGLVL_NONE);
+        OBFFConstraints constraints;
+        for (unsigned i=0; i < num_atoms; i++) {
+            if (find(atoms.begin(), atoms.end(), i) == atoms.end())
+                constraints.AddIgnore(i + 1);
+        }
+        if (!probe->Setup(mol, constraints))
+            throw std::runtime_error("Cannot set up the force field for the nonbonded interactions.");
+        for (unsigned k=0; k < atoms.size(); k++)
+            mol.GetAtom(atoms[k] + 1)->SetVector(1.0e4 * k, 0.0, 0.0);
+        probe->SetCoordinates(mol);
+        background = probe->E_VDW(false);
+    }
+
+    // The energy with the second atom moved perpendicular to the x axis at the given distance from the first atom.
+    // The distances to the other atoms then change by less than 1e-8 Angstrom
+    auto pair_energy = [&](unsigned i, unsigned j, double r, double (OBForceField::*term_energy)(bool)) {
+        vector3 original = mol.GetAtom(j + 1)->GetVector();
+        mol.GetAtom(j + 1)->SetVector(mol.GetAtom(i + 1)->GetVector() + vector3(0.0, r, 0.0));
+        probe->SetCoordinates(mol);
+        double energy = (probe.get()->*term_energy)(false);
+        mol.GetAtom(j + 1)->SetVector(original);
+        return energy;
+    };
+
+    // The buffered 14-7 potential with R = 1 and epsilon = 1, and the position of its minimum
+    double unit_params[2] = {1.0, 1.0};
+    NonbondedTerms unit;
+    unit.buffered = true;
+    double a = 0.8, b = 1.5, golden = (sqrt(5.0) - 1.0) / 2.0;
+    for (int iter=0; iter < 100; iter++) {
+        double x1 = b - golden * (b - a), x2 = a + golden * (b - a);
+        if (unit.vdwPairEnergy(x1, unit_params) < unit.vdwPairEnergy(x2, unit_params))
+            b = x2;
+        else
+            a = x1;
+    }
+    double q_min = 0.5 * (a + b);
+
+    vector<double> samples = {2.0, 2.5, 3.0, 3.5, 4.0, 5.0, 6.0, 8.0}, checks = {2.75, 4.5, 7.0};
+    for (auto key: keys) {
+        unsigned i = representative[key].first, j = representative[key].second;
+        vector<double> energies, check_energies;
+        for (auto r: samples)
+            energies.push_back(pair_energy(i, j, r, &OBForceField::E_VDW) - background);
+        for (auto r: checks)
+            check_energies.push_back(pair_energy(i, j, r, &OBForceField::E_VDW) - background);
+
+        // Pairs that do not interact are zero in both functional forms
+        array<double, 2> params = {0.0, 0.0};
+        bool interacting = false;
+        for (auto e: energies)
+            interacting = interacting || e != 0.0;
+
+        // Determine the functional form from the first interacting pair fitted with this force field
+        bool is_buffered = buffered.count(ff_type_) ? buffered[ff_type_] : false;
+        for (int attempt=0; interacting && attempt < 2; attempt++) {
+            NonbondedTerms form;
+            form.buffered = is_buffered;
+            if (!is_buffered) {
+                // Lennard-Jones 12-6; linear in A and B
+                Eigen::MatrixXd A(samples.size(), 2);
+                for (unsigned s=0; s < samples.size(); s++) {
+                    A(s, 0) = pow(samples[s], -12);
+                    A(s, 1) = -pow(samples[s], -6);
+                }
+                Eigen::VectorXd p = A.colPivHouseholderQr().solve(Eigen::Map<Eigen::VectorXd>(energies.data(), energies.size()));
+                params = {p(0), p(1)};
+            }
+            else {
+                // Buffered 14-7; linear in epsilon for a given R. R is the minimum of the least squares residual,
+                // bracketed on a grid of the position of the minimum q_min * R and refined by golden section search
+                auto residual = [&](double R, double &epsilon) {
+                    double ge = 0.0, gg = 0.0, ee = 0.0, R_params[2] = {R, 1.0};
+                    for (unsigned s=0; s < samples.size(); s++) {
+                        double g = form.vdwPairEnergy(samples[s], R_params);
+                        ge += g * energies[s];
+                        gg += g * g;
+                        ee += energies[s] * energies[s];
+                    }
+                    epsilon = ge / gg;
+                    return ee - ge * ge / gg;
+                };
+                double epsilon, best = 1.0, best_residual = residual(1.0 / q_min, epsilon);
+                for (double r_min=1.0; r_min <= 10.0; r_min += 0.05) {
+                    double res = residual(r_min / q_min, epsilon);
+                    if (res < best_residual) {
+                        best_residual = res;
+                        best = r_min;
+                    }
+                }
+                double a = best - 0.05, b = best + 0.05;
+                for (int iter=0; iter < 100; iter++) {
+                    double x1 = b - golden * (b - a), x2 = a + golden * (b - a);
+                    if (residual(x1 / q_min, epsilon) < residual(x2 / q_min, epsilon))
+                        b = x2;
+                    else
+                        a = x1;
+                }
+                residual(0.5 * (a + b) / q_min, epsilon);
+                params = {0.5 * (a + b) / q_min, epsilon};
+            }
+
+            // The tolerance is relative to the largest energy as the energy crosses zero
+            double tolerance = 0.0;
+            for (auto e: energies)
+                tolerance = std::max(tolerance, 1e-6 * std::abs(e));
+            bool good = true;
+            for (unsigned s=0; s < samples.size(); s++)
+                good = good && std::abs(form.vdwPairEnergy(samples[s], params.data()) - energies[s]) <= tolerance + 1e-10;
+            for (unsigned s=0; s < checks.size(); s++)
+                good = good && std::abs(form.vdwPairEnergy(checks[s], params.data()) - check_energies[s]) <= tolerance + 1e-10;
+            if (good) {
+                buffered[ff_type_] = is_buffered;
+                break;
+            }
+            if (buffered.count(ff_type_) || attempt == 1)
+                throw std::runtime_error("The cell list energy mode does not support the van der Waals potential of " + ff_type_);
+            is_buffered = true;
+        }
+        fitted[pair_key(key)] = params;
+    }
+
+    // Electrostatic constants from the energy of one charged pair and one charged 1-4 pair;
+    // the energy is constant * scale * q_i * q_j / (r + buffer). The other atoms add a constant offset
+    if (fit_electrostatics) {
+        array<double, 3> constants = {0.0, 0.0, 1.0};
+        for (int is14=0; is14 < 2; is14++) {
+            if (charged_pair[is14][0] == -1)
+                continue;
+            unsigned i = charged_pair[is14][0], j = charged_pair[is14][1];
+            double qq = terms.charges[i] * terms.charges[j];
+            double r[5] = {3.0, 6.0, 9.0, 4.5, 12.0}, e[5];
+            for (int k=0; k < 5; k++)
+                e[k] = pair_energy(i, j, r[k], &OBForceField::E_Electrostatic);
+            // The ratio of the differences of the energies at 3, 6, and 9 Angstrom is (9 + buffer) / (3 + buffer)
+            double ratio = (e[0] - e[1]) / (e[1] - e[2]);
+            double buffer = (9.0 - 3.0 * ratio) / (ratio - 1.0);
+            double c = (e[0] - e[1]) * (r[0] + buffer) * (r[1] + buffer) / (r[1] - r[0]), offset = e[0] - c / (r[0] + buffer);
+            for (int k=3; k < 5; k++) {
+                if (!(std::abs(c / (r[k] + buffer) + offset - e[k]) <= 1e-6 * std::abs(e[k] - offset)))
+                    throw std::runtime_error("The cell list energy mode does not support the electrostatic potential of " + ff_type_);
+            }
+            if (is14 == 0) {
+                constants[0] = c / qq;
+                constants[1] = std::abs(buffer) < 1e-8 ? 0.0 : buffer;
+            }
+            else
+                constants[2] = c / (qq * constants[0]);
+        }
+        electrostatics[ff_type_] = constants;
+    }
+    if (electrostatics.count(ff_type_)) {
+        terms.electrostatic_constant = electrostatics[ff_type_][0];
+        terms.electrostatic_buffer = electrostatics[ff_type_][1];
+        terms.electrostatic_scale_14 = electrostatics[ff_type_][2];
+    }
+
+    // Copy the van der Waals parameters for all the pairs of atom types
+    terms.buffered = buffered.count(ff_type_) ? buffered[ff_type_] : false;
+    terms.vdw_params.assign(4 * n_types * n_types, 0.0);
+    for (unsigned key=0; key < found.size(); key++) {
+        if (found[key]) {
+            auto &params = fitted[pair_key(key)];
+            terms.vdw_params[2 * key] = params[0];
+            terms.vdw_params[2 * key + 1] = params[1];
+        }
+    }
+}
+
+void Chain::findAtomNucleotides(vector<unsigned> &atom_strand, vector<unsigned> &atom_residue, vector<unsigned> &atom_index) {
+
+    // The atoms are in the same order as in setCoordsForChain
+    atom_strand.clear();
+    atom_residue.clear();
+    atom_index.clear();
+    for (unsigned chain_index=0; chain_index < 6; chain_index++) {
+        if (!build_strand_[chain_index])
+            continue;
+        auto &deleted_atoms_ids = v_deleted_atoms_ids_[chain_index];
+        unsigned local_offset = 0, deleted_atom_index = 0;
+        for (unsigned i=0; i < chain_length_; i++) {
+            auto n = v_num_bu_A_mol_atoms_[chain_index][i];
+            auto r = v_bb_start_index_[chain_index][i];
+            for (unsigned j=0; j < n; j++) {
+                if (j >= r - 1 && !deleted_atoms_ids.empty() && deleted_atom_index < deleted_atoms_ids.size()
+                    && j + local_offset == deleted_atoms_ids[deleted_atom_index]) {
+                    deleted_atom_index++;
+                    continue;
+                }
+                atom_strand.push_back(chain_index);
+                atom_residue.push_back(i);
+                atom_index.push_back(j);
+            }
+            local_offset += n;
+        }
+    }
+    if (atom_strand.size() != combined_chain_.NumAtoms())
+        throw std::runtime_error("Cannot determine the nucleotides of the atoms for the nonbonded interactions.");
 }
 
+void Chain::setupSymmetricPairs() {
+
+    NonbondedTerms &terms = nonbonded_terms_;
+    unsigned num_atoms = combined_chain_.NumAtoms();
+
+    // The strand, nucleotide, and index within the nucleotide of each atom
+    vector<unsigned> atom_strand, atom_residue, atom_index;
+    findAtomNucleotides(atom_strand, atom_residue, atom_index);
+
+    // Atoms in different nucleotides are equivalent if they have the same strand, index, atom type, and partial charge
+    map<tuple<unsigned, unsigned, unsigned, double>, unsigned> class_index;
+    vector<unsigned> atom_class(num_atoms);
+    for (unsigned i=0; i < num_atoms; i++) {
+        auto key = make_tuple(atom_strand[i], atom_index[i], terms.types[i], terms.charges[i]);
+        auto it = class_index.emplace(key, class_index.size()).first;
+        atom_class[i] = it->second;
+    }
+
+    // Group the pairs by the classes of the two atoms, the difference of the nucleotide indices, and the 1-4 flag
+    uint64_t num_classes = class_index.size(), num_offsets = 2 * chain_length_;
+    unordered_map<uint64_t, unsigned> pair_index;
+    vector<int> rel_of(num_atoms, -1);
+    terms.pair_atoms.clear();
+    terms.pair_vdw_params.clear();
+    terms.pair_weights.clear();
+    terms.pair_electrostatic.clear();
+    for (unsigned i=0; i < num_atoms; i++) {
+        for (auto &r: terms.relations[i])
+            rel_of[r.first] = r.second;
+        for (unsigned j=i+1; j < num_atoms; j++) {
+            if (rel_of[j] == 0)
+                continue;
+            int is14 = rel_of[j] == 1;
+            uint64_t offset = atom_residue[j] + chain_length_ - atom_residue[i];
+            uint64_t key = ((atom_class[i] * num_classes + atom_class[j]) * num_offsets + offset) * 2 + is14;
+            auto it = pair_index.emplace(key, terms.pair_weights.size());
+            if (it.second) {
+                double qq = terms.charges[i] * terms.charges[j];
+                terms.pair_atoms.push_back(i);
+                terms.pair_atoms.push_back(j);
+                terms.pair_vdw_params.push_back(4 * (terms.types[i] * terms.n_types + terms.types[j]) + 2 * is14);
+                terms.pair_weights.push_back(0.0);
+                terms.pair_electrostatic.push_back(terms.electrostatic_constant * qq * (is14 ? terms.electrostatic_scale_14 : 1.0));
+            }
+            terms.pair_weights[it.first->second] += 1.0;
+        }
+        for (auto &r: terms.relations[i])
+            rel_of[r.first] = -1;
+    }
+
+    for (std::size_t k=0; k < terms.pair_weights.size(); k++)
+        terms.pair_electrostatic[k] *= terms.pair_weights[k];
+    terms.symmetric = true;
+}
 
 ConformerData Chain::generateConformerData(double *conf, HelicalParameters &hp, vector<double> energy_filter) {
 
@@ -74,9 +974,10 @@ ConformerData Chain::generateConformerData(double *conf, HelicalParameters &hp,
     auto *xyz = new double[num_cooords];
 
     // Set the coordinates
+    setTransforms(hp);
     for (unsigned i=0; i < 6; i++) {
         if (build_strand_[i])
-            setCoordsForChain(xyz,conf,hp,v_num_bu_A_mol_atoms_[i],v_bb_start_index_[i], v_base_coords_vec_[i],v_deleted_atoms_ids_[i], i);
+            setCoordsForChain(xyz,conf,v_num_bu_A_mol_atoms_[i],v_bb_start_index_[i], v_base_coords_vec_[i],v_deleted_atoms_ids_[i], i);
     }
 
     // Fill in the energy data
@@ -84,6 +985,8 @@ ConformerData Chain::generateConformerData(double *conf, HelicalParameters &hp,
     fillConformerEnergyData(xyz, data, energy_filter);
 
     if (data.accepted) {
+        // Copying the molecule logs messages in openbabel, which is not thread-safe
+        lock_guard<mutex> lock(openbabelMutex());
         data.molecule = combined_chain_;
         data.molecule.SetChainsPerceived();
         // Reorder atoms
@@ -129,11 +1032,25 @@ void Chain::orderResidues(OBMol* molecule) {
 
 void Chain::fillConformerEnergyData(double *xyz, PNAB::ConformerData &conf_data, vector<double> energy_filter) {
 
+    // The force fields are set up once in the constructor; here we only update the coordinates
+    // of the instance needed for the next energy term. This does not require the openbabel lock.
+    // The bond, angle, and torsion terms are computed without openbabel when possible
+
     // Set the molecule
     OBMol *current_mol;
     current_mol = &combined_chain_;
     current_mol->SetCoordinates(xyz);
 
+    // Compute the energy of the bonded terms with openbabel. The terms are fitted once openbabel has computed as many energies
+    // as the fit computes, so that the fit at most doubles the cost when few candidates are computed
+    auto openbabel_energy = [&](BondedTerms &terms, OBForceField *pFF, double (OBForceField::*term_energy)(bool)) {
+        pFF->SetCoordinates(*current_mol);
+        double energy = (pFF->*term_energy)(false);
+        if (++terms.num_evaluations == terms.numFitSamples())
+            terms.native = fitBondedTerms(terms, pFF, term_energy);
+        return energy;
+    };
+
     // Determine the number of nucleotides in the system
     unsigned n = 0;
     for (auto i: build_strand_) {
@@ -141,11 +1058,12 @@ void Chain::fillConformerEnergyData(double *xyz, PNAB::ConformerData &conf_data,
             n += chain_length_; 
     }
 
-    // Get bond energy. We set the constraint to ignore all bonds except the 
-    // one bond between the first and second nucleotides in the first strand
-    // The other bonds will have the same energy
-    pFF_->Setup(*current_mol, constraintsBond_);
-    conf_data.bondE = pFF_->E_Bond(false);
+    // Get bond energy. Only the bond between the first and second nucleotides in the first strand
+    // is computed. The other bonds will have the same energy
+    if (bond_terms_.native)
+        conf_data.bondE = bond_terms_.energy(xyz);
+    else
+        conf_data.bondE = openbabel_energy(bond_terms_, pFFBond_, &OBForceField::E_Bond);
 
     if (!isKCAL_)
         conf_data.bondE *= KJ_TO_KCAL;
@@ -158,23 +1076,10 @@ void Chain::fillConformerEnergyData(double *xyz, PNAB::ConformerData &conf_data,
 
     // Get angle energy. We compute the energy only between the first and 
     // second nucleotides in the first strand. The other angles will have the same energy
-
-    // We use energy groups here
-    // Set the energy groups for the required angles
-    OBBitVec bit = OBBitVec();
-    pFF_->AddIntraGroup(bit); // Add empty bit in case only one nucleotide per strand is requested
-    for (auto i: all_angles_) {
-        OBBitVec bit = OBBitVec();
-        for (auto j: i)
-            bit.SetBitOn(j);
-        pFF_->AddIntraGroup(bit);
-    }
-
-
-    pFF_->Setup(*current_mol, constraintsAng_); // empty constraint
-    conf_data.angleE = pFF_->E_Angle(false);
-
-    pFF_->ClearGroups();
+    if (angle_terms_.native)
+        conf_data.angleE = angle_terms_.energy(xyz);
+    else
+        conf_data.angleE = openbabel_energy(angle_terms_, pFFAngle_, &OBForceField::E_Angle);
 
     if (!isKCAL_)
         conf_data.angleE *= KJ_TO_KCAL;
@@ -185,28 +1090,11 @@ void Chain::fillConformerEnergyData(double *xyz, PNAB::ConformerData &conf_data,
         return;
     }
 
-    // Get torsion energy
-    // Add interaction groups for rotatable torsions
-    bool is_there_fixed_bond = false;
-    for (int i=0; i < all_torsions_.size(); i++) {
-        // Determine whether we have fixed bonds
-        if (is_fixed_bond[i]) {
-            is_there_fixed_bond = true;
-            continue;
-            }
-        OBBitVec bit = OBBitVec();
-        for (auto j: all_torsions_[i]) {
-            bit.SetBitOn(j);
-        }
-        pFF_->AddIntraGroup(bit);
-    }
-
-    constraintsTor_.AddIgnore(0); // A trick to trigger a setup with the new interaction groups
-    pFF_->Setup(*current_mol, constraintsTor_);
-
-    conf_data.torsionE = pFF_->E_Torsion(false)/n; // Divide by the number of nucleotides
-
-    pFF_->ClearGroups();
+    // Get torsion energy for the rotatable torsions
+    if (torsion_terms_.native)
+        conf_data.torsionE = torsion_terms_.energy(xyz) / n; // Divide by the number of nucleotides
+    else
+        conf_data.torsionE = openbabel_energy(torsion_terms_, pFFTorsion_, &OBForceField::E_Torsion) / n;
 
     if (!isKCAL_)
         conf_data.torsionE *= KJ_TO_KCAL;
@@ -218,9 +1106,14 @@ void Chain::fillConformerEnergyData(double *xyz, PNAB::ConformerData &conf_data,
     }
 
     // Get VDW energy
-    pFF_->Setup(*current_mol, constraintsTot_); //empty constraint
-
-    conf_data.VDWE = pFF_->E_VDW(false) / n; // Divide by the number of nucleotides
+    double vdw = 0.0, electrostatic = 0.0;
+    pFFTotal_->SetCoordinates(*current_mol);
+    if (energy_mode_ != "openbabel") {
+        nonbonded_terms_.energy(xyz, vdw, electrostatic);
+        conf_data.VDWE = vdw / n; // Divide by the number of nucleotides
+    }
+    else
+        conf_data.VDWE = pFFTotal_->E_VDW(false) / n; // Divide by the number of nucleotides
 
     if (!isKCAL_)
         conf_data.VDWE *= KJ_TO_KCAL;
@@ -232,7 +1125,10 @@ void Chain::fillConformerEnergyData(double *xyz, PNAB::ConformerData &conf_data,
     }
 
     // Get total energy
-    conf_data.total_energy = pFF_->Energy(false) / n;
+    if (energy_mode_ != "openbabel")
+        conf_data.total_energy = (pFFTotal_->Energy(false) + vdw + electrostatic) / n; // Only bonded terms in the force field
+    else
+        conf_data.total_energy = pFFTotal_->Energy(false) / n;
 
     if (!isKCAL_)
         conf_data.total_energy *= KJ_TO_KCAL;
@@ -503,14 +1399,14 @@ void Chain::setupFFConstraints(OpenBabel::OBMol &chain, std::vector<unsigned> &n
     }
 }
 
-void Chain::setCoordsForChain(double *xyz, double *conf, PNAB::HelicalParameters &hp,
-                              std::vector<unsigned> &num_bu_atoms,
-                              std::vector<unsigned> &bb_start_index, std::vector<double *> &base_coords_vec,
-                              std::vector<unsigned> &deleted_atoms_ids, unsigned chain_index) {
+void Chain::setTransforms(HelicalParameters &hp) {
 
-    // Rotation for hexad
-    double twist = chain_index * 60.0 * DEG_TO_RAD;
-    matrix3x3 z_rot = {{cos(twist), -sin(twist), 0},{sin(twist), cos(twist), 0}, {0, 0, 1}};
+    vector<double> params = {hp.inclination, hp.tip, hp.h_twist, hp.x_displacement, hp.y_displacement, hp.h_rise,
+                             hp.shift, hp.slide, hp.rise, hp.tilt, hp.roll, hp.twist,
+                             hp.buckle, hp.propeller, hp.opening, hp.shear, hp.stretch, hp.stagger};
+    if (params == transforms_hp_)
+        return;
+    transforms_hp_ = params;
 
     // Reflection for both the duplex and the hexad
     matrix3x3 change_sign = {{1, 0, 0},{0, -1, 0}, {0, 0, -1}};
@@ -521,6 +1417,71 @@ void Chain::setCoordsForChain(double *xyz, double *conf, PNAB::HelicalParameters
     // Get the global rotation and translations
     auto g_rot = hp.getGlobalRotationMatrix(false, false);
     auto g_trans = hp.getGlobalTranslationVec(false, false);
+
+    for (unsigned chain_index=0; chain_index < 6; chain_index++) {
+        transforms_[chain_index].resize(chain_length_);
+        if (!build_strand_[chain_index])
+            continue;
+
+        // Rotation for hexad
+        double twist = chain_index * 60.0 * DEG_TO_RAD;
+        matrix3x3 z_rot = {{cos(twist), -sin(twist), 0},{sin(twist), cos(twist), 0}, {0, 0, 1}};
+
+        // The base-pair transformation
+        auto bp_rot = hp.getStepRotationMatrix(1, true, (bool) chain_index);
+        auto bp_g_rot = hp.getGlobalRotationMatrix(true, (bool) chain_index);
+        auto bp_trans = hp.getStepTranslationVec(1, true, (bool) chain_index);
+        auto bp_g_trans = hp.getGlobalTranslationVec(true, (bool) chain_index);
+
+        for (unsigned i = 0; i < chain_length_; ++i) {
+            // Get the step translation and rotation
+            auto s_trans = hp.getStepTranslationVec(i, false, false);
+            auto s_rot   = hp.getStepRotationMatrix(i, false, false);
+
+            // Apply the transformations in the same order as for each atom; the translations are skipped for the columns
+            auto transform = [&](vector3 v3, bool translate) {
+                if (!strand_orientation_[chain_index])
+                    v3 *= change_sign;
+
+                v3 *= bp_rot;
+                v3 *= bp_g_rot;
+                if (translate) {
+                    v3 += bp_trans;
+                    v3 += bp_g_trans;
+                }
+
+                v3 *= g_rot;
+                if (translate)
+                    v3 += g_trans;
+                v3 *= s_rot;
+                if (translate)
+                    v3 += s_trans;
+
+                if (hexad_)
+                    v3 *= z_rot;
+
+                //// Reflect to get the orientation that agrees with 3DNA for DNA/RNA
+                //v3 *=  change_sign2;
+                return v3;
+            };
+
+            auto &m = transforms_[chain_index][i];
+            vector3 columns[3] = {transform(vector3(1, 0, 0), false), transform(vector3(0, 1, 0), false),
+                                  transform(vector3(0, 0, 1), false)};
+            vector3 translation = transform(vector3(0, 0, 0), true);
+            for (int row=0; row < 3; row++) {
+                for (int col=0; col < 3; col++)
+                    m[4 * row + col] = columns[col][row];
+                m[4 * row + 3] = translation[row];
+            }
+        }
+    }
+}
+
+void Chain::setCoordsForChain(double *xyz, double *conf, std::vector<unsigned> &num_bu_atoms,
+                              std::vector<unsigned> &bb_start_index, std::vector<double *> &base_coords_vec,
+                              std::vector<unsigned> &deleted_atoms_ids, unsigned chain_index) {
+
     unsigned xyzI = 0, local_offset = 0, deleted_atom_index = 0;
 
     // Get the correct beginning index for the duplex and the hexad
@@ -533,73 +1494,28 @@ void Chain::setCoordsForChain(double *xyz, double *conf, PNAB::HelicalParameters
     for (unsigned i = 0; i < chain_length_; ++i) {
         auto n = num_bu_atoms[i];
         auto r = bb_start_index[i];
-        // Get the step translation and rotation 
-        auto s_trans = hp.getStepTranslationVec(i, false, false);
-        auto s_rot   = hp.getStepRotationMatrix(i, false, false);
+        Eigen::Map<const Eigen::Matrix<double, 3, 4, Eigen::RowMajor>> transform(transforms_[chain_index][i].data());
 
         // Set the coordinates for the nucleobases
-        double *base_coords = base_coords_vec[i];
-        for (unsigned baseI = 0; baseI < r - 1; ++baseI) {
-            vector3 v3;
-            v3.Set(base_coords + 3 * baseI);
-
-            if (!strand_orientation_[chain_index])
-                v3 *= change_sign;
-
-            v3 *= hp.getStepRotationMatrix(1, true, (bool) chain_index);
-            v3 *= hp.getGlobalRotationMatrix(true, (bool) chain_index);
-            v3 += hp.getStepTranslationVec(1, true, (bool) chain_index);
-            v3 += hp.getGlobalTranslationVec(true, (bool) chain_index);
-            
-            v3 *= g_rot;
-            v3 += g_trans;
-            v3 *= s_rot;
-            v3 += s_trans;
-
-            if (hexad_)
-                v3 *= z_rot;
-
-            //// Reflect to get the orientation that agrees with 3DNA for DNA/RNA
-            //v3 *=  change_sign2;
-
-            v3.Get(xyz + xyzI);
-            xyzI += 3;
-        }
+        Eigen::Map<const Eigen::Matrix3Xd> base(base_coords_vec[i], 3, r - 1);
+        Eigen::Map<Eigen::Matrix3Xd>(xyz + xyzI, 3, r - 1) = (transform.leftCols<3>() * base).colwise() + transform.col(3);
+        xyzI += 3 * (r - 1);
 
         // Set the coordinates for backbone
         unsigned monomer_index = monomer_bb_index_range_[0] - 1;
+        bb_xyz_.resize(3 * (n - r + 1));
+        Eigen::Map<const Eigen::Matrix3Xd> backbone(conf + 3 * monomer_index, 3, n - r + 1);
+        Eigen::Map<Eigen::Matrix3Xd>(bb_xyz_.data(), 3, n - r + 1) = (transform.leftCols<3>() * backbone).colwise() + transform.col(3);
+
+        // Skip the deleted atoms
         for (unsigned bbI = r - 1; bbI < n; bbI++) {
             if (deleted_atoms_ids.empty() || bbI + local_offset + 1 != deleted_atoms_ids[deleted_atom_index] + 1) {
-                vector3 v3;
-                v3.Set(conf + 3 * monomer_index);
-
-                if (!strand_orientation_[chain_index])
-                     v3 *= change_sign;
-
-                v3 *= hp.getStepRotationMatrix(1, true, (bool) chain_index);
-                v3 *= hp.getGlobalRotationMatrix(true, (bool) chain_index);
-                v3 += hp.getStepTranslationVec(1, true, (bool) chain_index);
-                v3 += hp.getGlobalTranslationVec(true, (bool) chain_index);
- 
-                v3 *= g_rot;
-                v3 += g_trans;
-                v3 *= s_rot;
-                v3 += s_trans;
-
-                if (hexad_)
-                    v3 *= z_rot;
-
-                //// Reflect to get the orientation that agrees with 3DNA for DNA/RNA
-                //v3 *=  change_sign2;
-
-                v3.Get(xyz + xyzI);
+                std::copy(bb_xyz_.begin() + 3 * (bbI - r + 1), bb_xyz_.begin() + 3 * (bbI - r + 2), xyz + xyzI);
                 xyzI += 3;
             } else {
                 deleted_atom_index++;
             }
-            monomer_index++;
         }
         local_offset += n;
     }
-
 }
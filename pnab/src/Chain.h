@@ -10,11 +10,161 @@
 #include <openbabel/rotor.h>
 #include <openbabel/generic.h>
 #include <openbabel/obiter.h>
+#include <openbabel/ring.h>
 #include "Containers.h"
 #define KJ_TO_KCAL 0.239006
 
 namespace PNAB {
 
+    /**
+    * @brief A class for evaluating one type of bonded energy terms (bonds, angles, or torsions) without openbabel
+    *
+    * The atoms of all the terms and their parameters are stored in flat arrays. The energy of each term
+    * is expanded in a few basis functions of its internal coordinate: a polynomial in the bond length
+    * for bonds, a polynomial in the angle for angles, and a Fourier series in the dihedral angle for torsions.
+    * Terms with the same atom types, bond orders, and rings share their expansion coefficients, which are fitted
+    * to the energies computed by the openbabel force field instance of the chain once openbabel has computed as many
+    * energies as the fit needs. The functional forms of the bonded terms of GAFF and MMFF94 are reproduced exactly by these expansions.
+    * If the fit does not reproduce the force field (e.g. the cosine angle terms of UFF), the terms are marked
+    * as not native and openbabel is used instead.
+    *
+    * @sa Chain::setupBondedTerms
+    * @sa Chain::fitBondedTerms
+    * @sa Chain::fillConformerEnergyData
+    */
+    class BondedTerms {
+
+    public:
+        /**
+        * @brief Constructor for the bonded terms
+        *
+        * @param n_atoms The number of atoms in each term; 2 for bonds, 3 for angles, and 4 for torsions
+        */
+        explicit BondedTerms(unsigned n_atoms = 2);
+
+        /**
+        * @brief Computes the internal coordinate of a term
+        *
+        * @param xyz The coordinates of the whole system
+        * @param atoms The offsets of the atoms of the term in the coordinate array (three times the zero-based atom index)
+        * @param basis An array of size n_basis to be filled with the values of the basis functions
+        */
+        void computeBasis(const double *xyz, const unsigned *atoms, double *basis) const;
+
+        /**
+        * @brief Computes the sum of the energies of all the terms
+        *
+        * @param xyz The coordinates of the whole system
+        *
+        * @returns The energy in the units of the force field
+        */
+        double energy(const double *xyz) const;
+
+        /**
+        * @brief The number of random positions used to fit and check the expansion coefficients
+        *
+        * @returns Twice the number of coefficients for the fit, and a few more positions for the check
+        */
+        std::size_t numFitSamples() const;
+
+        unsigned n_atoms, //!< @brief The number of atoms in each term
+                 n_basis; //!< @brief The number of basis functions (parameters) for each term
+        std::vector<unsigned> atoms; //!< @brief The offsets of the atoms of all the terms in the coordinate array, n_atoms per term
+        std::vector<unsigned> keys; //!< @brief The index of the expansion coefficients of each term
+        std::vector<double> params; //!< @brief The expansion coefficients shared by the terms, n_basis per index
+        std::size_t num_evaluations = 0; //!< @brief The number of energies computed with openbabel; the terms are fitted when it reaches numFitSamples
+        bool native = false; //!< @brief Whether the expansion reproduces the force field for all the terms
+    };
+
+    /**
+    * @brief A class for evaluating the van der Waals and electrostatic energies with a cell list
+    *
+    * For the van der Waals energy, the atoms are binned into cubic cells with the size of the cutoff, and only the pairs of atoms
+    * in neighboring cells are considered. Thus, the cost scales linearly with the number of atoms. As in openbabel, the pairs of
+    * atoms that are bonded or separated by two bonds are excluded, and the pairs separated by three bonds (1-4 pairs) may be scaled.
+    *
+    * The electrostatic energy is not truncated, as the strands are charged and the truncated energy is far from the total
+    * energy computed by openbabel. The atoms are grouped by nucleotide. The pairs of atoms in two nucleotides are computed exactly
+    * if the spheres enclosing the nucleotides are closer than the cutoff, and the two nucleotides interact through their charges,
+    * dipoles, and quadrupoles otherwise. The number of pairs of nucleotides is small compared with the number of pairs of atoms.
+    *
+    * The van der Waals parameters are stored for each pair of atom types and 1-4 flag. Two functional forms are supported:
+    * the Lennard-Jones 12-6 potential (e.g. GAFF and UFF) and the buffered 14-7 potential (MMFF94). The parameters, the
+    * electrostatic constants, and the partial charges are determined from the openbabel force field when the chain is constructed.
+    *
+    * In the "helical symmetry" energy mode, the pairs of atoms are instead evaluated from a list of the unique pairs. Each pair
+    * in the list stands for all the pairs related to it by the helical symmetry and is weighted by their number.
+    *
+    * @sa Chain::setupNonbondedTerms
+    * @sa Chain::setupSymmetricPairs
+    * @sa Chain::fillConformerEnergyData
+    * @sa RuntimeParameters::energy_mode
+    */
+    class NonbondedTerms {
+
+    public:
+        /**
+        * @brief Computes the van der Waals and electrostatic energies of all the pairs within the cutoff,
+        *        or of the unique pairs if @a symmetric is set
+        *
+        * @param xyz The coordinates of the whole system
+        * @param vdw The van der Waals energy in the units of the force field
+        * @param electrostatic The electrostatic energy in the units of the force field
+        */
+        void energy(const double *xyz, double &vdw, double &electrostatic) const;
+
+        /**
+        * @brief Computes the electrostatic energy from the pairs of atoms in nearby nucleotides and the multipole
+        *        expansion for the other pairs of nucleotides
+        *
+        * @param xyz The coordinates of the whole system
+        *
+        * @returns The electrostatic energy in the units of the force field
+        */
+        double electrostaticEnergy(const double *xyz) const;
+
+        /**
+        * @brief Computes the van der Waals energy of one pair of atoms
+        *
+        * @param r The distance between the atoms
+        * @param params The two parameters of the pair; (A, B) for the Lennard-Jones 12-6 potential A/r^12 - B/r^6
+        *               and (R, epsilon) for the buffered 14-7 potential
+        *
+        * @returns The van der Waals energy in the units of the force field
+        */
+        double vdwPairEnergy(double r, const double *params) const;
+
+        double cutoff = 12.0; /*!< @brief The cutoff distance (Angstrom) for the van der Waals interactions, and the distance between
+                               *   two nucleotides beyond which their electrostatic interaction is computed from their multipoles
+                               */
+        bool buffered = false; //!< @brief Whether the van der Waals potential is the buffered 14-7 potential instead of the Lennard-Jones 12-6 potential
+        unsigned n_types = 0; //!< @brief The number of atom types in the system
+        std::vector<unsigned> types; //!< @brief The atom type index of each atom
+        std::vector<double> charges; //!< @brief The partial charge of each atom
+        std::vector<double> vdw_params; //!< @brief Two van der Waals parameters for each pair of atom types and 1-4 flag
+        double electrostatic_constant = 0.0, //!< @brief The constant multiplying the product of the charges divided by the distance
+               electrostatic_buffer = 0.0, //!< @brief The constant added to the distance in the electrostatic term
+               electrostatic_scale_14 = 1.0; //!< @brief The scaling of the electrostatic term for 1-4 pairs
+        std::vector<std::vector<std::pair<unsigned, int>>> relations; /*!< @brief For each atom, the atoms that are 1-2 or 1-3 (relation 0)
+                                                                       *   or 1-4 (relation 1) to it. Sorted by the atom index
+                                                                       */
+        std::vector<unsigned> group_atoms, //!< @brief The atoms of all the nucleotides, one nucleotide after the other
+                              group_offsets; //!< @brief The offset of the atoms of each nucleotide in @a group_atoms, and the number of atoms at the end
+        bool symmetric = false; //!< @brief Whether the energy is computed from the list of unique pairs instead of the cell list
+        std::vector<unsigned> pair_atoms; //!< @brief The two atoms of each unique pair
+        std::vector<unsigned> pair_vdw_params; //!< @brief The offset of the van der Waals parameters of each unique pair in @a vdw_params
+        std::vector<double> pair_weights, //!< @brief The number of pairs that each unique pair stands for
+                            pair_electrostatic; //!< @brief The electrostatic coefficient of each unique pair, including the weight
+
+    private:
+        mutable std::vector<int> head_, //!< @brief The first atom in each cell
+                                 next_, //!< @brief The next atom in the same cell for each atom
+                                 relation_of_; //!< @brief The relation of each atom to the atom being considered, or -1 if they are not related
+        mutable std::vector<double> multipoles_; /*!< @brief The center, radius, charge, dipole, and traceless quadrupole (xx, yy, zz, xy, xz, yz)
+                                                  *   of each nucleotide
+                                                  */
+    };
+
     /**
     * @brief A class for building nucleic acid strands and evaluating their energies
     *
@@ -54,15 +204,21 @@ namespace PNAB {
         * @param build_strand Defines whether to build a given strand, RuntimeParameters::build_strand
         * @param strand_orientation The orientation of each strand in the hexad, RuntimeParameters::strand_orientation
         * @param glycosidic_bond_distance The distance of the glycosidic bond, RuntimeParameters::glycosidic_bond_distance
+        * @param energy_mode The method used to compute the van der Waals and total energies, RuntimeParameters::energy_mode
+        * @param nonbonded_cutoff The cutoff for the nonbonded interactions in the "cell list" energy mode, RuntimeParameters::nonbonded_cutoff
+        *
+        * @throws std::runtime_error if the energy mode is unrecognized, or if the "helical symmetry" mode is requested for
+        *         a strand with different nucleobases
         *
         * @sa setupChain
         * @sa setupFFConstraints
         */
-        Chain(PNAB::Bases bases, const PNAB::Backbone &backbone, std::vector<std::string> strand,
+        Chain(PNAB::Bases &bases, const PNAB::Backbone &backbone, std::vector<std::string> strand,
               std::string ff_type, std::array<unsigned, 2> &range, bool hexad,
               std::vector<bool> build_strand = {true, false, false, false, false, false},
               std::vector<bool> strand_orientation = {true, true, true, true, true, true},
-              double glycosidic_bond_distance = 0.0);
+              double glycosidic_bond_distance = 0.0, std::string energy_mode = "openbabel",
+              double nonbonded_cutoff = 12.0);
 
         /**
         * @brief Destructor for the chain class
@@ -72,8 +228,22 @@ namespace PNAB {
                 for (auto i : v)
                     delete[] i;
             }
+            delete pFFBond_;
+            delete pFFAngle_;
+            delete pFFTorsion_;
+            delete pFFTotal_;
         }
 
+        /**
+        * @brief The chain owns raw pointers to the coordinates and the force field, so it cannot be copied
+        */
+        Chain(const Chain &) = delete;
+
+        /**
+        * @brief The chain owns raw pointers to the coordinates and the force field, so it cannot be copied
+        */
+        Chain &operator=(const Chain &) = delete;
+
         /**
         * @brief Generate structure and energy data for nucleic acid conformers
         *
@@ -119,12 +289,24 @@ namespace PNAB {
                                                                                                       */
         unsigned chain_length_, //!< @brief The number of nucleotides in the strand
                  n_chains_; //!< @brief The number of strands in the system
+        std::string energy_mode_; //!< @brief The method used to compute the van der Waals and total energies, RuntimeParameters::energy_mode
+        PNAB::NonbondedTerms nonbonded_terms_; //!< @brief The nonbonded interactions for the "cell list" and "helical symmetry" energy modes
         bool isKCAL_, //!< @brief Whether the energy computed by openbabel is in kcal/mol
              hexad_; //!< @brief Whether we are building a hexad, RuntimeParameters::is_hexad
         std::vector<bool> strand_orientation_; //!< @brief A vector containing the orientation of each strand in the hexad, RuntimeParameters::strand_orientation
         double glycosidic_bond_distance_; //!< @brief The distance of the glycosidic bond, RuntimeParameters::glycosidic_bond_distance
-        OpenBabel::OBForceField *pFF_; //!< @brief The openbabel force field. Used to compute the energy of the system
+        OpenBabel::OBForceField *pFFBond_, //!< @brief An instance of the openbabel force field owned by the chain and set up once for the bond energy term
+                                *pFFAngle_, //!< @brief An instance of the openbabel force field owned by the chain and set up once for the angle energy term
+                                *pFFTorsion_, //!< @brief An instance of the openbabel force field owned by the chain and set up once for the torsion energy term
+                                *pFFTotal_; /*!< @brief An instance of the openbabel force field owned by the chain and set up once for the van der Waals and
+                                             *   total energy terms. Only the bonded terms are included in the "cell list" and "helical symmetry" energy modes
+                                             */
         std::array<unsigned, 2> monomer_bb_index_range_; //!< @brief Backbone index range for the first nucleotide
+        std::vector<std::vector<std::array<double, 12>>> transforms_ = std::vector<std::vector<std::array<double, 12>>>(6); /*!< @brief The 3x4 affine
+                                                                                                                             *   transform (row-major) of each nucleotide in each strand
+                                                                                                                             */
+        std::vector<double> transforms_hp_; //!< @brief The helical parameters used to compute Chain::transforms_
+        std::vector<double> bb_xyz_; //!< @brief The transformed backbone coordinates of one nucleotide before removing the deleted atoms
         std::vector<std::vector<unsigned>> v_bb_start_index_ = std::vector<std::vector<unsigned>>(6); /*!< @brief A vector containing a vector of the starting
                                                                                                        *   indices of the backbone atoms in the BaseUnit for each strand
                                                                                                        */
@@ -134,6 +316,10 @@ namespace PNAB {
         std::vector<bool> is_fixed_bond; //!< @brief A vector containing whether the torsional energy term is for a fixed rotatable bond or not
         std::vector<bool> build_strand_; //!< @brief A vector containing whether a given strand should be built
 
+        PNAB::BondedTerms bond_terms_ = PNAB::BondedTerms(2), //!< @brief The bond terms between the first and second nucleotides evaluated without openbabel
+                          angle_terms_ = PNAB::BondedTerms(3), //!< @brief The angle terms between the first and second nucleotides evaluated without openbabel
+                          torsion_terms_ = PNAB::BondedTerms(4); //!< @brief The terms of the rotatable torsions evaluated without openbabel
+
         OpenBabel::OBFFConstraints constraintsBond_, //!< @brief Setting all atoms not forming the new bond between the first two nucleotides to be ignored during bond energy computation
                                    constraintsAng_, //!< @brief An empty constraint object for angles; Energy groups are used for the angle terms
                                    constraintsTor_, //!< @brief An empty constraint object for torsions; Energy groups are used for the torsion terms
@@ -143,8 +329,9 @@ namespace PNAB {
         * @brief Computes the energy terms for the candidate system and determines whether it satisfies the energy thresholds
         *
         * This function uses openbabel to compute the energy for the candidate systems. See the description in setupFFConstraints
-        * for the bond, angle, and torsional energies terms. The van der Waals and total energy terms of the systems are computed
-        * without any constraints. The energy terms are computed sequentially as follows: bond, angle, torsion, van der Waals, and
+        * for the bond, angle, and torsional energies terms. These three terms are computed with BondedTerms when
+        * the fitted parameters reproduce the force field; the terms are fitted here once BondedTerms::numFitSamples energies
+        * are computed with openbabel. The van der Waals and total energy terms of the systems are computed without any constraints. The energy terms are computed sequentially as follows: bond, angle, torsion, van der Waals, and
         * total energies. If any one of the energy terms does not satisfy the energy thresholds defined in RuntimeParameters::energy_filter,
         * then the candidate is rejected, and we do not proceed to compute the additional energy terms.
         *
@@ -156,6 +343,95 @@ namespace PNAB {
         */
         void fillConformerEnergyData(double *xyz, PNAB::ConformerData &conf_data, std::vector<double> energy_filter);
 
+        /**
+        * @brief Sets up the force field instances for the bond, angle, torsion, and total energy terms
+        *
+        * Each energy term uses its own force field instance with its own constraints and energy groups.
+        * The setup (atom typing, charges, and the list of interactions) is performed once when the chain is
+        * constructed; fillConformerEnergyData only updates the coordinates of the instances for each candidate.
+        * This function is called from the constructor while holding the openbabel lock.
+        *
+        * @sa fillConformerEnergyData
+        * @sa setupFFConstraints
+        */
+        void setupForceFields();
+
+        /**
+        * @brief Determines the bond, angle, and torsion terms computed by the force field instances
+        *
+        * The terms are the same as those computed by openbabel with the constraints and energy groups set in setupForceFields.
+        * The terms with the same atom types, bond orders, and rings are given the same index of expansion coefficients.
+        * This function is called from the constructor while holding the openbabel lock.
+        *
+        * @sa BondedTerms
+        * @sa fitBondedTerms
+        */
+        void setupBondedTerms();
+
+        /**
+        * @brief Fits the expansion coefficients of the bond, angle, or torsion terms
+        *
+        * The atoms of the terms are placed at random along a spanning tree of their bonds, so that the internal coordinates
+        * of the terms cover wide ranges, and the energies computed by the force field instance of the energy term are fitted
+        * by linear least squares. The fit is checked for other random positions. Only the force field instances of this chain
+        * are used, so this function is called from fillConformerEnergyData without holding the openbabel lock.
+        *
+        * @param terms The bond, angle, or torsion terms
+        * @param pFF The force field instance of the energy term
+        * @param term_energy The function of the force field computing the energy term (e.g. OBForceField::E_Bond)
+        *
+        * @returns Whether the fit reproduces the force field; false if there are no terms
+        *
+        * @sa BondedTerms
+        * @sa fillConformerEnergyData
+        */
+        bool fitBondedTerms(PNAB::BondedTerms &terms, OpenBabel::OBForceField *pFF, double (OpenBabel::OBForceField::*term_energy)(bool));
+
+        /**
+        * @brief Determines the parameters of the nonbonded interactions for the "cell list" and "helical symmetry" energy modes
+        *
+        * The atom types and partial charges are taken from the force field instance of the total energy. The van der Waals parameters
+        * of each pair of atom types (and 1-4 flag) are fitted to the energies computed by a separate force field instance for a
+        * representative pair of atoms placed at a few distances while all the other atoms are far away. The electrostatic constants
+        * are determined in the same way, with the same force field instance. This function is called from the constructor while
+        * holding the openbabel lock.
+        *
+        * @param pFF The openbabel force field
+        *
+        * @sa NonbondedTerms
+        * @sa fillConformerEnergyData
+        */
+        void setupNonbondedTerms(OpenBabel::OBForceField *pFF);
+
+        /**
+        * @brief Finds the unique pairs of atoms for the "helical symmetry" energy mode
+        *
+        * All the nucleotides in a strand of a homopolymer have the same conformation and are related by the same helical
+        * step. Hence, the distance between two atoms depends only on their strands, their indices within the nucleotide, and the
+        * difference between their nucleotide indices. Pairs with the same distance, atom types, partial charges, and 1-4 flag
+        * have the same energy. Only one pair of each kind is kept and weighted by the number of such pairs. The number of unique
+        * pairs grows linearly with the length of the strand. The atoms at the ends of the strand, which have different atom
+        * types or are missing in other nucleotides, form their own pairs, so the energy is the same as that of all the pairs.
+        *
+        * @sa NonbondedTerms
+        * @sa setCoordsForChain
+        */
+        void setupSymmetricPairs();
+
+        /**
+        * @brief Find the strand, nucleotide, and index within the nucleotide of each atom of the combined chain
+        *
+        * The atoms are in the same order as in setCoordsForChain. The atoms removed when the nucleotides are joined are skipped.
+        *
+        * @param atom_strand The strand of each atom
+        * @param atom_residue The index of the nucleotide of each atom in its strand
+        * @param atom_index The index of each atom in its nucleotide
+        *
+        * @sa setCoordsForChain
+        */
+        void findAtomNucleotides(std::vector<unsigned> &atom_strand, std::vector<unsigned> &atom_residue,
+                                 std::vector<unsigned> &atom_index);
+
         /**
         * @brief Creates the molecule for each strand in the system
         *
@@ -212,9 +488,11 @@ namespace PNAB {
         * generate anti-parallel strands. For hexad systems, it can generate any combination of the parallel and anti-parallel
         * strands.
         *
+        * The coordinates of each nucleotide are generated with one matrix multiplication using the transforms computed
+        * by Chain::setTransforms.
+        *
         * @param xyz An array that will get the coordinates of the strands
         * @param conf An array containing the coordinates of one backbone determined by the search algorithms
-        * @param hp An instance of HelicalParameters which has the helical parameters and functions to generate the coordinates
         * @param num_bu_atoms The number of atoms in each BaseUnit
         * @param bb_start_index A vector containing the starting indices of the backbone atoms in the BaseUnit
         * @param base_coords_vec A vector containing the coordinates of each one of the nucleotides
@@ -222,14 +500,28 @@ namespace PNAB {
         * @param chain_index The index of the strand in the system
         *
         * @sa setupChain
+        * @sa setTransforms
         * @sa generateConformerData
-        * @sa HelicalParameters
         * @sa ConformationSearch
         */
-        void setCoordsForChain(double *xyz, double *conf, PNAB::HelicalParameters &hp, std::vector<unsigned> &num_bu_atoms,
+        void setCoordsForChain(double *xyz, double *conf, std::vector<unsigned> &num_bu_atoms,
                                std::vector<unsigned> &bb_start_index, std::vector<double *> &base_coords_vec,
                                std::vector<unsigned> &deleted_atoms_ids, unsigned chain_index);
 
+        /**
+        * @brief Computes the transform of each nucleotide in each strand
+        *
+        * The base-pair and base-step rotations and translations, the reflection for the anti-parallel strands, and the
+        * rotation for the hexads are combined into one 3x4 affine transform for each nucleotide. The transforms are
+        * only recomputed when the helical parameters change.
+        *
+        * @param hp An instance of HelicalParameters which has the helical parameters and functions to generate the coordinates
+        *
+        * @sa setCoordsForChain
+        * @sa HelicalParameters
+        */
+        void setTransforms(PNAB::HelicalParameters &hp);
+
         /**
         * @brief Orders the residues in the molecules correctly
         *
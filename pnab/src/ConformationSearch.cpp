@@ -2,8 +2,13 @@
  * @brief A file for defining various search algorithm functions
  */
 
+#include <fstream>
 #include <iomanip>
+#include <map>
+#include <numeric>
 #include <set>
+#include <thread>
+#include <unordered_set>
 #include <pybind11/pybind11.h>
 #include "ConformationSearch.h"
 
@@ -12,8 +17,259 @@ using namespace PNAB;
 using namespace std;
 using namespace OpenBabel;
 
+Migration::Migration(unsigned num_islands) : active_(num_islands) {
+    // No individual was sent before the first migration
+    for (auto &m: migrants_)
+        m.assign(num_islands, Migrant{numeric_limits<size_t>::max(), 0.0, {}});
+}
+
+bool Migration::exchange(unsigned island, std::vector<double> &genes, double &fitness) {
+    unique_lock<mutex> lock(mutex_);
+    size_t round = round_;
+    auto &migrants = migrants_[round % 2];
+    migrants[island] = Migrant{round, fitness, genes};
+
+    // The last island to arrive starts the next migration; the others wait for it
+    if (++arrived_ == active_) {
+        arrived_ = 0;
+        round_++;
+        round_done_.notify_all();
+    }
+    else
+        round_done_.wait(lock, [&]() { return round_ != round; });
+
+    // Receive the individual sent by the previous island in this migration
+    auto &received = migrants[(island + migrants.size() - 1) % migrants.size()];
+    if (received.round != round)
+        return false;
+    genes = received.genes;
+    fitness = received.fitness;
+    return true;
+}
+
+void Migration::leave() {
+    lock_guard<mutex> lock(mutex_);
+    // Complete the current migration if the other islands are waiting for this island
+    if (--active_ == arrived_ && arrived_ > 0) {
+        arrived_ = 0;
+        round_++;
+        round_done_.notify_all();
+    }
+}
+
+ReplicaExchange::ReplicaExchange(const std::vector<double> &temperatures, unsigned seed) : active_(temperatures.size()) {
+    for (auto t: temperatures)
+        replicas_.push_back(Replica{true, 1.0 / (t * BOLTZMANN), {}, 0.0, 0.0});
+    // Use a random number stream different from those of the replicas
+    seed_seq seq{seed, static_cast<unsigned>(temperatures.size())};
+    rng_.seed(seq);
+}
+
+void ReplicaExchange::exchange(unsigned replica, std::vector<double> &angles, double &distance, double &energy) {
+    unique_lock<mutex> lock(mutex_);
+    auto &r = replicas_[replica];
+    r.angles = angles;
+    r.distance = distance;
+    r.energy = energy;
+
+    // The last replica to arrive swaps the states; the others wait for it
+    size_t round = round_;
+    if (++arrived_ == active_)
+        swapReplicas();
+    else
+        round_done_.wait(lock, [&]() { return round_ != round; });
+
+    angles = r.angles;
+    distance = r.distance;
+    energy = r.energy;
+}
+
+void ReplicaExchange::leave(unsigned replica) {
+    lock_guard<mutex> lock(mutex_);
+    replicas_[replica].active = false;
+    // Complete the current exchange if the other replicas are waiting for this replica
+    if (--active_ == arrived_ && arrived_ > 0)
+        swapReplicas();
+}
+
+void ReplicaExchange::swapReplicas() {
+    // The replicas that are still searching, in increasing order of temperature
+    vector<Replica *> active;
+    for (auto &r: replicas_) {
+        if (r.active)
+            active.push_back(&r);
+    }
+
+    // Alternate between the even and the odd pairs of neighboring replicas
+    uniform_real_distribution<double> one_zero_dist(0, 1);
+    for (size_t i = round_ % 2; i + 1 < active.size(); i += 2) {
+        auto a = active[i], b = active[i + 1];
+        double delta = (a->beta - b->beta) * (a->energy - b->energy);
+        if (delta >= 0 || one_zero_dist(rng_) < exp(delta)) {
+            swap(a->angles, b->angles);
+            swap(a->distance, b->distance);
+            swap(a->energy, b->energy);
+        }
+    }
+
+    arrived_ = 0;
+    round_++;
+    round_done_.notify_all();
+}
+
+HaltonSequence::HaltonSequence(unsigned dimension, unsigned seed) {
+    // The first primes
+    for (unsigned n=2; bases_.size() < dimension; n++) {
+        if (all_of(bases_.begin(), bases_.end(), [&](unsigned p) { return n % p != 0; }))
+            bases_.push_back(n);
+    }
+
+    // A random permutation of the digits at each position, with enough positions for double precision
+    mt19937_64 rng;
+    seed_seq seq{seed};
+    rng.seed(seq);
+    for (auto b: bases_) {
+        int num_digits = ceil(53 * log(2.0) / log(b));
+        permutations_.emplace_back(num_digits, vector<unsigned>(b));
+        for (auto &permutation: permutations_.back()) {
+            iota(permutation.begin(), permutation.end(), 0);
+            shuffle(permutation.begin(), permutation.end(), rng);
+        }
+    }
+}
+
+void HaltonSequence::point(std::size_t index, std::vector<double> &point) const {
+    point.resize(bases_.size());
+    for (size_t d=0; d < bases_.size(); d++) {
+        // Mirror the scrambled digits of the index about the decimal point. The positions past the last digit of the index
+        // are scrambled zeros, so that the points do not cluster near zero
+        unsigned b = bases_[d];
+        size_t n = index;
+        double value = 0.0, weight = 1.0 / b;
+        for (auto &permutation: permutations_[d]) {
+            value += permutation[n % b] * weight;
+            n /= b;
+            weight /= b;
+        }
+        point[d] = min(value, nextafter(1.0, 0.0));
+    }
+}
+
+StructureWriter::StructureWriter(std::size_t capacity, const std::string &models_path) : capacity_(capacity) {
+    if (!models_path.empty()) {
+        models_.open(models_path + ".pdb", ios::out | ios::binary);
+        index_.open(models_path + ".csv", ios::out);
+        if (!models_ || !index_)
+            throw std::runtime_error("Cannot open the multi-model PDB file " + models_path + ".pdb");
+        index_ << "# Name, Model, Offset (bytes), Size (bytes)\n";
+    }
+    if (capacity_ > 0)
+        thread_ = thread(&StructureWriter::work, this);
+}
+
+StructureWriter::~StructureWriter() {
+    close();
+}
+
+void StructureWriter::write(std::string file_name, std::string contents) {
+    unique_lock<mutex> lock(mutex_);
+    // Without a writer thread, write the structure now
+    if (capacity_ == 0) {
+        save(file_name, contents);
+        return;
+    }
+    // Wait for the writer thread to catch up
+    not_full_.wait(lock, [&]() { return queue_.size() < capacity_; });
+    queue_.emplace_back(move(file_name), move(contents));
+    not_empty_.notify_one();
+}
+
+void StructureWriter::close() {
+    {
+        lock_guard<mutex> lock(mutex_);
+        closed_ = true;
+        not_empty_.notify_one();
+    }
+    if (thread_.joinable())
+        thread_.join();
+    models_.close();
+    index_.close();
+}
+
+void StructureWriter::work() {
+    unique_lock<mutex> lock(mutex_);
+    while (true) {
+        not_empty_.wait(lock, [&]() { return !queue_.empty() || closed_; });
+        // Write everything that was queued before the writer was closed
+        if (queue_.empty())
+            return;
+        auto structure = move(queue_.front());
+        queue_.pop_front();
+        not_full_.notify_one();
+
+        // Write without holding the lock, so that the searches can keep adding structures
+        lock.unlock();
+        save(structure.first, structure.second);
+        lock.lock();
+    }
+}
+
+void StructureWriter::save(const std::string &file_name, const std::string &contents) {
+    if (!models_.is_open()) {
+        ofstream file(file_name);
+        file << contents;
+        return;
+    }
+
+    // Wrap the structure in MODEL and ENDMDL records, in place of its END record
+    size_t end = contents.rfind("END");
+    if (end == string::npos || contents.find_first_not_of(" \r\n", end + 3) != string::npos)
+        end = contents.size();
+    ostringstream model;
+    model << "MODEL     " << setw(4) << ++num_models_ << "\n";
+    model.write(contents.data(), end);
+    model << "ENDMDL\n";
+
+    string s = model.str();
+    models_.write(s.data(), s.size());
+    models_.flush();
+    index_ << file_name << "," << num_models_ << "," << offset_ << "," << s.size() << "\n";
+    index_.flush();
+    offset_ += s.size();
+}
+
+CandidateStream::CandidateStream(Callback callback, std::size_t num_columns, std::size_t batch_size)
+    : callback_(callback), num_columns_(num_columns), batch_size_(max<size_t>(1, batch_size)), last_delivery_(chrono::steady_clock::now()) {}
+
+bool CandidateStream::add(const double *row) {
+    {
+        lock_guard<mutex> lock(mutex_);
+        batch_.insert(batch_.end(), row, row + num_columns_);
+        chrono::duration<double> elapsed = chrono::steady_clock::now() - last_delivery_;
+        if (batch_.size() < batch_size_ * num_columns_ && elapsed.count() < STREAM_INTERVAL)
+            return false;
+    }
+    return flush();
+}
+
+bool CandidateStream::flush() {
+    vector<double> batch;
+    {
+        lock_guard<mutex> lock(mutex_);
+        swap(batch, batch_);
+        last_delivery_ = chrono::steady_clock::now();
+    }
+    // Call the function without holding the lock, so that the other threads can keep adding candidates
+    if (batch.empty())
+        return false;
+    return callback_(batch);
+}
+
 ConformationSearch::ConformationSearch(RuntimeParameters &runtime_params, Backbone &backbone,
-                                       HelicalParameters &helical_params, Bases bases, string prefix, bool verbose) {
+                                       HelicalParameters &helical_params, Bases &bases, string prefix, bool verbose) {
+
+    // Setting up the molecules and the rotors is not thread-safe in openbabel
+    lock_guard<mutex> lock(openbabelMutex());
 
     // Set parameters
     runtime_params_ = runtime_params;
@@ -81,31 +337,172 @@ ConformationSearch::ConformationSearch(RuntimeParameters &runtime_params, Backbo
         r = rl.NextRotor(ri);
     }
 
-    // Header
-    std::string header = "# Prefix, Conformer Index, Distance (Angstroms), Bond Energy (kcal/mol), Angle Energy (kcal/mol), "
-                         "Torsion Energy (kcal/mol/nucleotide), Van der Waals Energy (kcal/mol/nucleotide), "
-                         "Total Energy (kcal/mol/nucleotide)";
-    for (int i=0; i < rotor_vector.size(); i++) {
-        header += ", Dihedral " + to_string(i+1) + " (degrees)";
+    // Setup the rotors for computing the distance from the dihedral angles
+    setupLinkerRotors();
+}
+
+void ConformationSearch::setCallback(CandidateStream::Callback callback, std::size_t batch_size) {
+    stream_ = make_shared<CandidateStream>(callback, numColumns(), batch_size);
+}
+
+void ConformationSearch::setStopToken(std::shared_ptr<StopToken> stop_token) {
+    stop_token_ = stop_token;
+}
+
+std::vector<std::string> ConformationSearch::columnNames(std::size_t num_dihedrals) {
+    vector<string> names = {"Conformer Index", "Distance (Angstroms)", "Bond Energy (kcal/mol)", "Angle Energy (kcal/mol)",
+                            "Torsion Energy (kcal/mol/nucleotide)", "Van der Waals Energy (kcal/mol/nucleotide)",
+                            "Total Energy (kcal/mol/nucleotide)"};
+    for (size_t i=0; i < num_dihedrals; i++)
+        names.push_back("Dihedral " + to_string(i+1) + " (degrees)");
+    return names;
+}
+
+std::vector<double> ConformationSearch::run() {
+
+    unsigned int num_threads = max(1u, runtime_params_.num_threads);
+
+    // Each island of the genetic algorithm search runs on its own thread
+    string algorithm = runtime_params_.search_algorithm;
+    transform(algorithm.begin(), algorithm.end(), algorithm.begin(), ::tolower);
+    shared_ptr<Migration> migration;
+    if (runtime_params_.num_islands > 1 && algorithm.find("genetic algorithm search") != std::string::npos) {
+        num_threads = runtime_params_.num_islands;
+        migration = make_shared<Migration>(num_threads);
+    }
+
+    // Each replica of the replica exchange Monte Carlo search runs on its own thread,
+    // with the temperatures spaced geometrically from the Monte Carlo temperature
+    shared_ptr<ReplicaExchange> replica_exchange;
+    if (algorithm.find("replica exchange monte carlo search") != std::string::npos) {
+        num_threads = max(1u, runtime_params_.num_replicas);
+        vector<double> temperatures;
+        for (unsigned int i=0; i < num_threads; i++) {
+            double fraction = num_threads == 1 ? 0.0 : static_cast<double>(i) / (num_threads - 1);
+            temperatures.push_back(runtime_params_.monte_carlo_temperature *
+                                   pow(runtime_params_.max_replica_temperature / runtime_params_.monte_carlo_temperature, fraction));
+        }
+        replica_exchange = make_shared<ReplicaExchange>(temperatures, runtime_params_.seed);
+    }
+    // Keep the structures with the lowest total energies in memory, and write them when the search finishes
+    if (runtime_params_.num_best > 0)
+        best_structures_ = make_shared<BestStructures>();
+
+    // Write the structures on a background thread, or to a single multi-model file
+    if (runtime_params_.write_queue_size > 0 || runtime_params_.multi_model_file)
+        writer_ = make_shared<StructureWriter>(runtime_params_.write_queue_size,
+                                               runtime_params_.multi_model_file ? prefix_ + "_models" : "");
+
+    // Set up a search for each additional thread. Each search has its own nucleotide, rotors, and coordinates.
+    // A single search keeps its random number stream, so that the results do not change
+    vector<unique_ptr<ConformationSearch>> searches;
+    for (unsigned int i=0; i < num_threads && (num_threads > 1 || replica_exchange); i++) {
+        ConformationSearch *s = this;
+        if (i > 0) {
+            searches.emplace_back(new ConformationSearch(runtime_params_, backbone_, helical_params_, bases_, prefix_, false));
+            s = searches.back().get();
+        }
+        s->thread_index_ = i;
+        s->num_threads_ = num_threads;
+        s->number_of_candidates = number_of_candidates;
+        s->stop_search_ = stop_search_;
+        s->migration_ = migration;
+        s->replica_exchange_ = replica_exchange;
+        s->best_structures_ = best_structures_;
+        s->writer_ = writer_;
+        s->stream_ = stream_;
+        s->stop_token_ = stop_token_;
+
+        // Derive a random number stream for each thread from the seed
+        seed_seq seq{runtime_params_.seed, i};
+        s->rng_.seed(seq);
     }
 
-    output_string += header + "\n";
+    // Exceptions cannot leave a thread; store them and stop the other threads
+    vector<exception_ptr> errors(num_threads);
+    auto work = [&](unsigned int i) {
+        try {
+            if (i == 0)
+                search();
+            else
+                searches[i - 1]->search();
+        }
+        catch (...) {
+            errors[i] = current_exception();
+            *stop_search_ = true;
+        }
+    };
+
+    vector<thread> threads;
+    for (unsigned int i=1; i < num_threads; i++)
+        threads.emplace_back(work, i);
+    // The calling thread runs the first search, so that it can check for keyboard interruptions
+    work(0);
+    for (auto &t: threads)
+        t.join();
+
+    // Wait for all the structures to be written, also when the search is interrupted or raises
+    writeBestStructures();
+    if (writer_)
+        writer_->close();
+
+    for (auto &e: errors) {
+        if (e)
+            rethrow_exception(e);
+    }
+
+    if (stream_)
+        stream_->flush();
+
+    // Add the candidates found by the other threads
+    for (auto &s: searches)
+        output_data.insert(output_data.end(), s->output_data.begin(), s->output_data.end());
+
+    // return the properties of the accepted candidates
+    return output_data;
 }
 
-std::string ConformationSearch::run() {
+void ConformationSearch::search() {
 
     // Choose search algorithm
     string search = runtime_params_.search_algorithm;
     transform(search.begin(), search.end(), search.begin(), ::tolower);
 
-    if(search.find("weighted random search") != std::string::npos)
-        ConformationSearch::RandomSearch(true);
+    if(search.find("weighted quasi-random search") != std::string::npos)
+        ConformationSearch::RandomSearch(true, true);
+
+    else if (search.find("quasi-random search") != std::string::npos)
+        ConformationSearch::RandomSearch(false, true);
+
+    else if(search.find("weighted random search") != std::string::npos)
+        ConformationSearch::RandomSearch(true, false);
 
     else if (search.find("random search") != std::string::npos)
-        ConformationSearch::RandomSearch(false);
+        ConformationSearch::RandomSearch(false, false);
+
+    else if (search.find("weighted adaptive sampling search") != std::string::npos)
+        ConformationSearch::AdaptiveSamplingSearch(true);
+
+    else if (search.find("adaptive sampling search") != std::string::npos)
+        ConformationSearch::AdaptiveSamplingSearch(false);
+
+    else if (search.find("weighted kinematic closure search") != std::string::npos)
+        ConformationSearch::KinematicClosureSearch(true);
+
+    else if (search.find("kinematic closure search") != std::string::npos)
+        ConformationSearch::KinematicClosureSearch(false);
+
+    else if (search.find("pruned systematic search") != std::string::npos)
+        ConformationSearch::SystematicSearch(true);
 
     else if (search.find("systematic search") != std::string::npos)
-        ConformationSearch::SystematicSearch();
+        ConformationSearch::SystematicSearch(false);
+
+    else if (search.find("weighted replica exchange monte carlo search") != std::string::npos)
+        ConformationSearch::MonteCarloSearch(true);
+
+    else if (search.find("replica exchange monte carlo search") != std::string::npos)
+        ConformationSearch::MonteCarloSearch(false);
 
     else if (search.find("weighted monte carlo search") != std::string::npos)
         ConformationSearch::MonteCarloSearch(true);
@@ -119,22 +516,40 @@ std::string ConformationSearch::run() {
     else {
         throw std::runtime_error(search + " is unrecognized search algorithm");
     }
+}
 
-    // return the CSV output string
-    return output_string;
+std::array<std::size_t, 2> ConformationSearch::threadRange(std::size_t search_size) {
+    // Split the steps evenly across the threads. If the steps cannot be split evenly,
+    // the first threads take one more step than the others
+    size_t chunk = search_size / num_threads_, remainder = search_size % num_threads_;
+    size_t begin = thread_index_ * chunk + min<size_t>(thread_index_, remainder);
+    size_t end = begin + chunk + (thread_index_ < remainder ? 1 : 0);
+    return {begin, end};
 }
 
 
 void ConformationSearch::GeneticAlgorithmSearch() {
     // Genetic algorithm search
 
+    // Once this island stops, the other islands continue to exchange individuals without it
+    struct LeaveMigration {
+        shared_ptr<Migration> migration;
+        ~LeaveMigration() {
+            if (migration)
+                migration->leave();
+        }
+    } leave_migration{migration_};
+
     // Setup chain
     Chain chain(bases_, backbone_, runtime_params_.strand, runtime_params_.ff_type, backbone_range_,
                 runtime_params_.is_hexad, runtime_params_.build_strand, runtime_params_.strand_orientation,
-                runtime_params_.glycosidic_bond_distance);
+                runtime_params_.glycosidic_bond_distance,
+                runtime_params_.energy_mode, runtime_params_.nonbonded_cutoff);
 
     // Set the search size; the number of generations in the genetic algorithm search
     size_t search_size = runtime_params_.num_steps;
+    // The generations searched by this thread. Each island evolves for all the generations
+    auto range = migration_ ? array<size_t, 2>{0, search_size} : threadRange(search_size);
 
     // Use uniform probability between 0 and 2 pi for the dihedral angles 
     uniform_real_distribution<double> dist = uniform_real_distribution<double>(0, 2 * M_PI);
@@ -147,53 +562,88 @@ void ConformationSearch::GeneticAlgorithmSearch() {
     int elites = 0; // Number of intact survivors; Not used now. Set to zero 
     double mutation_rate = runtime_params_.mutation_rate; // Mutation rate; large values prevent from getting stuck
     double crossover_rate = runtime_params_.crossover_rate; // Mating rate
-    vector<pair<double, vector<double>>> population; //(fitness (1/distance), vector of the torsional angles)
+
+    // The population is stored as the fitness (1/distance) of each individual and, in a separate contiguous buffer,
+    // the torsional angles of all the individuals one after the other. The new generation is written into a second
+    // pair of buffers, which are swapped with the population after each generation, so that no memory is allocated
+    // for the offsprings
+    size_t num_rotors = rotor_vector.size();
+    size_t population_size = numConformers;
+    vector<double> fitness(numConformers), new_fitness(numConformers);
+    vector<double> genes(numConformers * num_rotors), new_genes(numConformers * num_rotors);
+    // The individuals sorted by fitness; ties are sorted by the torsional angles
+    vector<size_t> ranking(numConformers);
+    auto fitter = [&](size_t a, size_t b) {
+        if (fitness[a] != fitness[b])
+            return fitness[a] < fitness[b];
+        return lexicographical_compare(genes.begin() + a * num_rotors, genes.begin() + (a + 1) * num_rotors,
+                                       genes.begin() + b * num_rotors, genes.begin() + (b + 1) * num_rotors);
+    };
+
+    // The dihedral angles of the rotors, set to the angles of each individual in turn
+    vector<double> angles(reference_angles_);
 
     // Initialize population with random dihedral angles
     for (int con=0; con < numConformers; con++ ) {
-        vector<double> state;
-        for (int i=0; i < rotor_vector.size(); i++) {
+        double *state = &genes[con * num_rotors];
+        for (size_t i=0; i < num_rotors; i++) {
             // Set all the dihedral angles to random values
-            state.push_back(dist(rng_));
-            auto r = rotor_vector[i];
-            r->SetToAngle(coords, state[i]);
+            state[i] = dist(rng_);
+            setAngle(angles, i, state[i]);
         }
         // Compute the fitness
-        double cur_dist = measureDistance(coords, head, tail);
-        population.push_back(make_pair(1.0/cur_dist, state));
+        fitness[con] = 1.0/measureDistance(angles);
     }
 
-    size_t save_index = 0; // Different index used to save pdb files
-    vector<int> save_cur_dist; // Save distance to avoid processing identical conformers
+    size_t save_index = (migration_ ? thread_index_ * search_size : range[0]) * numConformers; // Different index used to save pdb files
+    unordered_set<int> save_cur_dist; // Save distance to avoid processing identical conformers
+
+    // Rank-based selection probability for choosing an individual for crossover and mutation;
+    // it only changes if the size of the population changes
+    vector<double> weights;
+    discrete_distribution<> selection_probability;
 
     // Loop over the number of generations
-    for (size_t search_index=0; search_index < search_size; search_index++) {
+    for (size_t search_index = range[0]; search_index < range[1]; search_index++) {
 
-        if (PyErr_CheckSignals() != 0) {
-            py::error_already_set();
+        if (checkInterrupt())
             return;
-        }
 
         // print progress roughly every 10%
-        if (fmod(search_index, search_size/10) == 0 && verbose_) {
-            printProgress(search_index, search_size);
+        if (fmod(search_index - range[0], (range[1] - range[0])/10) == 0 && verbose_) {
+            printProgress(search_index - range[0], range[1] - range[0]);
         }
 
         // Sort population by fitness
-        sort(population.begin(), population.end());
-        vector<double> weights;
-        for (int i=0; i < population.size(); i++) {
-            // It seems rank-based weights are better in our case
-            // Weighting based on the fitness value seems to be too strong
-            weights.push_back(i + 1); // The weight is proportional to the rank
+        ranking.resize(population_size);
+        iota(ranking.begin(), ranking.end(), 0);
+
+        // Send a copy of the fittest individual to the next island and replace the
+        // least fit individual with the one sent by the previous island
+        if (migration_ && runtime_params_.migration_interval > 0 && search_index > 0 &&
+            search_index % runtime_params_.migration_interval == 0) {
+            auto best = *max_element(ranking.begin(), ranking.end(), fitter);
+            auto worst = *min_element(ranking.begin(), ranking.end(), fitter);
+            vector<double> migrant(genes.begin() + best * num_rotors, genes.begin() + (best + 1) * num_rotors);
+            double migrant_fitness = fitness[best];
+            if (migration_->exchange(thread_index_, migrant, migrant_fitness)) {
+                copy(migrant.begin(), migrant.end(), genes.begin() + worst * num_rotors);
+                fitness[worst] = migrant_fitness;
+            }
         }
 
-        // Selection probability for choosing an individuals for crossover and mutation
-        // Generate the index of the selected individual
-        discrete_distribution<> selection_probability (weights.begin(), weights.end()); 
-
-        // Vector to store new generation
-        vector<pair<double, vector<double>>> new_generation;
+        sort(ranking.begin(), ranking.end(), fitter);
+        if (weights.size() != population_size) {
+            weights.clear();
+            for (size_t i=0; i < population_size; i++) {
+                // It seems rank-based weights are better in our case
+                // Weighting based on the fitness value seems to be too strong
+                weights.push_back(i + 1); // The weight is proportional to the rank
+            }
+            // Selection probability for choosing an individuals for crossover and mutation
+            // Generate the index of the selected individual
+            selection_probability = discrete_distribution<>(weights.begin(), weights.end());
+        }
 
         // Save some candidates for the next generation
         // Not implemented now
@@ -203,16 +653,21 @@ void ConformationSearch::GeneticAlgorithmSearch() {
         //}
 
         // Generate offsprings
+        size_t new_size = 0;
         for (int i=0; i < (numConformers-elites)/2; i++) { // No survivors now
 
+            // Large populations take a long time for each generation
+            if (checkInterrupt())
+                return;
+
             // Select parents; allow self-mating
-            int r1 = selection_probability(rng_);
-            int r2 = selection_probability(rng_);
-            vector<double> parent1 = population[r1].second;
-            vector<double> parent2 = population[r2].second;
+            const double *parent1 = &genes[ranking[selection_probability(rng_)] * num_rotors];
+            const double *parent2 = &genes[ranking[selection_probability(rng_)] * num_rotors];
 
             // Set the offsprings to be equal to the parents and then perform mating and mutation
-            vector<vector<double>> offspring = {parent1, parent2};
+            double *offspring[2] = {&new_genes[new_size * num_rotors], &new_genes[(new_size + 1) * num_rotors]};
+            copy(parent1, parent1 + num_rotors, offspring[0]);
+            copy(parent2, parent2 + num_rotors, offspring[1]);
 
             // Crossover
             // Get a random number
@@ -220,7 +675,7 @@ void ConformationSearch::GeneticAlgorithmSearch() {
             if (v < crossover_rate) {
                 // Exchange one dihedral angle for each offspring
                 // Maybe a different choice for the mating procedure is preferred
-                int index = selection(rng_)%offspring[0].size();
+                int index = selection(rng_)%num_rotors;
                 offspring[0][index] = parent2[index];
                 offspring[1][index] = parent1[index];
             }
@@ -231,8 +686,8 @@ void ConformationSearch::GeneticAlgorithmSearch() {
             if (v < mutation_rate) {
                 // Select a random dihedral angle and change it
                 // Maybe a different choice for the mutation procedure is preferred 
-                int index1 = selection(rng_)%offspring[0].size();
-                int index2 = selection(rng_)%offspring[1].size();
+                int index1 = selection(rng_)%num_rotors;
+                int index2 = selection(rng_)%num_rotors;
                 offspring[0][index1] = dist(rng_);
                 offspring[1][index2] = dist(rng_);
             }
@@ -240,37 +695,45 @@ void ConformationSearch::GeneticAlgorithmSearch() {
             // Compute fitness (inverse distance) and see if the two offsprings are good candidates
             for (int kid=0; kid< 2; kid++) {
                 save_index++;
-                // Set the coordinates to the new angles
-                for (int j=0; j < offspring[kid].size(); j++) {
-                    auto r = rotor_vector[j];
-                    r->SetToAngle(coords, offspring[kid][j]);
+
+                // Compute fitness using only the head and tail atoms
+                for (size_t j=0; j < num_rotors; j++)
+                    setAngle(angles, j, offspring[kid][j]);
+                double cur_dist = measureDistance(angles);
+
+                // Close the gap of the near misses, and pass the refined dihedral angles to the next generation
+                double screen_dist = cur_dist;
+                cur_dist = refineClosure(angles, cur_dist);
+                if (cur_dist != screen_dist) {
+                    for (size_t j=0; j < num_rotors; j++)
+                        offspring[kid][j] = remainder(angles[j], 2 * M_PI);
                 }
 
-                // Compute fitness
-                double cur_dist = measureDistance(coords, head, tail);
-                new_generation.push_back(make_pair(1.0/cur_dist, offspring[kid]));
+                // Set the coordinates to the new angles for the candidates that pass the screening
+                if (cur_dist < runtime_params_.max_distance + DISTANCE_SCREEN_TOLERANCE) {
+                    setAngles(angles);
+                    cur_dist = measureDistance(coords, head, tail);
+                }
+                new_fitness[new_size++] = 1.0/cur_dist;
 
                 // if accept, add to vector of coord_vec_
                 if (cur_dist < runtime_params_.max_distance) {
                     // Do not process previously explored structures
                     // We cannot prevent getting identical structures. But we do not need to compute energies for it
                     // or save it again
-                    if (find(save_cur_dist.begin(), save_cur_dist.end(), int(cur_dist*1e6)) != save_cur_dist.end())
+                    if (!save_cur_dist.insert(int(cur_dist*1e6)).second)
                         continue;
-                    save_cur_dist.push_back(int(cur_dist*1e6));
 
                     // Generate chain and compute energies; check whether energies are less than thresholds
                     auto data = chain.generateConformerData(coords, helical_params_, runtime_params_.energy_filter);
 
                     if (data.accepted) {
                         // Save the candidate
-                        data.monomer_coord = new double[monomer_num_coords_];
                         data.index = save_index;
                         data.distance = cur_dist;
-                        memcpy(data.monomer_coord, coords, sizeof(double) * monomer_num_coords_);
+                        data.monomer_coord.assign(coords, coords + monomer_num_coords_);
                         reportData(data);
-                        delete[] data.monomer_coord;
-                        if (number_of_candidates == runtime_params_.num_candidates)
+                        if (*number_of_candidates >= runtime_params_.num_candidates)
                             return;
                     }
                 }
@@ -278,7 +741,9 @@ void ConformationSearch::GeneticAlgorithmSearch() {
         }
 
         // Set the population to the new generation
-        population = new_generation;
+        swap(fitness, new_fitness);
+        swap(genes, new_genes);
+        population_size = new_size;
 
     }
 
@@ -286,16 +751,67 @@ void ConformationSearch::GeneticAlgorithmSearch() {
 
 }
 
-void ConformationSearch::RandomSearch(bool weighted) {
-    // Random search: weighted or uniform probability distribution
+/**
+* @brief Computes the dihedral angle of a rotor as OpenBabel::OBRotor::CalcTorsion does, without clamping the cosine
+*
+* @param r The rotor
+* @param c The coordinates
+*
+* @returns The dihedral angle in radians, between -pi and pi
+*/
+static double exactTorsion(OBRotor *r, const double *c) {
+    vector<int> v = r->GetDihedralAtoms();
+    vector3 p[4];
+    for (int j=0; j < 4; j++) {
+        auto index = 3 * (v[j] - 1);
+        p[j] = vector3(c[index], c[index + 1], c[index + 2]);
+    }
+    vector3 v2 = p[1] - p[2];
+    vector3 c1 = cross(p[0] - p[1], v2), c2 = cross(v2, p[2] - p[3]), c3 = cross(c1, c2);
+    double angle = atan2(c3.length(), dot(c1, c2));
+    return dot(v2, c3) > 0.0 ? -angle : angle;
+}
+
+/**
+* @brief Maps a number between 0 and 1 through the inverse of the cumulative distribution function of a piecewise linear distribution
+*
+* @param d The distribution
+* @param u The number between 0 and 1
+*
+* @returns The value whose cumulative probability is u
+*/
+static double inverseCDF(const piecewise_linear_distribution<double> &d, double u) {
+    auto x = d.intervals();
+    auto p = d.densities();
+    for (size_t k=0; k + 1 < x.size(); k++) {
+        double width = x[k + 1] - x[k], area = (p[k] + p[k + 1]) / 2 * width;
+        if (u >= area && k + 2 < x.size()) {
+            u -= area;
+            continue;
+        }
+        // The density is linear in the interval, so the cumulative probability is quadratic in the distance t from its start:
+        // p t + slope t^2 / 2 = u. Use the root that does not lose precision for small slopes
+        double slope = (p[k + 1] - p[k]) / width;
+        double denominator = p[k] + sqrt(max(p[k] * p[k] + 2 * slope * u, 0.0));
+        double t = denominator > 0 ? 2 * u / denominator : 0.0;
+        return x[k] + min(max(t, 0.0), width);
+    }
+    return x.back();
+}
+
+void ConformationSearch::RandomSearch(bool weighted, bool quasi_random) {
+    // Random search: weighted or uniform probability distribution, drawn from random or quasi-random numbers
 
     // Setup chain
     Chain chain(bases_, backbone_, runtime_params_.strand, runtime_params_.ff_type, backbone_range_,
                 runtime_params_.is_hexad, runtime_params_.build_strand, runtime_params_.strand_orientation,
-                runtime_params_.glycosidic_bond_distance);
+                runtime_params_.glycosidic_bond_distance,
+                runtime_params_.energy_mode, runtime_params_.nonbonded_cutoff);
 
     // Set the search size;
     size_t search_size = runtime_params_.num_steps;
+    // The steps searched by this thread
+    auto range = threadRange(search_size);
 
     // Inititalize two different probability distibutions
     // We will choose based on whether we want weighted or unweighted search
@@ -313,36 +829,200 @@ void ConformationSearch::RandomSearch(bool weighted) {
         dist = uniform_real_distribution<double>(0, 2 * M_PI);
     }
 
+    // The quasi-random points are the points of a scrambled Halton sequence. The point of each step only depends on the seed,
+    // so that the searches give the same structures on any number of threads
+    unique_ptr<HaltonSequence> halton;
+    vector<double> point;
+    if (quasi_random)
+        halton.reset(new HaltonSequence(rotor_vector.size(), runtime_params_.seed));
+
+    // The dihedral angles of the rotors. WeightedDistributions rotates the rotors in the coordinates,
+    // so start from the dihedral angles that it leaves
+    vector<double> angles;
+    for (auto r: rotor_vector)
+        angles.push_back(exactTorsion(r, coords));
+
     // Loop over the number of iterations
-    for (size_t search_index = 0; search_index < search_size; ++search_index) {
+    for (size_t search_index = range[0]; search_index < range[1]; ++search_index) {
 
-        if (PyErr_CheckSignals() != 0) {
-            py::error_already_set();
+        if (checkInterrupt())
             return;
-        }
 
         // print progress roughly every 10%
-        if (fmod(search_index, search_size/10) == 0 && verbose_) {
-            printProgress(search_index, search_size);
+        if (fmod(search_index - range[0], (range[1] - range[0])/10) == 0 && verbose_) {
+            printProgress(search_index - range[0], range[1] - range[0]);
         }
 
+        if (quasi_random)
+            halton->point(search_index, point);
+
         // For random search, we rotate all dihedrals at every step 
         for (int i = 0; i < rotor_vector.size(); i++) {
-            // pick the rotor
-            auto r = rotor_vector[i];
-            double angle;
             // Choose a random angle
-            if (weighted) {
+            double angle;
+            if (quasi_random) {
+                // Map the coordinate of the point through the inverse of the cumulative distribution
+                angle = weighted ? inverseCDF(dist_vector[i], point[i]) : 2 * M_PI * point[i];
+            }
+            else if (weighted) {
                 angle = dist_vector[i](rng_);
             }
             else {
                 angle = dist(rng_);
             }
-            // Set new angle
-            r->SetToAngle(coords, angle);
+            setAngle(angles, i, angle);
+        }
+
+        // Screen the distance using only the head and tail atoms, after closing the gap of the near misses
+        double screen_dist = refineClosure(angles, measureDistance(angles));
+        if (screen_dist >= runtime_params_.max_distance + DISTANCE_SCREEN_TOLERANCE)
+            continue;
+
+        // Set new angles and measure distance
+        setAngles(angles);
+        double cur_dist = measureDistance(coords, head, tail);
+
+        // if accept, add to vector of coord_vec_
+        if (cur_dist < runtime_params_.max_distance) {
+
+            // Generate chain and compute energies; check whether energies are less than thresholds
+            auto data = chain.generateConformerData(coords, helical_params_, runtime_params_.energy_filter);
+
+            if (data.accepted) {
+                // Save the candidate
+                data.index = search_index;
+                data.distance = cur_dist;
+                data.monomer_coord.assign(coords, coords + monomer_num_coords_);
+                reportData(data);
+                if (*number_of_candidates >= runtime_params_.num_candidates)
+                    return;
+            }
+        }
+    }
+
+    return;
+}
+
+void ConformationSearch::AdaptiveSamplingSearch(bool weighted) {
+    // Adaptive sampling search: random search whose distributions are refitted to the lowest distances (cross-entropy method)
+
+    // Setup chain
+    Chain chain(bases_, backbone_, runtime_params_.strand, runtime_params_.ff_type, backbone_range_,
+                runtime_params_.is_hexad, runtime_params_.build_strand, runtime_params_.strand_orientation,
+                runtime_params_.glycosidic_bond_distance,
+                runtime_params_.energy_mode, runtime_params_.nonbonded_cutoff);
+
+    // Set the search size; each thread adapts its own distributions over its steps
+    size_t search_size = runtime_params_.num_steps;
+    auto range = threadRange(search_size);
+
+    // The initial distributions are given at the borders of 5 degrees intervals, like the weighted distributions
+    vector<vector<double>> intervals_vector, weights_vector;
+    if (weighted) {
+        for (auto &d: WeightedDistributions()) {
+            intervals_vector.push_back(d.intervals());
+            weights_vector.push_back(d.densities());
+        }
+    }
+    else {
+        double step = 5.0*M_PI/180.0;
+        vector<double> intervals;
+        for (int i=0; i < int(2*M_PI/step)+1; i++)
+            intervals.push_back(i * step);
+        intervals_vector.assign(rotor_vector.size(), intervals);
+        weights_vector.assign(rotor_vector.size(), vector<double>(intervals.size(), 1.0));
+    }
+    vector <std::piecewise_linear_distribution<double>> dist_vector;
+    for (size_t i=0; i < rotor_vector.size(); i++)
+        dist_vector.emplace_back(intervals_vector[i].begin(), intervals_vector[i].end(), weights_vector[i].begin());
+
+    // The dihedral angles of the rotors. WeightedDistributions rotates the rotors in the coordinates,
+    // so start from the dihedral angles that it leaves
+    vector<double> angles;
+    for (auto r: rotor_vector)
+        angles.push_back(exactTorsion(r, coords));
+
+    // The samples with the lowest distances seen so far (the elite samples), and the samples of the current batch.
+    // Each sample is stored as the distance followed by the dihedral angles
+    size_t interval = max(1u, runtime_params_.adaptation_interval);
+    size_t num_elite = max<size_t>(1, static_cast<size_t>(runtime_params_.elite_fraction * interval));
+    size_t sample_size = rotor_vector.size() + 1;
+    vector<double> samples;
+    samples.reserve((num_elite + interval) * sample_size);
+    vector<size_t> order;
+    vector<double> elite;
+
+    // Loop over the number of iterations
+    for (size_t search_index = range[0]; search_index < range[1]; ++search_index) {
+
+        if (checkInterrupt())
+            return;
+
+        // print progress roughly every 10%
+        if (fmod(search_index - range[0], (range[1] - range[0])/10) == 0 && verbose_) {
+            printProgress(search_index - range[0], range[1] - range[0]);
+        }
+
+        // Refit the distributions to the elite samples at the end of each batch
+        if (search_index > range[0] && (search_index - range[0]) % interval == 0) {
+            // Keep the samples with the lowest distances
+            size_t num_samples = samples.size() / sample_size;
+            order.resize(num_samples);
+            iota(order.begin(), order.end(), 0);
+            size_t n = min(num_elite, num_samples);
+            partial_sort(order.begin(), order.begin() + n, order.end(),
+                         [&](size_t a, size_t b) { return samples[a * sample_size] < samples[b * sample_size]; });
+            elite.clear();
+            for (size_t j=0; j < n; j++)
+                elite.insert(elite.end(), samples.begin() + order[j] * sample_size, samples.begin() + (order[j] + 1) * sample_size);
+            samples.swap(elite);
+
+            for (size_t i=0; i < rotor_vector.size(); i++) {
+                // Spread each elite dihedral angle over the borders of its interval by linear interpolation
+                auto &intervals = intervals_vector[i];
+                double step = intervals[1] - intervals[0];
+                vector<double> elite_weights(intervals.size(), 0.0);
+                for (size_t j=0; j < n; j++) {
+                    double x = samples[j * sample_size + i + 1] / step;
+                    size_t k = min(static_cast<size_t>(x), intervals.size() - 2);
+                    double frac = min(1.0, x - k);
+                    elite_weights[k] += 1.0 - frac;
+                    elite_weights[k + 1] += frac;
+                }
+                // 0 and 360 degrees are the same dihedral angle
+                elite_weights.front() = elite_weights.back() = elite_weights.front() + elite_weights.back();
+
+                // Move the weights toward the normalized elite weights. A small uniform floor keeps every dihedral angle reachable
+                auto &weights = weights_vector[i];
+                double sum = accumulate(weights.begin(), weights.end(), 0.0);
+                double elite_sum = accumulate(elite_weights.begin(), elite_weights.end(), 0.0);
+                double floor = ADAPTIVE_SAMPLING_FLOOR / elite_weights.size();
+                for (size_t k=0; k < weights.size(); k++) {
+                    double target = (1.0 - ADAPTIVE_SAMPLING_FLOOR) * elite_weights[k] / elite_sum + floor;
+                    weights[k] = (1.0 - runtime_params_.adaptation_rate) * weights[k] / sum + runtime_params_.adaptation_rate * target;
+                }
+                dist_vector[i] = piecewise_linear_distribution<double>(intervals.begin(), intervals.end(), weights.begin());
+            }
+        }
+
+        // Draw all the dihedral angles from the current distributions
+        samples.push_back(0.0);
+        for (size_t i = 0; i < rotor_vector.size(); i++) {
+            double angle = dist_vector[i](rng_);
+            samples.push_back(angle);
+            setAngle(angles, i, angle);
         }
 
-        // measure distance
+        // Screen the distance using only the head and tail atoms, and record it for the next refit
+        double screen_dist = measureDistance(angles);
+        samples[samples.size() - sample_size] = screen_dist;
+        // Close the gap of the near misses
+        screen_dist = refineClosure(angles, screen_dist);
+        if (screen_dist >= runtime_params_.max_distance + DISTANCE_SCREEN_TOLERANCE)
+            continue;
+
+        // Set new angles and measure distance
+        setAngles(angles);
         double cur_dist = measureDistance(coords, head, tail);
 
         // if accept, add to vector of coord_vec_
@@ -353,13 +1033,11 @@ void ConformationSearch::RandomSearch(bool weighted) {
 
             if (data.accepted) {
                 // Save the candidate
-                data.monomer_coord = new double[monomer_num_coords_];
                 data.index = search_index;
                 data.distance = cur_dist;
-                memcpy(data.monomer_coord, coords, sizeof(double) * monomer_num_coords_);
+                data.monomer_coord.assign(coords, coords + monomer_num_coords_);
                 reportData(data);
-                delete[] data.monomer_coord;
-                if (number_of_candidates == runtime_params_.num_candidates)
+                if (*number_of_candidates >= runtime_params_.num_candidates)
                     return;
             }
         }
@@ -368,16 +1046,142 @@ void ConformationSearch::RandomSearch(bool weighted) {
     return;
 }
 
+void ConformationSearch::KinematicClosureSearch(bool weighted) {
+    // Kinematic closure search: sample the driver dihedrals and solve the closure dihedrals
+
+    // Setup chain
+    Chain chain(bases_, backbone_, runtime_params_.strand, runtime_params_.ff_type, backbone_range_,
+                runtime_params_.is_hexad, runtime_params_.build_strand, runtime_params_.strand_orientation,
+                runtime_params_.glycosidic_bond_distance,
+                runtime_params_.energy_mode, runtime_params_.nonbonded_cutoff);
+
+    // Set the search size
+    size_t search_size = runtime_params_.num_steps;
+    auto range = threadRange(search_size);
+
+    // Get probability distribution
+    uniform_real_distribution<double> dist(0, 2 * M_PI);
+    vector <std::piecewise_linear_distribution<double>> dist_vector;
+    if (weighted)
+        dist_vector = WeightedDistributions();
+    auto draw = [&](unsigned i) { return weighted ? dist_vector[i](rng_) : dist(rng_); };
+
+    // The closure rotors are the last three rotors that move the head or the tail atoms. The other rotors are the driver rotors
+    vector<bool> is_closure(rotor_vector.size(), false);
+    vector<unsigned> closure_rotors;
+    for (unsigned i=rotor_vector.size(); i-- > 0 && closure_rotors.size() < 3;) {
+        for (auto &rotors: linker_rotors_) {
+            if (find(rotors.begin(), rotors.end(), i) != rotors.end() && !is_closure[i]) {
+                is_closure[i] = true;
+                closure_rotors.insert(closure_rotors.begin(), i);
+            }
+        }
+    }
+
+    // The dihedral angles of the rotors. WeightedDistributions rotates the rotors in the coordinates,
+    // so start from the dihedral angles that it leaves
+    vector<double> angles;
+    for (auto r: rotor_vector)
+        angles.push_back(exactTorsion(r, coords));
+
+    // The closures found for the current driver dihedral angles
+    size_t attempts = max(1u, runtime_params_.closure_attempts);
+    vector<vector<double>> closures;
+
+    // Loop over the number of iterations
+    for (size_t search_index = range[0]; search_index < range[1]; ++search_index) {
+
+        if (checkInterrupt())
+            return;
+
+        // print progress roughly every 10%
+        if (fmod(search_index - range[0], (range[1] - range[0])/10) == 0 && verbose_) {
+            printProgress(search_index - range[0], range[1] - range[0]);
+        }
+
+        // Set the driver dihedral angles to random values
+        for (unsigned i = 0; i < rotor_vector.size(); i++) {
+            if (!is_closure[i])
+                setAngle(angles, i, draw(i));
+        }
+
+        // Solve the closure dihedral angles from several random starting points
+        closures.clear();
+        for (size_t attempt=0; attempt < attempts; attempt++) {
+            for (auto i: closure_rotors)
+                setAngle(angles, i, draw(i));
+
+            // Descend to the threshold by cyclic coordinate descent over the closure rotors, then close the gap exactly
+            double cur_dist = measureDistance(angles);
+            for (unsigned iteration=0; iteration < runtime_params_.refinement_iterations && cur_dist >= runtime_params_.max_distance; iteration++) {
+                for (auto i: closure_rotors)
+                    cur_dist = minimizeGap(angles, i);
+            }
+            if (cur_dist >= runtime_params_.max_distance)
+                continue;
+            cur_dist = solveClosure(angles, closure_rotors, cur_dist);
+
+            // Different starting points often converge to the same closure
+            bool found = any_of(closures.begin(), closures.end(), [&](const vector<double> &closure) {
+                return all_of(closure_rotors.begin(), closure_rotors.end(), [&](unsigned i) {
+                    return fabs(remainder(closure[i] - angles[i], 2 * M_PI)) < CLOSURE_DUPLICATE_ANGLE;
+                });
+            });
+            if (found)
+                continue;
+            closures.push_back(angles);
+
+            // Set the angles and measure distance
+            setAngles(angles);
+            cur_dist = measureDistance(coords, head, tail);
+
+            // if accept, add to vector of coord_vec_
+            if (cur_dist < runtime_params_.max_distance) {
+
+                // Generate chain and compute energies; check whether energies are less than thresholds
+                auto data = chain.generateConformerData(coords, helical_params_, runtime_params_.energy_filter);
+
+                if (data.accepted) {
+                    // Save the candidate
+                    data.index = search_index * attempts + attempt;
+                    data.distance = cur_dist;
+                    data.monomer_coord.assign(coords, coords + monomer_num_coords_);
+                    reportData(data);
+                    if (*number_of_candidates >= runtime_params_.num_candidates)
+                        return;
+                }
+            }
+        }
+    }
+
+    return;
+}
+
 void ConformationSearch::MonteCarloSearch(bool weighted) {
     // Monte Carlo search: weighted or uniform probability distribution
 
+    // Once this replica stops, the other replicas continue to exchange their states without it
+    struct LeaveReplicaExchange {
+        shared_ptr<ReplicaExchange> replica_exchange;
+        unsigned replica;
+        ~LeaveReplicaExchange() {
+            if (replica_exchange)
+                replica_exchange->leave(replica);
+        }
+    } leave_replica_exchange{replica_exchange_, thread_index_};
+
     // Setup chain
     Chain chain(bases_, backbone_, runtime_params_.strand, runtime_params_.ff_type, backbone_range_,
                 runtime_params_.is_hexad, runtime_params_.build_strand, runtime_params_.strand_orientation,
-                runtime_params_.glycosidic_bond_distance);
+                runtime_params_.glycosidic_bond_distance,
+                runtime_params_.energy_mode, runtime_params_.nonbonded_cutoff);
 
     // Set the search size;
     size_t search_size = runtime_params_.num_steps;
+    // The steps searched by this thread. Each replica runs all the steps
+    auto range = replica_exchange_ ? array<size_t, 2>{0, search_size} : threadRange(search_size);
+    // The index used to name the candidates
+    size_t save_offset = replica_exchange_ ? thread_index_ * search_size : 0;
 
     // Inititalize two different probability distibutions
     // We will choose based on whether we want weighted or unweighted search
@@ -404,83 +1208,117 @@ void ConformationSearch::MonteCarloSearch(bool weighted) {
                     // V(bond) = Kb(b-b0)^2
                     // This is a rough value to get us close to the accepted distance
     double kT = runtime_params_.monte_carlo_temperature * BOLTZMANN; // kbT in kcal/mol
+    // Each replica has its own temperature
+    if (replica_exchange_)
+        kT = 1.0 / replica_exchange_->beta(thread_index_);
 
     // Set the initial distance to infinity
     double best_dist = std::numeric_limits<double>::infinity();
 
+    // The current dihedral angles of the rotors. WeightedDistributions rotates the rotors in the coordinates,
+    // so start from the dihedral angles that it leaves
+    vector<double> angles;
+    for (auto r: rotor_vector)
+        angles.push_back(exactTorsion(r, coords));
+
+    // The number of dihedrals rotated at every step
+    size_t n_rotations = min<size_t>(max(1u, runtime_params_.num_rotations), rotor_vector.size());
+    // Local moves perturb the dihedral angles by small steps instead of drawing them from the whole range.
+    // The step size adapts to reach the target acceptance rate
+    if (runtime_params_.proposal_mode != "global" && runtime_params_.proposal_mode != "local")
+        throw std::runtime_error(runtime_params_.proposal_mode + " is unrecognized proposal mode");
+    bool local = runtime_params_.proposal_mode == "local";
+    normal_distribution<double> step_dist(0, 1);
+    double step_size = runtime_params_.proposal_step * M_PI / 180.0;
+
+    // The indices of the rotors and the previous angles of the rotated rotors
+    vector<int> indices(rotor_vector.size());
+    iota(indices.begin(), indices.end(), 0);
+    vector<double> old_angles(n_rotations);
+
     // Loop over the number of iterations
-    for (size_t search_index = 0; search_index < search_size; ++search_index) {
+    for (size_t search_index = range[0]; search_index < range[1]; ++search_index) {
 
-        if (PyErr_CheckSignals() != 0) {
-            py::error_already_set();
+        if (checkInterrupt())
             return;
-        }
 
         // print progress roughly every 10%
-        if (fmod(search_index, search_size/10) == 0 && verbose_) {
-            printProgress(search_index, search_size);
+        if (fmod(search_index - range[0], (range[1] - range[0])/10) == 0 && verbose_) {
+            printProgress(search_index - range[0], range[1] - range[0]);
         }
 
-        // In Monte Carlo search, we randomly pick two dihedrals and rotate them
-        int n_rotations = 2;
-        // Store the indices of the rotors
-        vector<int> indices;
-        for (int i=0; i < rotor_vector.size(); i++)
-            indices.push_back(i); 
+        // Exchange the states of the replicas. The energy of a state is that of a bond stretched to the distance
+        if (replica_exchange_ && runtime_params_.exchange_interval > 0 && search_index > 0 &&
+            search_index % runtime_params_.exchange_interval == 0) {
+            double energy = k * best_dist * best_dist;
+            replica_exchange_->exchange(thread_index_, angles, best_dist, energy);
+        }
 
-        // Randomly choose two indices
-        shuffle(indices.begin(), indices.end(), rng_);
-        vector<int> rotated_indices = {indices[0], indices[1]};
+        // In Monte Carlo search, we randomly pick a few dihedrals and rotate them
+        if (local) {
+            // Pick the dihedrals by shuffling only the first indices
+            for (size_t i=0; i < n_rotations; i++)
+                swap(indices[i], indices[uniform_int_distribution<size_t>(i, indices.size() - 1)(rng_)]);
+        }
+        else {
+            // Shuffle all the indices in order; this keeps the steps of a given seed unchanged, see RuntimeParameters::proposal_mode
+            iota(indices.begin(), indices.end(), 0);
+            shuffle(indices.begin(), indices.end(), rng_);
+        }
 
-        // Save the old angles and the rotated indices
-        vector<double> old_angles;
-        for (int i=0; i < n_rotations; i++) {
+        for (size_t i=0; i < n_rotations; i++) {
             // Pick the index
-            int index = rotated_indices[i];
+            int index = indices[i];
             
-            // Get the rotor
-            auto r = rotor_vector[index];
-
             // Save previous angle, in case the step is not good
-            double old_angle = r->CalcTorsion(coords);
-            old_angles.push_back(old_angle);
+            old_angles[i] = measureAngle(angles[index]);
 
             // Choose a random angle
             double angle;
-            if (weighted) {
+            if (local) {
+                angle = remainder(angles[index] + step_size * step_dist(rng_), 2 * M_PI);
+            }
+            else if (weighted) {
                 angle = dist_vector[index](rng_);
             }
             else {
                 angle = dist(rng_);
             }
-            // Set new angle
-            r->SetToAngle(coords, angle);
+            setAngle(angles, index, angle);
         }
-        // measure distance
-        double cur_dist = measureDistance(coords, head, tail);
+        // measure distance using only the head and tail atoms
+        double cur_dist = measureDistance(angles);
         // Accept step if the new distance is less than the previous distance
         // or the distance is less than 1.0 Angstroms. Minimizing the distance to 
         // zero is not the goal. Rather, it is just a trick to get us close to a 
-        // reasonable bond length
-        if (cur_dist < best_dist || cur_dist < 1.0) {
-            best_dist = cur_dist;
-        }
-
+        // reasonable bond length.
         // If the new distance is larger than the previous distance,
         // accept step conditionally
-        else if (one_zero_dist(rng_) < exp(-k*pow((cur_dist-best_dist), 2) / kT)) {
-            best_dist = cur_dist;
+        bool accepted = cur_dist < best_dist || cur_dist < 1.0 ||
+                        one_zero_dist(rng_) < exp(-k*pow((cur_dist-best_dist), 2) / kT);
+
+        // Increase the step size after an accepted step and decrease it after a rejected step,
+        // so that the acceptance rate approaches the target
+        if (local) {
+            step_size *= exp(PROPOSAL_ADAPTATION_RATE * ((accepted ? 1.0 : 0.0) - runtime_params_.target_acceptance));
+            step_size = min(step_size, M_PI);
         }
 
         // If the step is not accepted, set the dihedral angle back to the previous state
-        else {
-            for (int i=0; i < n_rotations; i++) {
-                auto r = rotor_vector[rotated_indices[i]];
-                r->SetToAngle(coords, old_angles[i]);
-            }
+        if (!accepted) {
+            for (size_t i=0; i < n_rotations; i++)
+                setAngle(angles, indices[i], old_angles[i]);
             // Go to the next iteration
             continue;
         }
+        // Close the gap of the near misses; the refined dihedral angles become the current state
+        best_dist = cur_dist = refineClosure(angles, cur_dist);
+
+        // Set the angles and measure the distance for the steps that pass the screening
+        if (cur_dist >= runtime_params_.max_distance + DISTANCE_SCREEN_TOLERANCE)
+            continue;
+        setAngles(angles);
+        cur_dist = measureDistance(coords, head, tail);
 
         // if accept, add to vector of coord_vec_
         if (cur_dist < runtime_params_.max_distance) {
@@ -490,13 +1328,11 @@ void ConformationSearch::MonteCarloSearch(bool weighted) {
 
             if (data.accepted) {
                 // Save the candidate
-                data.monomer_coord = new double[monomer_num_coords_];
-                data.index = search_index;
+                data.index = save_offset + search_index;
                 data.distance = cur_dist;
-                memcpy(data.monomer_coord, coords, sizeof(double) * monomer_num_coords_);
+                data.monomer_coord.assign(coords, coords + monomer_num_coords_);
                 reportData(data);
-                delete[] data.monomer_coord;
-                if (number_of_candidates == runtime_params_.num_candidates)
+                if (*number_of_candidates >= runtime_params_.num_candidates)
                     return;
             }
         }
@@ -506,15 +1342,199 @@ void ConformationSearch::MonteCarloSearch(bool weighted) {
 }
 
 
+/**
+* @brief The weighted distributions of the dihedral angles of a nucleotide
+*/
+struct WeightedDistributionsEntry {
+    vector<vector<double>> intervals, //!< @brief The borders of the intervals of each distribution
+                           weights; //!< @brief The probabilities at the borders of the intervals of each distribution
+    vector<double> coords; //!< @brief The coordinates of the nucleotide after computing the distributions
+};
+
+/**
+* @brief Returns the weighted distributions computed in this process, keyed by weightedDistributionsKey
+*/
+static map<string, WeightedDistributionsEntry> &weightedDistributionsCache() {
+    static map<string, WeightedDistributionsEntry> cache;
+    return cache;
+}
+
+/**
+* @brief Returns the mutex that protects weightedDistributionsCache
+*/
+static mutex &weightedDistributionsMutex() {
+    static mutex cache_mutex;
+    return cache_mutex;
+}
+
+/**
+* @brief Describes everything the weighted distributions depend on in a single line
+*
+* The nucleotide is described by the elements, the coordinates, and the bonds of its atoms, which depend on the backbone and the
+* nucleobase, and the rotors by their dihedral atoms, which depend on the fixed bonds.
+*
+* @param mol The nucleotide
+* @param rotors The rotors
+* @param ff_type The force field
+* @param temperature The weighting temperature
+*
+* @returns The key of the distributions
+*/
+static string weightedDistributionsKey(OBMol &mol, const vector<OBRotor *> &rotors, const string &ff_type, double temperature) {
+    ostringstream key;
+    key << setprecision(17) << ff_type << " " << temperature << " atoms";
+    FOR_ATOMS_OF_MOL(a, mol)
+        key << " " << a->GetAtomicNum() << " " << a->GetX() << " " << a->GetY() << " " << a->GetZ();
+    key << " bonds";
+    FOR_BONDS_OF_MOL(b, mol)
+        key << " " << b->GetBeginAtomIdx() << " " << b->GetEndAtomIdx() << " " << b->GetBondOrder();
+    key << " rotors";
+    for (auto r: rotors) {
+        for (auto i: r->GetDihedralAtoms())
+            key << " " << i;
+    }
+    return key.str();
+}
+
+/**
+* @brief Reads the weighted distributions saved by writeWeightedDistributions
+*
+* @param path The path of the file
+* @param key The key of the distributions, which must match the key saved in the file
+* @param entry The distributions; modified in place
+*
+* @returns Whether the distributions were read
+*/
+static bool readWeightedDistributions(const string &path, const string &key, WeightedDistributionsEntry &entry) {
+    ifstream f(path);
+    string line;
+    if (!getline(f, line) || line != key)
+        return false;
+
+    size_t num_rotors, size;
+    f >> num_rotors;
+    entry.intervals.assign(num_rotors, {});
+    entry.weights.assign(num_rotors, {});
+    for (size_t i=0; i < num_rotors && f >> size; i++) {
+        entry.intervals[i].resize(size);
+        entry.weights[i].resize(size);
+        for (auto &v: entry.intervals[i])
+            f >> v;
+        for (auto &v: entry.weights[i])
+            f >> v;
+    }
+    f >> size;
+    entry.coords.resize(size);
+    for (auto &v: entry.coords)
+        f >> v;
+
+    return !f.fail();
+}
+
+/**
+* @brief Saves the weighted distributions to a file, so that other processes can read them with readWeightedDistributions
+*
+* The file is written under a temporary name and then renamed, so that other processes never read a partial file.
+* Errors are ignored, as the distributions can always be computed again.
+*
+* @param path The path of the file
+* @param key The key of the distributions
+* @param entry The distributions
+*/
+static void writeWeightedDistributions(const string &path, const string &key, const WeightedDistributionsEntry &entry) {
+    string tmp_path = path + "." + to_string(random_device()()) + ".tmp";
+    {
+        ofstream f(tmp_path);
+        f << setprecision(17) << key << "\n" << entry.intervals.size() << "\n";
+        for (size_t i=0; i < entry.intervals.size(); i++) {
+            f << entry.intervals[i].size();
+            for (auto v: entry.intervals[i])
+                f << " " << v;
+            for (auto v: entry.weights[i])
+                f << " " << v;
+            f << "\n";
+        }
+        f << entry.coords.size();
+        for (auto v: entry.coords)
+            f << " " << v;
+        f << "\n";
+        if (!f)
+            return;
+    }
+    if (rename(tmp_path.c_str(), path.c_str()) != 0)
+        remove(tmp_path.c_str());
+}
+
 std::vector <std::piecewise_linear_distribution<double>> ConformationSearch::WeightedDistributions() {
     // Compute the weighted distributions bases on the energies of the dihedral angles
 
-    // A vector to store the weighted distribution for each dihedral
+    // The distributions only depend on the nucleotide, the force field, and the temperature.
+    // Reuse the distributions computed before in this process or saved in the cache directory by other processes
+    string key = weightedDistributionsKey(bu_a_mol, rotor_vector, runtime_params_.ff_type, runtime_params_.weighting_temperature);
+    // Name the file by the FNV-1a hash of the key
+    uint64_t hash = 14695981039346656037ull;
+    for (unsigned char c: key)
+        hash = (hash ^ c) * 1099511628211ull;
+    ostringstream path;
+    path << runtime_params_.weights_cache << "/weights_" << hex << setw(16) << setfill('0') << hash << ".txt";
+
+    WeightedDistributionsEntry entry;
+    bool found = false, saved = runtime_params_.weights_cache.empty();
+    {
+        lock_guard<mutex> lock(weightedDistributionsMutex());
+        auto it = weightedDistributionsCache().find(key);
+        if (it != weightedDistributionsCache().end()) {
+            entry = it->second;
+            found = true;
+        }
+    }
+    if (!saved) {
+        if (found)
+            saved = ifstream(path.str()).good();
+        else
+            found = saved = readWeightedDistributions(path.str(), key, entry) &&
+                            entry.intervals.size() == rotor_vector.size() && entry.coords.size() == monomer_num_coords_;
+    }
+
+    if (found) {
+        // Leave the coordinates as computing the distributions does
+        copy(entry.coords.begin(), entry.coords.end(), coords);
+    }
+    else {
+        computeWeightedDistributions(entry.intervals, entry.weights);
+        entry.coords.assign(coords, coords + monomer_num_coords_);
+    }
+
+    {
+        lock_guard<mutex> lock(weightedDistributionsMutex());
+        weightedDistributionsCache()[key] = entry;
+        // Save the distributions for the other processes if the cache directory does not have them yet
+        if (!saved)
+            writeWeightedDistributions(path.str(), key, entry);
+    }
+
+    // Generate the distribution. Intervals are weighted based on the Boltzmann ratio.
+    // Probabilities inside each interval are based on linear interpolation of the probabilities
+    // at the border of the interval
     vector <std::piecewise_linear_distribution<double>> dist_vector;
+    for (size_t i=0; i < entry.intervals.size(); i++)
+        dist_vector.emplace_back(entry.intervals[i].begin(), entry.intervals[i].end(), entry.weights[i].begin());
+
+    return dist_vector;
+}
+
+void ConformationSearch::computeWeightedDistributions(std::vector<std::vector<double>> &intervals_vector,
+                                                      std::vector<std::vector<double>> &weights_vector) {
+    // Compute the weighted distributions bases on the energies of the dihedral angles
+    intervals_vector.clear();
+    weights_vector.clear();
 
     // The temperatue used in weighting the dihedral angles
     double kT = runtime_params_.weighting_temperature * BOLTZMANN; // kbT in kcal/mol
 
+    // Setting up the force field is not thread-safe in openbabel
+    lock_guard<mutex> lock(openbabelMutex());
+
     // Set up rotor
     for (auto r: rotor_vector) {
         // For each dihedral angle, determine all atoms that are connected to the rotatable bond in the dihedral
@@ -581,71 +1601,137 @@ std::vector <std::piecewise_linear_distribution<double>> ConformationSearch::Wei
         for (auto f: factors) {
             weights.push_back(f/sum);
         }
-        
-        // Generate the distribution. Intervals are weighted based on the Boltzmann ratio.
-        // Probabilities inside each interval are based on linear interpolation of the probabilities
-        // at the border of the interval
-        std::piecewise_linear_distribution<double> dist(intervals.begin(),intervals.end(),weights.begin());
-        dist_vector.push_back(dist);
-    }
 
-    return dist_vector;
+        intervals_vector.push_back(intervals);
+        weights_vector.push_back(weights);
+    }
 }
 
 
-void ConformationSearch::SystematicSearch() {
+
+
+void ConformationSearch::SystematicSearch(bool pruned) {
     // Systematic search: Rotate each one of the dihedral angles at a given step size
 
     // Setup chain
     Chain chain(bases_, backbone_, runtime_params_.strand, runtime_params_.ff_type, backbone_range_,
                 runtime_params_.is_hexad, runtime_params_.build_strand, runtime_params_.strand_orientation,
-                runtime_params_.glycosidic_bond_distance);
+                runtime_params_.glycosidic_bond_distance,
+                runtime_params_.energy_mode, runtime_params_.nonbonded_cutoff);
 
     // Determine the step size and the number of steps
     // The number of steps is (360/dihedral_step)^(number of rotors)
     double dihedral_step = runtime_params_.dihedral_step*M_PI/180.0;
-    size_t steps_per_bond = (size_t) round(2*M_PI/dihedral_step);
-    size_t search_size = (size_t) pow(steps_per_bond, rotor_vector.size());
+    size_t steps_per_bond = max<size_t>(1, (size_t) round(2*M_PI/dihedral_step));
+    // Stop counting at the largest index, so that the number of steps does not overflow
+    // for backbones with many rotors or for small step sizes
+    size_t grid_size = 1;
+    for (size_t i=0; i < rotor_vector.size(); i++) {
+        if (grid_size > numeric_limits<size_t>::max() / steps_per_bond) {
+            grid_size = numeric_limits<size_t>::max();
+            break;
+        }
+        grid_size *= steps_per_bond;
+    }
 
-    // Set all rotors to zero to start
-    for (auto r: rotor_vector)
-        r->SetToAngle(coords, 0.0);
+    // The grid points searched in this run; used to split the search across processes
+    size_t start_index = runtime_params_.start_index;
+    size_t stop_index = runtime_params_.stop_index == 0 ? grid_size : min(runtime_params_.stop_index, grid_size);
+    if (start_index >= stop_index)
+        throw std::runtime_error("The start index of the systematic search (" + to_string(start_index) +
+                                 ") must be less than the stop index and the number of grid points (" +
+                                 to_string(stop_index) + ")");
+
+    // The grid points searched by this thread
+    auto range = threadRange(stop_index - start_index);
+    range[0] += start_index;
+    range[1] += start_index;
+
+    // The grid point of each rotor for the current step, with the first rotor changing fastest
+    vector<size_t> grid_point(rotor_vector.size());
+    size_t index = range[0];
+    for (auto &p: grid_point) {
+        p = index % steps_per_bond;
+        index /= steps_per_bond;
+    }
+
+    // The dihedral angles of the rotors. The angles only depend on the grid point, so that the searches that start
+    // in the middle of the grid give the same structures as the whole search.
+    // The last rotor is rotated once at the first grid point, so it is one step ahead
+    vector<double> angles(rotor_vector.size());
+    auto grid_angle = [&](size_t i) {
+        return (grid_point[i] + (i == rotor_vector.size() - 1 ? 1 : 0)) * dihedral_step;
+    };
+    for (size_t i=0; i < rotor_vector.size(); i++)
+        angles[i] = grid_angle(i);
+    // The refined dihedral angles of the near misses
+    vector<double> refined;
+
+    // The blocks are pruned if no grid point in them can be within the distance threshold or refined to it
+    double prune_distance = max(runtime_params_.max_distance, runtime_params_.refinement_distance) + DISTANCE_SCREEN_TOLERANCE;
 
     // Loop over the number of iterations
-    for (size_t search_index = 0; search_index < search_size; ++search_index) {
+    for (size_t search_index = range[0]; search_index < range[1]; ++search_index) {
 
-        if (PyErr_CheckSignals() != 0) {
-            py::error_already_set();
+        if (checkInterrupt())
             return;
-        }
 
         // print progress roughly every 10%
-        if (fmod(search_index, search_size/10) == 0 && verbose_) {
-            printProgress(search_index, search_size);
+        if (fmod(search_index - range[0], (range[1] - range[0])/10) == 0 && verbose_) {
+            printProgress(search_index - range[0], range[1] - range[0]);
         }
 
-        // Choose rotor to change
-        int rotor_index = 0;
-        for (int i = 1; i < rotor_vector.size(); i++){
-            size_t d = pow(steps_per_bond, i);
-            int accept = search_index%d;
-            if (accept==0) {
-                rotor_index = i;
-            }
+        // Advance the grid points like an odometer; a rotor advances when the previous rotor wraps around to zero
+        if (search_index > range[0]) {
+            size_t i = 0;
+            while (i < rotor_vector.size() - 1 && ++grid_point[i] == steps_per_bond)
+                grid_point[i++] = 0;
+            if (i == rotor_vector.size() - 1)
+                grid_point[i]++;
+            // Only the rotors up to the one that advanced change
+            for (size_t j=0; j <= i; j++)
+                angles[j] = grid_angle(j);
         }
 
-        // Set lower rotors to zero and start rotating
-        for (int i=0; i < rotor_index; i++) {
-            auto r = rotor_vector[i];
-            r->SetToAngle(coords, 0.0);
+        // Prune the grid points that only differ in the first rotors if these rotors cannot bring the
+        // head and the tail atoms within the distance threshold. The grid points are pruned only at the first
+        // grid point of such a block, when the grid points of the first rotors are all zero
+        if (pruned) {
+            size_t num_free = 0;
+            while (num_free < rotor_vector.size() - 1 && grid_point[num_free] == 0)
+                num_free++;
+            // Try the largest block first
+            for (; num_free > 0; num_free--) {
+                if (measureDistanceBound(angles, num_free) < prune_distance)
+                    continue;
+                // Skip to the last grid point of the block; the odometer advances to the next block at the next step
+                size_t block_size = 1;
+                for (size_t j=0; j < num_free; j++) {
+                    grid_point[j] = steps_per_bond - 1;
+                    block_size = block_size > numeric_limits<size_t>::max() / steps_per_bond ?
+                                 numeric_limits<size_t>::max() : block_size * steps_per_bond;
+                }
+                search_index += min(block_size - 1, range[1] - 1 - search_index);
+                break;
+            }
+            if (num_free > 0)
+                continue;
         }
 
-        // Set dihedral angle
-        auto r = rotor_vector[rotor_index];
-        double angle = r->CalcTorsion(coords) + dihedral_step;
-        r->SetToAngle(coords, angle);
+        // Screen the distance using only the head and tail atoms. Close the gap of the near misses in a copy
+        // of the dihedral angles, so that the grid does not change
+        const vector<double> *point = &angles;
+        double screen_dist = measureDistance(angles);
+        if (screen_dist >= runtime_params_.max_distance && screen_dist < runtime_params_.refinement_distance) {
+            refined = angles;
+            screen_dist = refineClosure(refined, screen_dist);
+            point = &refined;
+        }
+        if (screen_dist >= runtime_params_.max_distance + DISTANCE_SCREEN_TOLERANCE)
+            continue;
 
-        // measure distance
+        // Set the angles and measure distance
+        setAngles(*point);
         double cur_dist = measureDistance(coords, head, tail);
 
         // if accept, add to vector of coord_vec_
@@ -655,13 +1741,11 @@ void ConformationSearch::SystematicSearch() {
 
             if (data.accepted) {
                 // Save the candidate
-                data.monomer_coord = new double[monomer_num_coords_];
                 data.index = search_index;
                 data.distance = cur_dist;
-                memcpy(data.monomer_coord, coords, sizeof(double) * monomer_num_coords_);
+                data.monomer_coord.assign(coords, coords + monomer_num_coords_);
                 reportData(data);
-                delete[] data.monomer_coord;
-                if (number_of_candidates == runtime_params_.num_candidates)
+                if (*number_of_candidates >= runtime_params_.num_candidates)
                     return;
             }
         }
@@ -672,9 +1756,40 @@ void ConformationSearch::SystematicSearch() {
 
 void ConformationSearch::printProgress(std::size_t search_index, std::size_t search_size) {
     // Print progress
-    cout << prefix_ << ": ";
-    cout << 100 * static_cast<double>(search_index) / search_size;
-    cout << "%\tAccepted: " << number_of_candidates << endl;
+    ostringstream progress;
+    progress << prefix_ << ": ";
+    progress << 100 * static_cast<double>(search_index) / search_size;
+    progress << "%\tAccepted: " << *number_of_candidates;
+
+    // Reacquire the python interpreter lock to print to the python standard output
+    py::gil_scoped_acquire acquire;
+    py::print(progress.str(), py::arg("flush") = true);
+}
+
+
+bool ConformationSearch::checkInterrupt() {
+    // Stop if requested by another thread or if enough candidates are found
+    if ((stop_token_ && stop_token_->stopped()) || *stop_search_ || *number_of_candidates >= runtime_params_.num_candidates)
+        return true;
+
+    // Only the calling thread can receive keyboard interruptions
+    if (thread_index_ != 0)
+        return false;
+
+    // Reacquiring the python interpreter lock at every step is expensive,
+    // so we only check for keyboard interruption every few steps
+    if (++interrupt_check_counter_ < SIGNAL_CHECK_INTERVAL)
+        return false;
+    interrupt_check_counter_ = 0;
+
+    py::gil_scoped_acquire acquire;
+    if (PyErr_CheckSignals() != 0) {
+        py::error_already_set();
+        *stop_search_ = true;
+        return true;
+    }
+
+    return false;
 }
 
 double ConformationSearch::measureDistance(double *coords, unsigned head, unsigned tail) {
@@ -683,6 +1798,280 @@ double ConformationSearch::measureDistance(double *coords, unsigned head, unsign
     vector3 head_coord(coords[hi], coords[hi + 1], coords[hi + 2]);
     vector3 tail_coord(coords[ti], coords[ti + 1], coords[ti + 2]);
 
+    return measureDistance(head_coord, tail_coord);
+}
+
+/**
+* @brief Rotates a point about an axis using the Rodrigues rotation formula
+*
+* @param p The coordinates of the point; modified in place
+* @param axis A point on the axis followed by the unit vector of the axis
+* @param angle The rotation angle in radians
+*/
+static void rotateAboutAxis(double *p, const std::array<double, 6> &axis, double angle) {
+    double cs = cos(angle), sn = sin(angle);
+    double v[3] = {p[0] - axis[0], p[1] - axis[1], p[2] - axis[2]};
+    double dot = axis[3] * v[0] + axis[4] * v[1] + axis[5] * v[2];
+    double cross[3] = {axis[4] * v[2] - axis[5] * v[1], axis[5] * v[0] - axis[3] * v[2], axis[3] * v[1] - axis[4] * v[0]};
+    for (int j=0; j < 3; j++)
+        p[j] = axis[j] + v[j] * cs + cross[j] * sn + axis[3 + j] * dot * (1 - cs);
+}
+
+double ConformationSearch::measureAngle(double angle) {
+    angle = remainder(angle, 2 * M_PI);
+    double cosine = max(min(cos(angle), 0.9999999), -0.9999999);
+    return copysign(acos(cosine), angle);
+}
+
+void ConformationSearch::setAngle(std::vector<double> &angles, unsigned index, double angle) {
+    // Rotate by the difference from the measured angle, keeping the difference between the exact and the measured angle
+    double measured = measureAngle(angles[index]);
+    if (fabs(angle - measured) >= 1e-5)
+        angles[index] = angle + remainder(angles[index] - measured, 2 * M_PI);
+}
+
+void ConformationSearch::measureLinkers(const std::vector<double> &angles, vector3 *linker_coords) {
+    // Compute the positions of the head and the tail atoms from the dihedral angles
+    unsigned linkers[2] = {head, tail};
+    for (int k=0; k < 2; k++) {
+        auto index = 3 * (linkers[k] - 1);
+        double p[3] = {reference_coords_[index], reference_coords_[index + 1], reference_coords_[index + 2]};
+        // Rotate about the axis of each rotor, starting from the rotor farthest from the nucleobase
+        for (auto i: linker_rotors_[k])
+            rotateAboutAxis(p, rotor_axes_[i], angles[i] - reference_angles_[i]);
+        linker_coords[k] = vector3(p[0], p[1], p[2]);
+    }
+}
+
+double ConformationSearch::measureDistance(const std::vector<double> &angles) {
+    vector3 linker_coords[2];
+    measureLinkers(angles, linker_coords);
+    return measureDistance(linker_coords[0], linker_coords[1]);
+}
+
+vector3 ConformationSearch::measureGap(const std::vector<double> &angles) {
+    // The vector from the tail atom of the next nucleotide to the head atom, after the global and step transformations
+    vector3 linker_coords[2];
+    measureLinkers(angles, linker_coords);
+    for (auto &p: linker_coords) {
+        p *= glbl_rot_;
+        p += glbl_translate_;
+    }
+    linker_coords[1] *= step_rot_;
+    linker_coords[1] += step_translate_;
+    return linker_coords[0] - linker_coords[1];
+}
+
+double ConformationSearch::minimizeGap(std::vector<double> &angles, unsigned index) {
+    // Rotating the rotor by x moves the head and the tail atoms on circles, so the gap is A + B cos(x) + C sin(x).
+    // Find A, B, and C from the gaps at three rotations
+    const double third = 2 * M_PI / 3;
+    double angle = angles[index];
+    vector3 g0 = measureGap(angles);
+    angles[index] = angle + third;
+    vector3 g1 = measureGap(angles);
+    angles[index] = angle - third;
+    vector3 g2 = measureGap(angles);
+    vector3 a = (g0 + g1 + g2) / 3.0, b = g0 - a, c = (g1 - g2) / (2 * sin(third));
+
+    // Minimize the squared length of the gap over a coarse grid, then refine with Newton steps
+    auto gap_at = [&](double x) { return a + b * cos(x) + c * sin(x); };
+    double best_x = 0.0, best_sq = g0.length_2();
+    for (int j=1; j < CLOSURE_REFINEMENT_GRID; j++) {
+        double x = 2 * M_PI * j / CLOSURE_REFINEMENT_GRID;
+        double sq = gap_at(x).length_2();
+        if (sq < best_sq) {
+            best_x = x;
+            best_sq = sq;
+        }
+    }
+    for (int j=0; j < 3; j++) {
+        vector3 g = gap_at(best_x), dg = c * cos(best_x) - b * sin(best_x);
+        double first = dot(g, dg), second = dot(dg, dg) - dot(g, g - a);
+        if (second <= 0)
+            break;
+        double x = best_x - first / second, sq = gap_at(x).length_2();
+        if (sq >= best_sq)
+            break;
+        best_x = x;
+        best_sq = sq;
+    }
+
+    angles[index] = remainder(angle + best_x, 2 * M_PI);
+    return sqrt(best_sq);
+}
+
+double ConformationSearch::refineClosure(std::vector<double> &angles, double distance) {
+    // Only refine the near misses
+    if (distance < runtime_params_.max_distance || distance >= runtime_params_.refinement_distance)
+        return distance;
+
+    // Only the rotors that move the head or the tail atoms change the distance
+    vector<bool> moves_linker(rotor_vector.size(), false);
+    for (auto &rotors: linker_rotors_) {
+        for (auto i: rotors)
+            moves_linker[i] = true;
+    }
+
+    for (unsigned iteration=0; iteration < runtime_params_.refinement_iterations; iteration++) {
+        for (unsigned i=0; i < rotor_vector.size(); i++) {
+            if (distance < runtime_params_.max_distance)
+                return distance;
+            if (moves_linker[i])
+                distance = minimizeGap(angles, i);
+        }
+    }
+
+    return distance;
+}
+
+double ConformationSearch::solveClosure(std::vector<double> &angles, const std::vector<unsigned> &rotors, double distance) {
+    // Three rotors give as many unknowns as the components of the gap
+    if (rotors.size() != 3)
+        return distance;
+
+    for (int iteration=0; iteration < CLOSURE_NEWTON_ITERATIONS && distance > CLOSURE_TOLERANCE; iteration++) {
+        // The derivatives of the gap with respect to the dihedral angles, by finite differences
+        vector3 g = measureGap(angles), jacobian[3];
+        for (int k=0; k < 3; k++) {
+            angles[rotors[k]] += CLOSURE_DIFFERENCE_STEP;
+            jacobian[k] = (measureGap(angles) - g) / CLOSURE_DIFFERENCE_STEP;
+            angles[rotors[k]] -= CLOSURE_DIFFERENCE_STEP;
+        }
+        double det = dot(jacobian[0], cross(jacobian[1], jacobian[2]));
+        if (fabs(det) < 1e-12)
+            break;
+
+        // Solve the linear equations by Cramer's rule
+        double step[3], old_angles[3];
+        for (int k=0; k < 3; k++) {
+            step[k] = -dot(g, cross(jacobian[(k + 1) % 3], jacobian[(k + 2) % 3])) / det;
+            old_angles[k] = angles[rotors[k]];
+        }
+
+        // Halve the Newton step until it decreases the distance
+        double new_distance = distance, fraction = 1.0;
+        for (int j=0; j < CLOSURE_NEWTON_ITERATIONS; j++, fraction /= 2) {
+            for (int k=0; k < 3; k++)
+                angles[rotors[k]] = remainder(old_angles[k] + fraction * step[k], 2 * M_PI);
+            new_distance = measureGap(angles).length();
+            if (new_distance < distance)
+                break;
+        }
+        if (new_distance >= distance) {
+            for (int k=0; k < 3; k++)
+                angles[rotors[k]] = old_angles[k];
+            break;
+        }
+        distance = new_distance;
+    }
+
+    return distance;
+}
+
+double ConformationSearch::measureDistanceBound(const std::vector<double> &angles, unsigned num_free) {
+    // Compute spheres that contain all the positions of the head and the tail atoms for any angles of the free rotors
+    vector3 linker_coords[2];
+    double radius[2] = {0.0, 0.0};
+    unsigned linkers[2] = {head, tail};
+    for (int k=0; k < 2; k++) {
+        auto index = 3 * (linkers[k] - 1);
+        double p[3] = {reference_coords_[index], reference_coords_[index + 1], reference_coords_[index + 2]};
+        for (auto i: linker_rotors_[k]) {
+            auto &axis = rotor_axes_[i];
+            if (i >= num_free) {
+                // The rotation moves the center of the sphere and keeps its radius
+                rotateAboutAxis(p, axis, angles[i] - reference_angles_[i]);
+                continue;
+            }
+            // A full rotation sweeps the sphere around the axis. The new sphere is centered at the point on the axis
+            // nearest to the center and its radius grows by the distance of the center from the axis
+            double v[3] = {p[0] - axis[0], p[1] - axis[1], p[2] - axis[2]};
+            double dot = axis[3] * v[0] + axis[4] * v[1] + axis[5] * v[2];
+            double dist_sq = 0.0;
+            for (int j=0; j < 3; j++) {
+                p[j] = axis[j] + axis[3 + j] * dot;
+                dist_sq += (v[j] - axis[3 + j] * dot) * (v[j] - axis[3 + j] * dot);
+            }
+            radius[k] += sqrt(dist_sq);
+        }
+        linker_coords[k] = vector3(p[0], p[1], p[2]);
+    }
+
+    // The global and step transformations do not change the radii
+    return measureDistance(linker_coords[0], linker_coords[1]) - radius[0] - radius[1];
+}
+
+void ConformationSearch::setupLinkerRotors() {
+    // Save the current coordinates and dihedral angles as the reference
+    reference_coords_.assign(coords, coords + monomer_num_coords_);
+    reference_angles_.clear();
+    rotor_axes_.clear();
+    for (int k=0; k < 2; k++)
+        linker_rotors_[k].clear();
+
+    // The coordinate indices (three times the zero-based atom indices) of the atoms moved by a rotor
+    auto rot_atoms = [](const OBRotor *r) -> const vector<int> & { return r->GetRotAtoms(); };
+
+    unsigned linkers[2] = {head, tail};
+    for (unsigned i=0; i < rotor_vector.size(); i++) {
+        auto r = rotor_vector[i];
+        reference_angles_.push_back(exactTorsion(r, coords));
+
+        // The axis passes through the two atoms of the rotatable bond
+        vector<int> v = r->GetDihedralAtoms();
+        auto b = 3 * (v[1] - 1), c = 3 * (v[2] - 1);
+        vector3 point(coords[b], coords[b + 1], coords[b + 2]);
+        vector3 direction = vector3(coords[c], coords[c + 1], coords[c + 2]) - point;
+        direction.normalize();
+
+        array<double, 6> axis = {point.x(), point.y(), point.z(), direction.x(), direction.y(), direction.z()};
+
+        // Rotating the moving atoms clockwise or counterclockwise increases the dihedral angle
+        // depending on which side of the bond moves. Check the direction with a small rotation
+        vector<double> test(reference_coords_);
+        for (auto j: rot_atoms(r))
+            rotateAboutAxis(&test[j], axis, 0.1);
+        double change = exactTorsion(r, test.data()) - reference_angles_.back();
+        if (sin(change) < 0) {
+            for (int j=3; j < 6; j++)
+                axis[j] = -axis[j];
+        }
+        rotor_axes_.push_back(axis);
+
+        // Find whether the rotor moves the head or the tail atom
+        for (int k=0; k < 2; k++) {
+            auto &atoms = rot_atoms(r);
+            if (find(atoms.begin(), atoms.end(), static_cast<int>(3 * (linkers[k] - 1))) != atoms.end())
+                linker_rotors_[k].push_back(i);
+        }
+    }
+
+    // The rotors that move an atom are nested along the path from the nucleobase to the atom.
+    // The rotor farthest from the nucleobase moves the fewest atoms
+    for (int k=0; k < 2; k++) {
+        stable_sort(linker_rotors_[k].begin(), linker_rotors_[k].end(), [&](unsigned i, unsigned j) {
+            return rot_atoms(rotor_vector[i]).size() < rot_atoms(rotor_vector[j]).size();
+        });
+    }
+}
+
+void ConformationSearch::setAngles(const std::vector<double> &angles) {
+    // Start from the reference coordinates so that rounding errors do not accumulate over the search
+    copy(reference_coords_.begin(), reference_coords_.end(), coords);
+    for (unsigned i=0; i < rotor_vector.size(); i++) {
+        // Rotate by the difference from the exact reference angle rather than from the angle measured by SetToAngle
+        double rotation = angles[i] - reference_angles_[i];
+        if (rotation == 0.0)
+            continue;
+        auto r = rotor_vector[i];
+        double cosine = cos(rotation);
+        r->Set(coords, sin(rotation), cosine, 1 - cosine, 1 / r->CalcBondLength(coords));
+    }
+}
+
+double ConformationSearch::measureDistance(vector3 head_coord, vector3 tail_coord) {
+
     // Perform the global rotation and translation for both the head and the tail
     tail_coord *= glbl_rot_;
     tail_coord += glbl_translate_;
@@ -698,14 +2087,26 @@ double ConformationSearch::measureDistance(double *coords, unsigned head, unsign
 }
 
 void ConformationSearch::reportData(PNAB::ConformerData &conf_data) {
-    
+
+    // Reject the candidates that cannot be among the structures with the lowest total energies
+    if (best_structures_) {
+        lock_guard<mutex> lock(best_structures_->mutex);
+        auto &heap = best_structures_->heap;
+        if (heap.size() >= runtime_params_.num_best && !(conf_data.total_energy < heap.front().total_energy))
+            return;
+    }
+
     // Increase number of accepted candidates
-    number_of_candidates += 1;
+    // Skip the candidate if the other threads have already found enough candidates
+    if (++(*number_of_candidates) > runtime_params_.num_candidates)
+        return;
 
     // Setup variables for saving the structure of the accepted candidate
-    ostringstream strs;
+    ostringstream strs, pdb;
     filebuf fb;
-    stringstream output_stringstream;
+
+    // Writing the molecule is not thread-safe in openbabel
+    unique_lock<mutex> lock(openbabelMutex());
 
     // Set output format
     conv_.SetOutFormat("PDB");
@@ -716,9 +2117,11 @@ void ConformationSearch::reportData(PNAB::ConformerData &conf_data) {
     // All conformers are named prefix_ + "_" + index
     strs << prefix_ << "_" << conf_data.index << ".pdb";
 
-    // Open file for writing...
-    fb.open(strs.str().c_str(), std::ios::out);
-    ostream fileStream(&fb);
+    // Open file for writing, or write to memory if the structure is written later or by the writer thread
+    bool in_memory = best_structures_ || writer_;
+    if (!in_memory)
+        fb.open(strs.str().c_str(), std::ios::out);
+    ostream fileStream(in_memory ? static_cast<streambuf *>(pdb.rdbuf()) : &fb);
 
     // Set conformer data and save to file
     conf_data.molecule.SetTitle(strs.str().c_str());
@@ -760,7 +2163,7 @@ void ConformationSearch::reportData(PNAB::ConformerData &conf_data) {
 
     for (int i=0; i < rotor_vector.size(); i++) {
         labels.push_back("Dihedral " + to_string(i+1) + " (degrees)");
-        double angle = rotor_vector[i]->CalcTorsion(conf_data.monomer_coord) * 180.0/M_PI;
+        double angle = rotor_vector[i]->CalcTorsion(conf_data.monomer_coord.data()) * 180.0/M_PI;
         conf_data.dihedral_angles.push_back(angle);
         data.push_back(angle);
     }
@@ -776,17 +2179,49 @@ void ConformationSearch::reportData(PNAB::ConformerData &conf_data) {
     conv_.SetOutStream(&fileStream);
     conv_.Write(&conf_data.molecule);
     fb.close();
+    lock.unlock();
+
+    if (best_structures_) {
+        // Keep the structure, and drop the one with the highest total energy if there are too many
+        lock_guard<mutex> lock(best_structures_->mutex);
+        auto &heap = best_structures_->heap;
+        heap.push_back(BestStructures::Structure{conf_data.total_energy, strs.str(), pdb.str()});
+        push_heap(heap.begin(), heap.end());
+        if (heap.size() > runtime_params_.num_best) {
+            pop_heap(heap.begin(), heap.end());
+            heap.pop_back();
+        }
+        // Reject the candidates of this thread that cannot be kept before saving them
+        if (heap.size() >= runtime_params_.num_best)
+            runtime_params_.energy_filter[4] = min(runtime_params_.energy_filter[4], heap.front().total_energy);
+    }
+    else if (writer_)
+        writer_->write(strs.str(), pdb.str());
 
     // Now we store the properties of the accepted candidates
-    auto v = conf_data;
-    output_stringstream << prefix_ << ", " << v.index  << ", " << v.distance << ", " << v.bondE << ", " << v.angleE << ", "
-        << v.torsionE << ", " << v.VDWE << ", " << v.total_energy;
-    for (auto angle: v.dihedral_angles)
-        output_stringstream << ", " << angle;
-    output_stringstream << endl;
+    auto &v = conf_data;
+    size_t row = output_data.size();
+    output_data.insert(output_data.end(), {static_cast<double>(v.index), v.distance, v.bondE, v.angleE,
+                                           v.torsionE, v.VDWE, v.total_energy});
+    output_data.insert(output_data.end(), v.dihedral_angles.begin(), v.dihedral_angles.end());
 
-    // Update the output string
-    output_string += output_stringstream.str();
+    // Stream the candidate, and stop all the threads if requested
+    if (stream_ && stream_->add(&output_data[row]))
+        *stop_search_ = true;
 
     return;
 }
+
+void ConformationSearch::writeBestStructures() {
+    if (!best_structures_)
+        return;
+    for (auto &structure: best_structures_->heap) {
+        if (writer_) {
+            writer_->write(structure.file_name, structure.pdb);
+            continue;
+        }
+        ofstream file(structure.file_name);
+        file << structure.pdb;
+    }
+    best_structures_->heap.clear();
+}
@@ -5,11 +5,383 @@
 #ifndef PNAB_CONFORMATIONSEARCH_H
 #define PNAB_CONFORMATIONSEARCH_H
 
+#include <atomic>
+#include <chrono>
+#include <condition_variable>
+#include <deque>
+#include <functional>
+#include <fstream>
+#include <memory>
+#include <thread>
 #include "Chain.h"
 
 #define BOLTZMANN 0.0019872041 // kcal/(mol.K)
+#define SIGNAL_CHECK_INTERVAL 1000 // Number of steps between checks for keyboard interruption
+#define DISTANCE_SCREEN_TOLERANCE 0.01 // Angstroms; margin for the distance computed from the dihedral angles
+#define PROPOSAL_ADAPTATION_RATE 0.01 // Rate of change of the logarithm of the step size of the local Monte Carlo steps
+#define CLOSURE_REFINEMENT_GRID 36 // Number of rotations tried before the Newton steps of the closure refinement
+#define CLOSURE_NEWTON_ITERATIONS 10 // Maximum number of Newton steps that close the gap in the kinematic closure search
+#define CLOSURE_TOLERANCE 1e-6 // Angstroms; distance at which the gap is closed in the kinematic closure search
+#define CLOSURE_DIFFERENCE_STEP 1e-6 // Radians; step of the finite differences of the gap in the kinematic closure search
+#define CLOSURE_DUPLICATE_ANGLE 1e-3 // Radians; closures whose dihedral angles differ by less than this are the same closure
+#define ADAPTIVE_SAMPLING_FLOOR 0.01 // Fraction of the refitted distributions of the adaptive sampling search spread uniformly
+#define STREAM_INTERVAL 1.0 // Seconds; the accepted candidates waiting to be streamed are delivered at least this often
 
 namespace PNAB {
+    /**
+     * @brief The exchange of individuals between the islands of the genetic algorithm search
+     *
+     * The islands are arranged in a ring. At each migration, every island sends a copy of its fittest individual to the next
+     * island and waits until all the islands that are still searching have sent theirs. The individuals of each round
+     * are kept apart from those of the next round, so that the exchanges do not depend on the timing of the threads.
+     *
+     * @sa ConformationSearch::GeneticAlgorithmSearch
+     * @sa RuntimeParameters::num_islands
+     */
+    class Migration {
+
+    public:
+        /**
+         * @brief Constructor for the exchange between the islands
+         *
+         * @param num_islands The number of islands
+         */
+        explicit Migration(unsigned num_islands);
+
+        /**
+         * @brief Sends an individual to the next island and receives the individual sent by the previous island
+         *
+         * Blocks until all the islands that are still searching reach the same migration.
+         *
+         * @param island The index of the island
+         * @param genes The dihedral angles of the individual to send; replaced by those of the received individual
+         * @param fitness The fitness of the individual to send; replaced by that of the received individual
+         *
+         * @returns Whether an individual was received; the previous island may have stopped searching
+         */
+        bool exchange(unsigned island, std::vector<double> &genes, double &fitness);
+
+        /**
+         * @brief Removes an island that stopped searching, so that the other islands do not wait for it
+         */
+        void leave();
+
+    private:
+        /**
+         * @brief An individual sent by an island
+         */
+        struct Migrant {
+            std::size_t round; //!< @brief The migration in which the individual was sent
+            double fitness; //!< @brief The fitness of the individual
+            std::vector<double> genes; //!< @brief The dihedral angles of the individual
+        };
+
+        std::mutex mutex_; //!< @brief Protects the exchange
+        std::condition_variable round_done_; //!< @brief Notifies the waiting islands that all the islands reached the migration
+        std::size_t round_ = 0; //!< @brief The index of the current migration
+        unsigned arrived_ = 0, //!< @brief The number of islands that reached the current migration
+                 active_; //!< @brief The number of islands that are still searching
+        std::array<std::vector<Migrant>, 2> migrants_; //!< @brief The individuals sent by each island in the current and the previous migrations
+    };
+
+    /**
+     * @brief The exchange of the states of the replicas in the replica exchange Monte Carlo search
+     *
+     * The replicas are ordered by increasing temperature. At each exchange, every replica sends its state and waits until
+     * all the replicas that are still searching have sent theirs. The last replica to arrive then attempts to swap the states of
+     * neighboring replicas, alternating between the even and the odd pairs, with the Metropolis criterion
+     * \f$\min(1, \exp[(\beta_i - \beta_j)(E_i - E_j)])\f$. The swaps use their own random number stream,
+     * so that the exchanges do not depend on the timing of the threads.
+     *
+     * @sa ConformationSearch::MonteCarloSearch
+     * @sa RuntimeParameters::num_replicas
+     */
+    class ReplicaExchange {
+
+    public:
+        /**
+         * @brief Constructor for the exchange between the replicas
+         *
+         * @param temperatures The temperatures of the replicas in increasing order (K)
+         * @param seed The seed of the random number stream used for the swaps
+         */
+        ReplicaExchange(const std::vector<double> &temperatures, unsigned seed);
+
+        /**
+         * @brief Sends the state of a replica and receives the state assigned to it after the swaps
+         *
+         * Blocks until all the replicas that are still searching reach the same exchange.
+         *
+         * @param replica The index of the replica
+         * @param angles The dihedral angles of the state; modified in place
+         * @param distance The distance of the state; modified in place
+         * @param energy The energy of the state (kcal/mol); modified in place
+         */
+        void exchange(unsigned replica, std::vector<double> &angles, double &distance, double &energy);
+
+        /**
+         * @brief Removes a replica that stopped searching, so that the other replicas do not wait for it
+         *
+         * @param replica The index of the replica
+         */
+        void leave(unsigned replica);
+
+        /**
+         * @brief Returns the inverse temperature of a replica
+         *
+         * @param replica The index of the replica
+         *
+         * @returns \f$1/k_{B}T\f$ (mol/kcal)
+         */
+        double beta(unsigned replica) const { return replicas_[replica].beta; }
+
+    private:
+        /**
+         * @brief The state of a replica
+         */
+        struct Replica {
+            bool active; //!< @brief Whether the replica is still searching
+            double beta; //!< @brief The inverse temperature of the replica (mol/kcal)
+            std::vector<double> angles; //!< @brief The dihedral angles of the state
+            double distance, //!< @brief The distance of the state
+                   energy; //!< @brief The energy of the state
+        };
+
+        /**
+         * @brief Attempts to swap the states of the neighboring replicas and starts the next exchange
+         *
+         * Called by the last replica to arrive, with ReplicaExchange::mutex_ held.
+         */
+        void swapReplicas();
+
+        std::mutex mutex_; //!< @brief Protects the exchange
+        std::condition_variable round_done_; //!< @brief Notifies the waiting replicas that the states are swapped
+        std::size_t round_ = 0; //!< @brief The index of the current exchange
+        unsigned arrived_ = 0, //!< @brief The number of replicas that reached the current exchange
+                 active_; //!< @brief The number of replicas that are still searching
+        std::vector<Replica> replicas_; //!< @brief The replicas in increasing order of temperature
+        std::mt19937_64 rng_; //!< @brief The random number generator used for the swaps
+    };
+
+    /**
+     * @brief A scrambled Halton sequence of points in the unit hypercube
+     *
+     * Each dimension uses a different prime base. The coordinate of a point in a dimension is the radical inverse of its index in the
+     * base of the dimension: the digits of the index are mirrored about the decimal point. The digits at each position are scrambled
+     * by a random permutation, which breaks the correlations between the dimensions with large bases while keeping the points evenly spread.
+     * The permutations only depend on the seed, so the point of each index is the same on every thread.
+     *
+     * @sa ConformationSearch::RandomSearch
+     */
+    class HaltonSequence {
+
+    public:
+        /**
+         * @brief Constructor for the scrambled Halton sequence
+         *
+         * @param dimension The number of dimensions
+         * @param seed The seed of the random number stream used for the permutations
+         */
+        HaltonSequence(unsigned dimension, unsigned seed);
+
+        /**
+         * @brief Returns a point of the sequence
+         *
+         * @param index The index of the point
+         * @param point The coordinates of the point, between 0 and 1; modified in place
+         */
+        void point(std::size_t index, std::vector<double> &point) const;
+
+    private:
+        std::vector<unsigned> bases_; //!< @brief The prime base of each dimension
+        std::vector<std::vector<std::vector<unsigned>>> permutations_; //!< @brief The permutation of the digits at each position for each dimension
+    };
+
+    /**
+     * @brief The structures of the accepted candidates with the lowest total energies
+     *
+     * The structures are kept in memory in a max-heap on the total energy, and written when the search finishes.
+     * Shared by the threads searching the same helical configuration.
+     *
+     * @sa RuntimeParameters::num_best
+     */
+    struct BestStructures {
+        /**
+         * @brief The structure of an accepted candidate
+         */
+        struct Structure {
+            double total_energy; //!< @brief The total energy of the candidate (kcal/mol/nucleotide)
+            std::string file_name, //!< @brief The name of the PDB file of the candidate
+                        pdb; //!< @brief The contents of the PDB file
+            bool operator<(const Structure &other) const { return total_energy < other.total_energy; }
+        };
+
+        std::mutex mutex; //!< @brief Protects the heap
+        std::vector<Structure> heap; //!< @brief The kept structures, with the highest total energy first
+    };
+
+    /**
+     * @brief Writes the structures of the accepted candidates on a background thread
+     *
+     * The searching threads add the PDB contents of the accepted candidates to a bounded queue, and a writer thread
+     * writes them to files, so that the searches do not wait for the file system. If the queue is full, the searching
+     * threads wait until the writer thread takes a structure. Closing the writer waits until all the queued structures are written.
+     *
+     * The structures are either written to a file each, or appended as models to a single multi-model PDB file. For the
+     * multi-model file, an index file has the name, the model number, the offset, and the size in bytes of each structure,
+     * so that any structure can be read without reading the whole file.
+     *
+     * @sa RuntimeParameters::write_queue_size
+     * @sa RuntimeParameters::multi_model_file
+     */
+    class StructureWriter {
+
+    public:
+        /**
+         * @brief Constructor for the writer; starts the writer thread
+         *
+         * @param capacity The maximum number of structures waiting to be written. If zero, the structures are
+         *                 written by the calling threads, one at a time
+         * @param models_path The path of the multi-model PDB file, without the extension; "models_path.pdb" has the
+         *                    structures and "models_path.csv" has the index. If empty, each structure is written to its own file
+         */
+        explicit StructureWriter(std::size_t capacity, const std::string &models_path = "");
+
+        /**
+         * @brief Destructor for the writer; writes the queued structures and stops the writer thread
+         */
+        ~StructureWriter();
+
+        /**
+         * @brief Adds a structure to the queue
+         *
+         * Blocks while the queue is full.
+         *
+         * @param file_name The name of the file; for the multi-model file, the name of the structure in the index
+         * @param contents The contents of the file
+         */
+        void write(std::string file_name, std::string contents);
+
+        /**
+         * @brief Writes the queued structures and stops the writer thread
+         */
+        void close();
+
+    private:
+        /**
+         * @brief Writes the queued structures until the writer is closed; runs on the writer thread
+         */
+        void work();
+
+        /**
+         * @brief Writes a structure to its file, or appends it to the multi-model file and the index
+         *
+         * @param file_name The name of the file
+         * @param contents The contents of the file
+         */
+        void save(const std::string &file_name, const std::string &contents);
+
+        std::mutex mutex_; //!< @brief Protects the queue, and the files if there is no writer thread
+        std::condition_variable not_empty_, //!< @brief Notifies the writer thread that a structure is queued or that the writer is closed
+                                not_full_; //!< @brief Notifies the searching threads that a structure was taken from the queue
+        std::deque<std::pair<std::string, std::string>> queue_; //!< @brief The names and the contents of the files waiting to be written
+        std::size_t capacity_; //!< @brief The maximum number of structures waiting to be written
+        bool closed_ = false; //!< @brief Whether the writer is closed
+        std::thread thread_; //!< @brief The writer thread
+        std::ofstream models_, //!< @brief The multi-model PDB file; not open if each structure is written to its own file
+                      index_; //!< @brief The index of the multi-model PDB file
+        std::size_t num_models_ = 0, //!< @brief The number of structures in the multi-model PDB file
+                    offset_ = 0; //!< @brief The size of the multi-model PDB file in bytes
+    };
+
+    /**
+     * @brief Streams the properties of the accepted candidates to a function while the search runs
+     *
+     * The threads searching a helical configuration add the properties of their accepted candidates, and the candidates are
+     * delivered to the function in batches, to limit the cost of calling it. A batch is delivered once it has the requested
+     * number of candidates, or once STREAM_INTERVAL seconds passed since the last delivery, so that rare candidates are not held back.
+     *
+     * @sa ConformationSearch::setCallback
+     */
+    class CandidateStream {
+
+    public:
+        /**
+         * @brief The function receiving the batches
+         *
+         * It receives the properties of the candidates in row-major order, with the columns in ConformationSearch::columnNames,
+         * and returns whether the search should stop.
+         */
+        typedef std::function<bool(const std::vector<double> &)> Callback;
+
+        /**
+         * @brief Constructor for the stream
+         *
+         * @param callback The function receiving the batches
+         * @param num_columns The number of properties of each candidate
+         * @param batch_size The number of candidates in a full batch
+         */
+        CandidateStream(Callback callback, std::size_t num_columns, std::size_t batch_size);
+
+        /**
+         * @brief Adds the properties of a candidate, and delivers the waiting candidates if the batch is full or is old enough
+         *
+         * @param row The properties of the candidate
+         *
+         * @returns Whether the function requested to stop the search
+         */
+        bool add(const double *row);
+
+        /**
+         * @brief Delivers the waiting candidates
+         *
+         * @returns Whether the function requested to stop the search
+         */
+        bool flush();
+
+    private:
+        Callback callback_; //!< @brief The function receiving the batches
+        std::size_t num_columns_, //!< @brief The number of properties of each candidate
+                    batch_size_; //!< @brief The number of candidates in a full batch
+        std::mutex mutex_; //!< @brief Protects the waiting candidates
+        std::vector<double> batch_; //!< @brief The properties of the waiting candidates
+        std::chrono::steady_clock::time_point last_delivery_; //!< @brief The time of the last delivery
+    };
+
+    /**
+     * @brief A flag shared by the searches of a run, to request them to stop from another thread
+     *
+     * Python can only catch keyboard interruptions in the main thread. Searches running in other threads
+     * (e.g. when the helical configurations are run in a thread pool) are stopped through the flag of their run,
+     * so the other searches running in the same process are not affected.
+     *
+     * @sa ConformationSearch::setStopToken
+     */
+    class StopToken {
+
+    public:
+        /**
+         * @brief Requests the searches to stop, or allows new searches to run
+         *
+         * The searches stop at the next step and return the candidates accepted so far.
+         *
+         * @param stop Whether to stop the searches (true) or to allow new searches to run (false)
+         */
+        void stop(bool stop = true) {
+            stopped_ = stop;
+        }
+
+        /**
+         * @brief Returns whether the searches are requested to stop
+         */
+        bool stopped() const {
+            return stopped_;
+        }
+
+    private:
+        std::atomic<bool> stopped_{false}; //!< @brief Whether the searches are requested to stop
+    };
+
     /**
      * @brief A rotor search function used to find acceptable conformations of arbitrary backbone and helical
      * parameter combinations. The main class of the proto-Nucleic Acid Builder
@@ -39,9 +411,11 @@ namespace PNAB {
      * 11. Repeat steps 4-10 or quit.
      *
      * The various search algorithm differ in the implementation of step 4.
-     * Four classes of search algorithms are implemented here, namely:
+     * Six classes of search algorithms are implemented here, namely:
      * - Systematic Search
      * - Random Search
+     * - Adaptive Sampling Search
+     * - Kinematic Closure Search
      * - Monte Carlo Search
      * - Genetic Algorithm Search
      *
@@ -49,6 +423,8 @@ namespace PNAB {
      *
      * @sa SystematicSearch
      * @sa RandomSearch
+     * @sa AdaptiveSamplingSearch
+     * @sa KinematicClosureSearch
      * @sa MonteCarloSearch
      * @sa GeneticAlgorithmSearch
      * @sa HelicalParameters
@@ -74,23 +450,67 @@ namespace PNAB {
          * @param verbose Whether to print progress report to screen
          */
         ConformationSearch(PNAB::RuntimeParameters &runtime_params, PNAB::Backbone &backbone,
-                           PNAB::HelicalParameters &helical_params, PNAB::Bases bases,
+                           PNAB::HelicalParameters &helical_params, PNAB::Bases &bases,
                            std::string prefix = "test", bool verbose = true);
 
         /**
          * @brief A function to call the appropriate search algorithm using the provided RuntimeParameters::search_algorithm
          *
-         * @returns A string in CSV format containing the properties of the accepted candidates. The structure of the accepted
-         *          candidates are saved as PDB files.
+         * If RuntimeParameters::num_threads is larger than one, the search steps are split evenly across several threads.
+         * Each thread has its own copy of the nucleotide, the rotors, the coordinates, and the chain, and its own
+         * random number stream derived from RuntimeParameters::seed. All the threads share the number of
+         * accepted candidates, so that they all stop when RuntimeParameters::num_candidates is reached.
+         * For the genetic algorithm search with more than one island, RuntimeParameters::num_islands threads are used instead,
+         * one for each island. Likewise, the replica exchange Monte Carlo search uses one thread for each of the
+         * RuntimeParameters::num_replicas replicas.
+         *
+         * @returns The properties of the accepted candidates in row-major order, with one row of the columns in ConformationSearch::columnNames
+         *          for each candidate. The structure of the accepted candidates are saved as PDB files.
          *
          * @sa SystematicSearch
          * @sa RandomSearch
          * @sa MonteCarloSearch
          * @sa GeneticAlgorithmSearch
          */
-        std::string run();
+        std::vector<double> run();
+
+        /**
+         * @brief Streams the properties of the accepted candidates to a function while the search runs
+         *
+         * Must be called before ConformationSearch::run. If the function returns true, the search stops.
+         *
+         * @param callback The function receiving the batches of candidates, CandidateStream::Callback
+         * @param batch_size The number of candidates in a full batch
+         */
+        void setCallback(CandidateStream::Callback callback, std::size_t batch_size);
+
+        /**
+         * @brief Returns the names of the properties of the accepted candidates returned by ConformationSearch::run
+         *
+         * @param num_dihedrals The number of rotatable dihedral angles in the backbone
+         *
+         * @returns The conformer index, the distance, the energies, and the dihedral angles
+         */
+        static std::vector<std::string> columnNames(std::size_t num_dihedrals);
+
+        /**
+         * @brief Returns the number of properties of each accepted candidate returned by ConformationSearch::run
+         */
+        std::size_t numColumns() const {
+            return columnNames(rotor_vector.size()).size();
+        }
+
+        /**
+         * @brief Stops the search when the flag is set from another thread
+         *
+         * Must be called before ConformationSearch::run. The flag may be shared by several searches.
+         *
+         * @param stop_token The flag requesting the search to stop, StopToken
+         */
+        void setStopToken(std::shared_ptr<StopToken> stop_token);
 
     private:
+        std::size_t interrupt_check_counter_ = 0; //!< @brief The number of calls to ConformationSearch::checkInterrupt since the last signal check
         bool verbose_; //!< @brief Whether to print progress report to screen
         PNAB::RuntimeParameters runtime_params_; //!< @brief The runtime parameters instance, RuntimeParameters
         std::array<unsigned, 2> backbone_range_; //!< @brief The Backbone index range for the first nucleotide
@@ -98,7 +518,16 @@ namespace PNAB {
         PNAB::HelicalParameters helical_params_; //!< @brief the helical parameters
         PNAB::Bases bases_; //!< @brief the list of the defined bases
         std::mt19937_64 rng_; //!< @brief A random number generator
-        int number_of_candidates = 0; //!< @brief The number of accepted candiates
+        std::shared_ptr<std::atomic<unsigned int>> number_of_candidates = std::make_shared<std::atomic<unsigned int>>(0); //!< @brief The number of accepted candiates. Shared by all the threads searching the same helical configuration
+        std::shared_ptr<std::atomic<bool>> stop_search_ = std::make_shared<std::atomic<bool>>(false); //!< @brief Whether the threads searching the same helical configuration should stop
+        unsigned int thread_index_ = 0, //!< @brief The index of the thread running this search
+                     num_threads_ = 1; //!< @brief The number of threads searching the same helical configuration
+        std::shared_ptr<Migration> migration_; //!< @brief The exchange between the islands of the genetic algorithm search; null for a single island
+        std::shared_ptr<ReplicaExchange> replica_exchange_; //!< @brief The exchange between the replicas of the replica exchange Monte Carlo search; null otherwise
+        std::shared_ptr<BestStructures> best_structures_; //!< @brief The structures with the lowest total energies, RuntimeParameters::num_best; null if all the structures are written
+        std::shared_ptr<CandidateStream> stream_; //!< @brief Streams the accepted candidates to a function, ConformationSearch::setCallback; null if not streamed
+        std::shared_ptr<StopToken> stop_token_; //!< @brief Requests the search to stop from another thread, ConformationSearch::setStopToken; null if not set
+        std::shared_ptr<StructureWriter> writer_; //!< @brief Writes the structures on a background thread, RuntimeParameters::write_queue_size; null if the structures are written by the searching threads
         OpenBabel::matrix3x3 step_rot_, //!< @brief The step rotation matrix, HelicalParameters::getStepRotationMatrix
                              glbl_rot_; //!< @brief The global rotation matrix, HelicalParameters::getGlobalRotationMatrix
         OpenBabel::vector3 step_translate_, //!< @brief The step translation vector, HelicalParameters::getStepTranslationVec
@@ -111,10 +540,16 @@ namespace PNAB {
         OpenBabel::OBMol bu_a_mol; //!< @brief The molecule of the first nucleotide
         unsigned head, //!< @brief The first terminal atom in the backbone
                  tail; //!< @brief The second terminal atom in the backbone
-        std::string output_string; //!< @brief A string in CSV format containing the properties of the accepted candidates
+        std::vector<double> output_data; //!< @brief The properties of the accepted candidates, one row of ConformationSearch::columnNames for each candidate
         double* coords; //!< @brief The coordinates of the first nucleotide 
         OpenBabel::OBRotorList rl; //!< @brief The list of the all rotatable dihedral angles in the backbone
         std::vector<OpenBabel::OBRotor*> rotor_vector; //!< @brief A vector of dihedral angles to be rotated in the search. Excludes fixed angles
+        std::vector<double> reference_coords_, //!< @brief The coordinates of the first nucleotide used for computing the head and tail positions from the dihedral angles
+                            reference_angles_; //!< @brief The exact dihedral angles in ConformationSearch::reference_coords_
+        std::vector<std::array<double, 6>> rotor_axes_; /*!< @brief The point and the unit vector of the axis of each rotor in ConformationSearch::reference_coords_.
+                                                         *   The direction of the vector increases the dihedral angle
+                                                         */
+        std::array<std::vector<unsigned>, 2> linker_rotors_; //!< @brief The rotors that move the head and the tail atoms, starting from the one farthest from the nucleobase
 
         /**
          * @brief Given a step size, the algorithm exhaustively searches over all the rotatable dihedral angles in the backbone
@@ -126,12 +561,28 @@ namespace PNAB {
          * This algorithm is deterministic and reproducible. It is guranteed to find an acceptable candidate, if any exists, to within
          * the given resolution. This algorithm can be used to validate the results of the other algorithms and to determine
          * whether the other algorithms found all the families of the acceptable candidates.
+         *
+         * The grid points are visited like an odometer, with the first rotor changing fastest. The dihedral angles only depend
+         * on the index of the grid point, which is used to name the accepted candidates. A range of grid points can be searched using RuntimeParameters::start_index
+         * and RuntimeParameters::stop_index, so that a large search can be split across several runs and their results merged.
+         * The number of grid points is capped at the largest index, so that it does not overflow.
+         *
+         * In the pruned systematic search, the grid points are visited in the same order. At the first grid point of a block of
+         * grid points that only differ in the first rotors, a lower bound of the distance over the block is computed with measureDistanceBound.
+         * If the first rotors cannot bring the head and the tail atoms within the distance threshold, the whole block is skipped.
+         * The largest such block is tried first. The pruned search gives the same candidates as the systematic search, and is faster
+         * for small step sizes and many rotors when the first rotors move the head or the tail atoms.
+         *
+         * @param pruned Whether to skip the blocks of grid points that cannot satisfy the distance threshold
          * 
          * @sa RuntimeParameters::dihedral_step
+         * @sa RuntimeParameters::start_index
+         * @sa RuntimeParameters::stop_index
          * @sa measureDistance
+         * @sa measureDistanceBound
          * @sa Chain::generateConformerData
          */ 
-        void SystematicSearch();
+        void SystematicSearch(bool pruned);
 
         /**
          *@brief The algorithm randomly changes all the dihedral angles in the backbone and evaluates whether they are acceptable
@@ -146,20 +597,83 @@ namespace PNAB {
          * The probability of choosing a random angle between 0 and 360&deg; can be uniform or can be weighted. See the
          * description in WeightedDistributions for an explanation on the weighting scheme for the dihedral angles.
          *
+         * Pseudo-random numbers cluster and leave gaps in the space of the dihedral angles. In the quasi-random search, the dihedral
+         * angles at each iteration are the point of the iteration in a scrambled HaltonSequence, which covers the space more evenly.
+         * In the weighted quasi-random search, the coordinates of the point are mapped through the inverses of the cumulative distribution
+         * functions of the weighted distributions. The points only depend on RuntimeParameters::seed, so the same structures are found
+         * on any number of threads.
+         *
          * @param weighted Whether to use a weighted distribution for the dihedral angles
+         * @param quasi_random Whether to use quasi-random instead of pseudo-random numbers
          *
          * @sa RuntimeParameters::num_steps
          * @sa RuntimeParameters::weighting_temperature
          * @sa WeightedDistributions
+         * @sa HaltonSequence
          * @sa measureDistance
          * @sa Chain::generateConformerData
          */ 
-        void RandomSearch(bool weighted);
+        void RandomSearch(bool weighted, bool quasi_random);
+
+        /**
+         * @brief A random search that refits the distributions of the dihedral angles to the samples with the lowest distances
+         *
+         * This algorithm uses the cross-entropy method. Like the random search, it sets all the dihedral angles in the backbone to
+         * random values at every iteration. The distribution of each dihedral angle is piecewise linear over 5&deg; intervals, and
+         * starts uniform or weighted, as in WeightedDistributions. Every RuntimeParameters::adaptation_interval iterations, the
+         * samples with the lowest distances between the head atom of the backbone and the tail atom of the adjacent backbone seen
+         * so far are kept, up to RuntimeParameters::elite_fraction of the interval. The weights of each distribution then move
+         * toward the histogram of the dihedral angles of these elite samples by RuntimeParameters::adaptation_rate. A small fraction
+         * of the weights, ADAPTIVE_SAMPLING_FLOOR, is spread uniformly so that no dihedral angle becomes unreachable.
+         *
+         * The torsion profiles know nothing about ring closure, while the refitted distributions concentrate on the dihedral angles
+         * that bring the backbone close to closure. Therefore, many more iterations satisfy the distance threshold than in the
+         * random search. Each dihedral angle is refitted independently, so the correlations between dihedral angles are not learned.
+         * Each thread adapts its own distributions over its share of the iterations.
+         *
+         * @param weighted Whether to start from the weighted distributions for the dihedral angles
+         *
+         * @sa RuntimeParameters::num_steps
+         * @sa RuntimeParameters::adaptation_interval
+         * @sa RuntimeParameters::elite_fraction
+         * @sa RuntimeParameters::adaptation_rate
+         * @sa WeightedDistributions
+         * @sa measureDistance
+         * @sa Chain::generateConformerData
+         */
+        void AdaptiveSamplingSearch(bool weighted);
+
+        /**
+         * @brief A random search that samples the driver dihedral angles and solves the closure dihedral angles
+         *
+         * The other search algorithms set all the dihedral angles and then check whether the head atom of the backbone and the tail
+         * atom of the adjacent backbone are close, so only a tiny fraction of the iterations reach the energy filters. This algorithm
+         * sets only the driver dihedral angles to random values at every iteration. The last three rotors that move the head or the
+         * tail atoms are the closure rotors, whose dihedral angles are solved so that the two atoms coincide.
+         *
+         * Three dihedral angles and the three components of the vector between the two atoms give as many unknowns as equations,
+         * which have zero or more solutions. Starting from RuntimeParameters::closure_attempts random dihedral angles of the closure rotors,
+         * each closure rotor is set in turn to the dihedral angle that minimizes the distance, as in refineClosure, for at most
+         * RuntimeParameters::refinement_iterations sweeps. When the distance is below RuntimeParameters::max_distance, Newton steps
+         * close the gap exactly. The distinct closures are built and passed to the energy filters.
+         *
+         * The probability of choosing a random angle between 0 and 360&deg; can be uniform or can be weighted. See the
+         * description in WeightedDistributions for an explanation on the weighting scheme for the dihedral angles.
+         *
+         * @param weighted Whether to use a weighted distribution for the dihedral angles
+         *
+         * @sa RuntimeParameters::num_steps
+         * @sa RuntimeParameters::closure_attempts
+         * @sa minimizeGap
+         * @sa solveClosure
+         * @sa Chain::generateConformerData
+         */
+        void KinematicClosureSearch(bool weighted);
 
         /**
          * @brief The algorithm utilizes the Metropolis Monte Carlo scheme to improve the choice of the dihedral angle
          *
-         * At every iteration, this algorithm randomly chooses two dihedrals and set them to random values.
+         * At every iteration, this algorithm randomly chooses two (by default) dihedrals and set them to random values.
          * If the new configuration decreases the distance between the head atom of the backbone and the tail atom
          * of the adjacent backbone or if the new distance is less than 1 Angstrom, this step is accepted.
          * If the new configuration does not decrease the distance, the step is provisionally accpeted if a random number
@@ -181,11 +695,28 @@ namespace PNAB {
          *
          * The probability of choosing a random angle between 0 and 360&deg; can be uniform or can be weighted. See the
          * description in WeightedDistributions for an explanation on the weighting scheme for the dihedral angles.
+         *
+         * The number of dihedrals changed at every step is given by RuntimeParameters::num_rotations. In the local proposal mode,
+         * the chosen dihedrals are perturbed by normally distributed steps instead of being set to random values. The logarithm of the
+         * step size increases after an accepted step and decreases after a rejected step, by PROPOSAL_ADAPTATION_RATE times the
+         * difference from RuntimeParameters::target_acceptance, so the acceptance rate approaches the target. Near a closed backbone,
+         * where almost every step over the whole range is rejected, the small steps explore the neighborhood of the accepted structures.
+         *
+         * In the replica exchange Monte Carlo search, RuntimeParameters::num_replicas searches (replicas) run on separate threads for
+         * all the steps, at temperatures spaced geometrically between RuntimeParameters::monte_carlo_temperature and
+         * RuntimeParameters::max_replica_temperature. Every RuntimeParameters::exchange_interval steps, the dihedral angles of
+         * neighboring replicas are swapped with the Metropolis criterion of ReplicaExchange, using the energy \f$E=k(\textrm{distance})^2\f$.
+         * The hot replicas cross the barriers of the distance penalty and pass their dihedral angles down to the cold replicas,
+         * which refine them, so the cold replicas do not get stuck once the distance is small.
+         *
          * @param weighted Whether to use a weighted distribution for the dihedral angles
          *
          * @sa RuntimeParameters::num_steps
          * @sa RuntimeParameters::weighting_temperature
          * @sa RuntimeParameters::monte_carlo_temperature
+         * @sa RuntimeParameters::num_replicas
+         * @sa RuntimeParameters::proposal_mode
+         * @sa ReplicaExchange
          * @sa WeightedDistributions
          * @sa measureDistance
          * @sa Chain::generateConformerData
@@ -218,8 +749,20 @@ namespace PNAB {
          *
          * The probability of choosing a random angle between 0 and 360&deg; is uniform.
          *
+         * The dihedral angles of the population are stored contiguously, and the offsprings are written into a second
+         * buffer that is swapped with the population after each generation. The distances of the accepted candidates are
+         * kept in a hash set, so that identical candidates are skipped in constant time.
+         *
+         * If RuntimeParameters::num_islands is larger than one, several populations (islands) evolve on separate threads for all the
+         * generations, each with its own random number stream. Every RuntimeParameters::migration_interval generations, each island
+         * sends a copy of its fittest individual to the next island, where it replaces the least fit individual. The islands keep
+         * more diversity than a single large population. Otherwise, the generations are split across the threads, which evolve
+         * independent populations.
+         *
          * @sa RuntimeParameters::num_steps
          * @sa RuntimeParameters::population_size
+         * @sa RuntimeParameters::num_islands
+         * @sa RuntimeParameters::migration_interval
          * @sa RuntimeParameters::crossover_rate
          * @sa RuntimeParameters::mutation_rate
          * @sa measureDistance
@@ -245,14 +788,33 @@ namespace PNAB {
          * the search if the acceptable candidates adopt structures where the dihedral angles are not strained. However,
          * it may worsen the search if the unstrained dihedral angles do not produce low-energy candidates.
          *
+         * The distributions only depend on the nucleotide, the force field, and the temperature, but computing them sets up the
+         * force field many times for every rotor. They are computed once per process and reused by all the searches of the same
+         * nucleotide. If RuntimeParameters::weights_cache is set, they are also saved in that directory and reused by other processes.
+         * A file is only used if it was computed for the same elements, coordinates, and bonds of the atoms, the same rotors, the same force field,
+         * and the same temperature. Computing the distributions rotates the rotors, so the coordinates left by the computation
+         * are saved with the distributions, and the searches start from the same coordinates whether the distributions are reused or not.
+         *
          * @returns A vector of the weighted distributions for each rotatable dihedral angle
          *
          * @sa RuntimeParameters::weighting_temperature
+         * @sa RuntimeParameters::weights_cache
          * @sa RandomSearch
          * @sa MonteCarloSearch
          */ 
         std::vector <std::piecewise_linear_distribution<double>> WeightedDistributions();
 
+        /**
+         * @brief Computes the weighted distributions for each rotatable dihedral angle in the backbone
+         *
+         * @param intervals_vector The borders of the intervals of each distribution; modified in place
+         * @param weights_vector The probabilities at the borders of the intervals of each distribution; modified in place
+         *
+         * @sa WeightedDistributions
+         */
+        void computeWeightedDistributions(std::vector<std::vector<double>> &intervals_vector,
+                                          std::vector<std::vector<double>> &weights_vector);
+
         /**
         * @brief Compute the distance between the head backbone atom and the tail backbone atom of the next nucleotide
         *
@@ -271,18 +833,201 @@ namespace PNAB {
         */ 
         double measureDistance(double *coords, unsigned head, unsigned tail);
 
+        /**
+        * @brief Compute the distance between the head backbone atom and the tail backbone atom of the next nucleotide
+        *        from the dihedral angles
+        *
+        * Setting the dihedral angles with OpenBabel::OBRotor::SetToAngle moves all the atoms of the backbone, while only the
+        * head and the tail atoms are needed for the distance. This function computes only the positions of these two atoms by
+        * rotating their positions in ConformationSearch::reference_coords_ about the axes of the rotors that move them.
+        * The rotations start from the rotor farthest from the nucleobase, so that the axes are the ones in the reference
+        * coordinates. The search algorithms use this distance to screen the steps, and only set the dihedral angles of the
+        * steps whose distance is within DISTANCE_SCREEN_TOLERANCE of RuntimeParameters::max_distance.
+        *
+        * @param angles The dihedral angles of the rotors in ConformationSearch::rotor_vector
+        *
+        * @returns The distance between the two atoms in Angstroms
+        *
+        * @sa setupLinkerRotors
+        * @sa setAngles
+        */
+        double measureDistance(const std::vector<double> &angles);
+
+        /**
+        * @brief Compute the positions of the head and the tail atoms of the first nucleotide from the dihedral angles
+        *
+        * @param angles The dihedral angles of the rotors in ConformationSearch::rotor_vector
+        * @param linker_coords The positions of the head and the tail atoms; modified in place
+        *
+        * @sa measureDistance
+        */
+        void measureLinkers(const std::vector<double> &angles, OpenBabel::vector3 *linker_coords);
+
+        /**
+        * @brief Compute the vector from the tail atom of the next nucleotide to the head atom from the dihedral angles
+        *
+        * @param angles The dihedral angles of the rotors in ConformationSearch::rotor_vector
+        *
+        * @returns The vector between the two atoms after the global and step transformations
+        *
+        * @sa measureDistance
+        */
+        OpenBabel::vector3 measureGap(const std::vector<double> &angles);
+
+        /**
+        * @brief Set the dihedral angle of a rotor to the angle that minimizes the distance between the head atom and the tail atom
+        *        of the next nucleotide
+        *
+        * Rotating a rotor moves the head and the tail atoms on circles, so the vector between them is \f$A+B\cos x+C\sin x\f$ for
+        * a rotation \f$x\f$. The three vectors are found from the positions at three rotations, the distance is minimized over
+        * CLOSURE_REFINEMENT_GRID rotations, and the best rotation is refined by Newton steps.
+        *
+        * @param angles The dihedral angles of the rotors in ConformationSearch::rotor_vector; modified in place
+        * @param index The index of the rotor in ConformationSearch::rotor_vector
+        *
+        * @returns The minimized distance in Angstroms
+        */
+        double minimizeGap(std::vector<double> &angles, unsigned index);
+
+        /**
+        * @brief Close the gap between the head atom and the tail atom of the next nucleotide by cyclic coordinate descent
+        *
+        * If the distance is at least RuntimeParameters::max_distance and less than RuntimeParameters::refinement_distance,
+        * the rotors that move the head or the tail atoms are set in turn to the dihedral angle that minimizes the distance, for at most
+        * RuntimeParameters::refinement_iterations sweeps over the rotors or until the distance is less than RuntimeParameters::max_distance.
+        * Each rotor is set with minimizeGap.
+        *
+        * The refinement runs before the energy filters, so many near misses become candidates. It changes all the rotors that move the
+        * head or the tail atoms, so the refined dihedral angles may be far from the sampled ones for large refinement distances.
+        *
+        * @param angles The dihedral angles of the rotors in ConformationSearch::rotor_vector; modified in place
+        * @param distance The distance for the dihedral angles, from measureDistance
+        *
+        * @returns The distance for the refined dihedral angles in Angstroms
+        *
+        * @sa RuntimeParameters::refinement_distance
+        */
+        double refineClosure(std::vector<double> &angles, double distance);
+
+        /**
+        * @brief Close the gap between the head atom and the tail atom of the next nucleotide exactly by Newton steps over three rotors
+        *
+        * The derivatives of the vector between the two atoms are computed by finite differences, and the linear equations are solved
+        * by Cramer's rule. The steps stop when the distance is below CLOSURE_TOLERANCE, when a step does not decrease the distance, or
+        * after CLOSURE_NEWTON_ITERATIONS steps.
+        *
+        * @param angles The dihedral angles of the rotors in ConformationSearch::rotor_vector; modified in place
+        * @param rotors The indices of the three rotors in ConformationSearch::rotor_vector; other numbers of rotors are not changed
+        * @param distance The distance for the dihedral angles
+        *
+        * @returns The distance for the solved dihedral angles in Angstroms
+        *
+        * @sa KinematicClosureSearch
+        */
+        double solveClosure(std::vector<double> &angles, const std::vector<unsigned> &rotors, double distance);
+
+        /**
+        * @brief Apply the global and step transformations to the head and tail atoms and compute their distance
+        *
+        * @param head_coord The coordinates of the head atom in the first nucleotide
+        * @param tail_coord The coordinates of the tail atom in the first nucleotide
+        *
+        * @returns The distance between the head atom and the tail atom of the next nucleotide in Angstroms
+        */
+        double measureDistance(OpenBabel::vector3 head_coord, OpenBabel::vector3 tail_coord);
+
+        /**
+        * @brief Compute a lower bound of the distance between the head atom and the tail atom of the next nucleotide
+        *        over all the dihedral angles of the first rotors
+        *
+        * The positions of the head and the tail atoms are propagated as spheres through the rotors that move them, as in
+        * measureDistance. A fixed rotor rotates the center of the sphere. A free rotor can take any angle, so the sphere is replaced by
+        * the sphere centered on the axis that contains all its rotations. The bound is the distance between the centers minus the radii.
+        *
+        * @param angles The dihedral angles of the rotors in ConformationSearch::rotor_vector; the angles of the free rotors are ignored
+        * @param num_free The number of free rotors at the start of ConformationSearch::rotor_vector
+        *
+        * @returns The lower bound of the distance in Angstroms
+        *
+        * @sa SystematicSearch
+        */
+        double measureDistanceBound(const std::vector<double> &angles, unsigned num_free);
+
+        /**
+        * @brief Determine the rotors that move the head and the tail atoms and the axes of all the rotors
+        *
+        * This function is called by the constructor after the rotors are set up.
+        *
+        * @sa measureDistance
+        */
+        void setupLinkerRotors();
+
+        /**
+        * @brief Set the dihedral angles of all the rotors in the coordinates of the first nucleotide
+        *
+        * The rotors are rotated starting from ConformationSearch::reference_coords_, so that the coordinates only depend on the
+        * dihedral angles and rounding errors do not accumulate over the search.
+        *
+        * @param angles The exact dihedral angles of the rotors in ConformationSearch::rotor_vector
+        *
+        * @sa setAngle
+        */
+        void setAngles(const std::vector<double> &angles);
+
+        /**
+        * @brief Set the dihedral angle of a rotor in the same way as OpenBabel::OBRotor::SetToAngle
+        *
+        * OpenBabel::OBRotor::CalcTorsion clamps the cosine of the dihedral angle, so it does not measure the angles within
+        * about 0.03&deg; of 0 and 180&deg; exactly. OpenBabel::OBRotor::SetToAngle rotates the atoms by the difference between
+        * the requested and the measured angle, and does not rotate them if the difference is less than 1e-5 radians.
+        * The search algorithms keep the exact dihedral angles and set them with this function, so that the searches give
+        * the same structures as setting the dihedral angles in the coordinates at every step.
+        *
+        * @param angles The exact dihedral angles of the rotors in ConformationSearch::rotor_vector; modified in place
+        * @param index The index of the rotor
+        * @param angle The requested dihedral angle in radians
+        *
+        * @sa measureAngle
+        */
+        void setAngle(std::vector<double> &angles, unsigned index, double angle);
+
+        /**
+        * @brief Compute the dihedral angle that OpenBabel::OBRotor::CalcTorsion measures for an exact dihedral angle
+        *
+        * @param angle The exact dihedral angle in radians
+        *
+        * @returns The measured dihedral angle in radians, between -pi and pi
+        */
+        static double measureAngle(double angle);
+
         /**
         * @brief A function to report the data on the accepted candidates 
         *
         * This function saves the structure of each accepted candidate in PDB format. It also reports
         * the properties of the candidates, ordered by their total energies, in a string with the CSV format.
-        * This is called by all search algorithms when a candidate is accepted. The ConformationSearch::output_string
+        * This is called by all search algorithms when a candidate is accepted. The ConformationSearch::output_data
         * variable is updated.
         *
+        * If a function is set with ConformationSearch::setCallback, the properties of the candidate are streamed to it.
+        * If RuntimeParameters::write_queue_size is larger than zero, the structure is written by ConformationSearch::writer_.
+        * If RuntimeParameters::num_best is larger than zero, the structure is kept in ConformationSearch::best_structures_
+        * instead of being written. Once RuntimeParameters::num_best structures are kept, the candidates whose total energies are
+        * not lower than the highest kept total energy are rejected, and the maximum total energy in RuntimeParameters::energy_filter
+        * is lowered to the highest kept total energy.
+        *
         * @param conf_data The properties of the accepted candiate
+        *
+        * @sa writeBestStructures
         */ 
         void reportData(PNAB::ConformerData &conf_data);
 
+        /**
+        * @brief Write the PDB files of the structures kept in ConformationSearch::best_structures_
+        *
+        * @sa RuntimeParameters::num_best
+        */
+        void writeBestStructures();
+
         /**
         * @brief Prints the percentage of search completed and the best accepted candidate
         *
@@ -293,6 +1038,38 @@ namespace PNAB {
         * @param search_size The total number of steps
         */ 
         void printProgress(std::size_t search_index, std::size_t search_size);
+
+        /**
+        * @brief Calls the search algorithm using the provided RuntimeParameters::search_algorithm
+        *
+        * @sa run
+        */
+        void search();
+
+        /**
+        * @brief Finds the range of steps searched by this thread
+        *
+        * The steps are split evenly across the threads searching the same helical configuration.
+        *
+        * @param search_size The total number of steps
+        *
+        * @returns The index of the first step and one past the index of the last step
+        */
+        std::array<std::size_t, 2> threadRange(std::size_t search_size);
+
+        /**
+        * @brief Checks whether the search should stop
+        *
+        * The search runs without holding the python global interpreter lock. The search stops if
+        * its StopToken is set, if another thread searching the same helical configuration stopped, or if
+        * the requested number of candidates is found. Every SIGNAL_CHECK_INTERVAL calls, the lock is reacquired to
+        * check whether python received a keyboard interruption. This is called by all search algorithms at every step.
+        *
+        * @returns Whether the search should stop
+        *
+        * @sa setStopToken
+        */
+        bool checkInterrupt();
     };
 }
 
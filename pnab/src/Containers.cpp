@@ -9,6 +9,11 @@ using namespace std;
 using namespace PNAB;
 using namespace OpenBabel;
 
+std::mutex &PNAB::openbabelMutex() {
+    static std::mutex ob_mutex;
+    return ob_mutex;
+}
+
 void HelicalParameters::computeHelicalParameters() {
     if (!is_helical) {
         vector<vector3> ref_frame = StepParametersToReferenceFrame();
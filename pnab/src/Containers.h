@@ -8,6 +8,7 @@
 #include <string>
 #include <random>
 #include <array>
+#include <mutex>
 #include <openbabel/mol.h>
 #include <openbabel/atom.h>
 #include <openbabel/bond.h>
@@ -40,11 +41,16 @@ namespace PNAB {
         *
         * This empty constructor can be used. After that, values for the member variables should be specified.
         */
-        RuntimeParameters() : energy_filter{}, max_distance(), ff_type(), glycosidic_bond_distance(0.0),
-                              num_steps(0), seed(0), weighting_temperature(298.0), monte_carlo_temperature(298.0),
-                              mutation_rate(0.75), crossover_rate(0.75), population_size(1000), strand{}, is_hexad(false),
-                              build_strand(std::vector<bool> {true, false, false, false, false, false}), num_candidates(10),
-                              strand_orientation(std::vector<bool> {true, true, true, true, true, true}){};
+        RuntimeParameters() : energy_filter{}, max_distance(), ff_type(), energy_mode("openbabel"), nonbonded_cutoff(12.0),
+                              num_steps(0), seed(0), start_index(0), stop_index(0), weighting_temperature(298.0), weights_cache(), monte_carlo_temperature(298.0),
+                              num_replicas(4), max_replica_temperature(1000.0), exchange_interval(100),
+                              proposal_mode("global"), num_rotations(2), proposal_step(30.0), target_acceptance(0.3),
+                              adaptation_interval(1000), elite_fraction(0.1), adaptation_rate(0.7),
+                              refinement_distance(0.0), refinement_iterations(10), closure_attempts(8),
+                              mutation_rate(0.75), crossover_rate(0.75), population_size(1000), num_islands(1), migration_interval(10), strand{},
+                              build_strand(std::vector<bool> {true, false, false, false, false, false}),
+                              strand_orientation(std::vector<bool> {true, true, true, true, true, true}), is_hexad(false), glycosidic_bond_distance(0.0),
+                              num_candidates(10), num_best(0), write_queue_size(64), multi_model_file(false), num_threads(1){};
 
         // Thresholds
         std::vector<double> energy_filter;      /*!< @brief [max bond E, max angle E, max torsion E, max VDW E, max total E]
@@ -75,16 +81,36 @@ namespace PNAB {
                                                 *
                                                 * @sa Chain::Chain
                                                 */
+        std::string energy_mode;                /*!< @brief How the van der Waals and electrostatic energies are computed
+                                                *
+                                                * - "openbabel" (default): Openbabel evaluates all the pairs of atoms
+                                                * - "cell list": a neighbor grid evaluates only the van der Waals pairs within the nonbonded cutoff;
+                                                *   the nucleotides farther apart interact electrostatically through their multipoles
+                                                * - "helical symmetry": only the unique pairs of a homopolymer are evaluated and weighted by their number
+                                                *
+                                                * @sa Chain::Chain
+                                                * @sa NonbondedTerms
+                                                */
+        double nonbonded_cutoff;                //!< @brief The cutoff distance (in Angstroms) for the van der Waals interactions and the multipole expansion in the "cell list" energy mode
 
         // Algorithm parameters
         std::string search_algorithm;           /*!< @brief The search algorithm
                                                 *
-                                                * There are six search algorithms:
+                                                * There are fifteen search algorithms:
                                                 * - Systematic search
+                                                * - Pruned systematic search
                                                 * - Monte Carlo search
                                                 * - Weighted Monte Carlo search
+                                                * - Replica exchange Monte Carlo search
+                                                * - Weighted replica exchange Monte Carlo search
                                                 * - Random search
                                                 * - Weighted random search
+                                                * - Quasi-random search
+                                                * - Weighted quasi-random search
+                                                * - Adaptive sampling search
+                                                * - Weighted adaptive sampling search
+                                                * - Kinematic closure search
+                                                * - Weighted kinematic closure search
                                                 * - Genetic algorithm search
                                                 *
                                                 *   @sa ConformationSearch
@@ -112,17 +138,127 @@ namespace PNAB {
                                                 * @sa ConformationSearch::SystematicSearch
                                                 */
 
+        std::size_t start_index,                /*!< @brief The index of the first grid point searched in systematic search
+                                                *
+                                                * The grid points are numbered with the first rotor changing fastest. Together with
+                                                * RuntimeParameters::stop_index, this splits a large systematic search into shards that
+                                                * can be run in separate processes or nodes. The accepted candidates are named after the
+                                                * index of their grid point, so the results of the shards can be merged afterwards.
+                                                *
+                                                * @sa ConformationSearch::SystematicSearch
+                                                */
+                    stop_index;                 /*!< @brief One past the index of the last grid point searched in systematic search
+                                                *
+                                                * If zero (default), the search continues to the last grid point.
+                                                *
+                                                * @sa RuntimeParameters::start_index
+                                                */
+
         double weighting_temperature;           /*!< @brief The temperature used to compute the weighted probability for weighted
                                                 * Monte Carlo and weighted random searches
                                                 *
                                                 * @sa ConformationSearch::WeightedDistributions
                                                 */
 
+        std::string weights_cache;              /*!< @brief The directory where the weighted distributions are saved and reused by other processes
+                                                *
+                                                * The directory must exist. If empty, the weighted distributions are only reused within the process.
+                                                *
+                                                * @sa ConformationSearch::WeightedDistributions
+                                                */
+
         double monte_carlo_temperature;         /*!< @brief The temperature used in the Monte Carlo acceptance and rejection procedure
                                                 *
                                                 * @sa ConformationSearch::MonteCarloSearch
                                                 */
 
+        unsigned int num_replicas;              /*!< @brief The number of replicas in the replica exchange Monte Carlo search
+                                                *
+                                                * Each replica runs on its own thread with its own random number stream for all the steps,
+                                                * and replaces RuntimeParameters::num_threads for the replica exchange Monte Carlo search.
+                                                *
+                                                * @sa ConformationSearch::MonteCarloSearch
+                                                */
+
+        double max_replica_temperature;         /*!< @brief The temperature of the hottest replica in the replica exchange Monte Carlo search
+                                                *
+                                                * The temperatures of the replicas are spaced geometrically between RuntimeParameters::monte_carlo_temperature
+                                                * and this temperature.
+                                                *
+                                                * @sa ConformationSearch::MonteCarloSearch
+                                                */
+
+        unsigned int exchange_interval;         /*!< @brief The number of steps between the exchanges of the replicas in the replica exchange Monte Carlo search
+                                                *
+                                                * If zero, the replicas are not exchanged.
+                                                *
+                                                * @sa ConformationSearch::MonteCarloSearch
+                                                */
+
+        std::string proposal_mode;              /*!< @brief How the Monte Carlo steps change the dihedral angles
+                                                *
+                                                * - "global": The new dihedral angles are drawn from the whole range, or from the weighted distributions
+                                                * - "local": The dihedral angles are perturbed by normally distributed steps, whose size adapts to
+                                                *   reach RuntimeParameters::target_acceptance
+                                                *
+                                                * The global steps shuffle the indices of all the rotors to pick the RuntimeParameters::num_rotations
+                                                * rotors that change, so that a given seed gives the same structures as earlier versions. Each global
+                                                * step is therefore linear in the number of rotors. The local steps only draw the indices that change.
+                                                *
+                                                * @sa ConformationSearch::MonteCarloSearch
+                                                */
+
+        unsigned int num_rotations;             //!< @brief The number of dihedral angles changed at every Monte Carlo step
+
+        double proposal_step;                   /*!< @brief The initial standard deviation of the local Monte Carlo steps (degrees)
+                                                *
+                                                * @sa RuntimeParameters::proposal_mode
+                                                */
+
+        double target_acceptance;               /*!< @brief The target acceptance rate of the local Monte Carlo steps
+                                                *
+                                                * @sa RuntimeParameters::proposal_mode
+                                                */
+
+        unsigned int adaptation_interval;       /*!< @brief The number of steps between the refits of the distributions in the adaptive sampling search
+                                                *
+                                                * @sa ConformationSearch::AdaptiveSamplingSearch
+                                                */
+
+        double elite_fraction;                  /*!< @brief The number of elite samples in the adaptive sampling search, as a fraction of RuntimeParameters::adaptation_interval
+                                                *
+                                                * @sa ConformationSearch::AdaptiveSamplingSearch
+                                                */
+
+        double adaptation_rate;                 /*!< @brief The fraction by which the distributions move toward the elite samples at every refit
+                                                *
+                                                * If one, the distributions are replaced by the histograms of the elite samples. If zero, the
+                                                * distributions do not change.
+                                                *
+                                                * @sa ConformationSearch::AdaptiveSamplingSearch
+                                                */
+
+        double refinement_distance;             /*!< @brief The distance (in Angstroms) below which the near misses are refined to close the gap
+                                                *
+                                                * The dihedral angles whose distance is between RuntimeParameters::max_distance and this distance are refined
+                                                * by cyclic coordinate descent before the energy filters run. If not larger than RuntimeParameters::max_distance,
+                                                * the dihedral angles are not refined.
+                                                *
+                                                * @sa ConformationSearch::refineClosure
+                                                */
+
+        unsigned int refinement_iterations;     /*!< @brief The maximum number of sweeps over the rotors in the refinement of the near misses
+                                                *
+                                                * Also the maximum number of sweeps over the closure rotors in the kinematic closure search.
+                                                *
+                                                * @sa RuntimeParameters::refinement_distance
+                                                */
+
+        unsigned int closure_attempts;          /*!< @brief The number of starting points of the closure rotors for each sample in the kinematic closure search
+                                                *
+                                                * @sa ConformationSearch::KinematicClosureSearch
+                                                */
+
         double mutation_rate;                   /*!< @brief The mutation rate in the genetic algorithm search
                                                 *
                                                 * @sa ConformationSearch::GeneticAlgorithmSearch
@@ -138,6 +274,21 @@ namespace PNAB {
                                                 * @sa ConformationSearch::GeneticAlgorithmSearch
                                                 */
 
+        unsigned int num_islands;               /*!< @brief The number of populations (islands) in the genetic algorithm search
+                                                *
+                                                * If larger than one, each island evolves on its own thread with its own random number stream
+                                                * for all the generations, and replaces RuntimeParameters::num_threads for the genetic algorithm search.
+                                                *
+                                                * @sa ConformationSearch::GeneticAlgorithmSearch
+                                                */
+
+        unsigned int migration_interval;        /*!< @brief The number of generations between the exchanges of the fittest individuals of the islands
+                                                *
+                                                * If zero, the islands do not exchange individuals.
+                                                *
+                                                * @sa RuntimeParameters::num_islands
+                                                */
+
         //Strand parameters
         std::vector<std::string> strand;        //!< @brief The names of each base used in the strand
         std::vector<bool> build_strand;         /*!< @brief Defines whether to build a given strand
@@ -153,6 +304,38 @@ namespace PNAB {
         // Glycosidic bond
         double glycosidic_bond_distance;        //!< @brief Set a user-defined glycosidic bond distance (in Angstroms). If zero (default), sets the distance based on van der Waals radii
         unsigned int num_candidates;            //!< @brief Quit after finding the specified number of accepted candidates
+        unsigned int num_best;                  /*!< @brief The number of accepted candidates with the lowest total energies whose structures are written
+                                                *
+                                                * If zero, the structures of all the accepted candidates are written as they are found. Otherwise, the
+                                                * structures are kept in memory, the candidates whose total energies are not lower than the highest
+                                                * kept total energy are rejected, and the kept structures are written when the search finishes.
+                                                *
+                                                * @sa ConformationSearch::reportData
+                                                */
+        unsigned int write_queue_size;          /*!< @brief The maximum number of structures waiting to be written by the writer thread
+                                                *
+                                                * The structures of the accepted candidates are written to files on a background thread, so
+                                                * that the searches do not wait for the file system. The searches wait if this many structures are
+                                                * waiting to be written. If zero, the structures are written by the searching threads.
+                                                *
+                                                * @sa StructureWriter
+                                                */
+        bool multi_model_file;                  /*!< @brief Defines whether the structures are appended to a single multi-model PDB file
+                                                *
+                                                * If true, the structures of all the accepted candidates of a helical configuration are appended as
+                                                * models to "prefix_models.pdb", instead of being written to a file each. "prefix_models.csv" has the
+                                                * name, the model number, the offset, and the size in bytes of each structure, so that any structure
+                                                * can be read without reading the whole file.
+                                                *
+                                                * @sa StructureWriter
+                                                */
+        unsigned int num_threads;               /*!< @brief The number of threads used to search a single helical configuration
+                                                *
+                                                * The search steps are split evenly across the threads. Each thread uses its own random
+                                                * number stream derived from the seed.
+                                                *
+                                                * @sa ConformationSearch::run
+                                                */
     };
 
     /**
@@ -724,8 +907,8 @@ namespace PNAB {
      */
     struct ConformerData {
         OpenBabel::OBMol molecule;                  //!< @brief The openbabel OBMol object for the conformer
-        double *monomer_coord,                      //!< @brief Pointer to array containing coordinates of a single monomer
-                distance,                           //!< @brief distance between interconnects in Backbone for adjacent BaseUnit
+        std::vector<double> monomer_coord;          //!< @brief The coordinates of a single monomer
+        double distance,                            //!< @brief distance between interconnects in Backbone for adjacent BaseUnit
                 bondE,                              //!< @brief Energy of newly formed bonds in the backbone divided by the length of the strand -1
                 angleE,                             //!< @brief Energy of newly formed angles in the backbone divided by the length of the strand -1
                 torsionE,                           //!< @brief Energy of all rotatable torsions divided by the length of the strand
@@ -746,6 +929,21 @@ namespace PNAB {
         }
     };
 
+    /**
+     * @brief Returns the mutex that serializes the calls to the parts of openbabel that are not thread-safe
+     *
+     * Reading molecules, perceiving their properties, and setting up force fields modify global openbabel
+     * objects (e.g. the error log and the force field constraints). These calls must hold this lock when
+     * several searches run at the same time in different threads. Rotating dihedral angles and computing
+     * energies with force fields that are already set up do not require the lock.
+     *
+     * @return The mutex guarding the global openbabel state
+     *
+     * @sa ConformationSearch::ConformationSearch
+     * @sa Chain::Chain
+     */
+    std::mutex &openbabelMutex();
+
 }
 
 #endif //PNAB_CONTAINERS_H
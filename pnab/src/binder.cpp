@@ -3,9 +3,9 @@
  */
 
 #include <pybind11/pybind11.h>
+#include <pybind11/numpy.h>
 #include <pybind11/stl.h>
 #include <pybind11/stl_bind.h>
-#include <pybind11/iostream.h>
 
 #include "ConformationSearch.h"
 
@@ -13,42 +13,162 @@ namespace py = pybind11;
 
 namespace PNAB {
     /**
-     * @brief A wrapper function to run the search algorithm code from python
+     * @brief Runs the search algorithm code
+     *
+     * The function must be called without holding the python global interpreter lock, so several
+     * helical configurations can be run at the same time from different python threads.
      *
      * @param runtime_params The runtime parameters defined in the python script
      * @param py_backbone The backbone defined in the python script
      * @param py_bases A vector of the bases defined in the python script
      * @param hp The helical parameters defined in the python script
-     * @param prefix A string the prepends the names of the output PDB files, default to "run"
-     * @param verbose Whether to print progress report to screen, default to true
+     * @param prefix A string the prepends the names of the output PDB files
+     * @param verbose Whether to print progress report to screen
+     * @param num_columns The number of properties of each accepted candidate; modified in place
+     * @param callback The function receiving the batches of accepted candidates while the search runs, or an empty function
+     * @param batch_size The number of candidates in a full batch
+     * @param stop_token The flag requesting the search to stop from another thread, or null
      *
-     * @returns A CSV string containing the properties of the accepted candidates
-     */ 
-    std::string run(PNAB::RuntimeParameters runtime_params, PNAB::Backbone &py_backbone,
-                    std::vector<PNAB::Base> py_bases, PNAB::HelicalParameters hp, std::string prefix="run", bool verbose=true) {
+     * @returns The properties of the accepted candidates in row-major order, ConformationSearch::run
+     */
+    std::vector<double> search(PNAB::RuntimeParameters &runtime_params, PNAB::Backbone &py_backbone,
+                               std::vector<PNAB::Base*> &py_bases, PNAB::HelicalParameters &hp, std::string &prefix, bool verbose,
+                               std::size_t &num_columns, CandidateStream::Callback callback = nullptr, std::size_t batch_size = 0,
+                               std::shared_ptr<StopToken> stop_token = nullptr) {
+        // Copying the molecules and reading the input files are not thread-safe in openbabel
+        // The bases are passed as pointers so that they are only copied here
+        std::unique_lock<std::mutex> lock(openbabelMutex());
         Backbone backbone(py_backbone.file_path, py_backbone.interconnects, py_backbone.linker, py_backbone.fixed_bonds);
-        Bases bases(py_bases);
+        std::vector<Base> input_bases;
+        for (auto b: py_bases)
+            input_bases.push_back(*b);
+        Bases bases(input_bases);
+        lock.unlock();
 
         hp.computeHelicalParameters();
 
         ConformationSearch search(runtime_params, backbone, hp,  bases, prefix, verbose);
-        std::string output = search.run();
+        num_columns = search.numColumns();
+        if (callback)
+            search.setCallback(callback, batch_size);
+        if (stop_token)
+            search.setStopToken(stop_token);
+        std::vector<double> output = search.run();
 
         return output;
 
     }
 
+    /**
+     * @brief A wrapper function to run the search algorithm code from python
+     *
+     * The search runs without holding the python global interpreter lock, so several
+     * helical configurations can be run at the same time from different python threads.
+     * The returned array uses the memory of the results of the search; nothing is copied.
+     *
+     * If a callback is given, it is called with 2D numpy arrays of the accepted candidates, with the same columns as
+     * the returned array, while the search runs. The candidates are delivered in batches of batch_size candidates,
+     * or sooner if STREAM_INTERVAL seconds passed since the last batch. If the callback returns True, the search stops.
+     * The callback may be called from any of the threads searching the helical configuration.
+     *
+     * If a stop token is given, the search stops once the token is set from another python thread.
+     * A token can be shared by several searches, e.g. the helical configurations of one run.
+     *
+     * @param runtime_params The runtime parameters defined in the python script
+     * @param py_backbone The backbone defined in the python script
+     * @param py_bases A vector of the bases defined in the python script
+     * @param hp The helical parameters defined in the python script
+     * @param prefix A string the prepends the names of the output PDB files, default to "run"
+     * @param verbose Whether to print progress report to screen, default to true
+     * @param callback A python function receiving the batches of accepted candidates while the search runs, default to None
+     * @param batch_size The number of candidates in a full batch, default to 100
+     * @param stop_token A StopToken requesting the search to stop, default to None
+     *
+     * @returns A 2D numpy array of the properties of the accepted candidates, with the columns in ConformationSearch::columnNames
+     */
+    py::array_t<double> run(PNAB::RuntimeParameters runtime_params, PNAB::Backbone &py_backbone,
+                            std::vector<PNAB::Base*> py_bases, PNAB::HelicalParameters hp, std::string prefix="run", bool verbose=true,
+                            py::object callback=py::none(), std::size_t batch_size=100,
+                            std::shared_ptr<StopToken> stop_token=nullptr) {
+        std::size_t num_columns;
+        std::unique_ptr<std::vector<double>> output(new std::vector<double>);
+
+        // The python function outlives the search, so it is used without changing its reference count
+        CandidateStream::Callback stream;
+        if (!callback.is_none()) {
+            py::handle function = callback;
+            stream = [function, &num_columns](const std::vector<double> &batch) {
+                py::gil_scoped_acquire acquire;
+                py::array_t<double> array({batch.size() / num_columns, num_columns}, batch.data());
+                return py::bool_(function(array)).cast<bool>();
+            };
+        }
+
+        {
+            py::gil_scoped_release release;
+            *output = search(runtime_params, py_backbone, py_bases, hp, prefix, verbose, num_columns, stream, batch_size, stop_token);
+        }
+
+        // The array owns the results
+        std::size_t num_rows = output->size() / num_columns;
+        double *data = output->data();
+        py::capsule owner(output.release(), [](void *p) { delete reinterpret_cast<std::vector<double>*>(p); });
+        return py::array_t<double>({num_rows, num_columns}, data, owner);
+    }
+
+    /**
+     * @brief A wrapper function to run the search algorithm code from python and get the results as a CSV string
+     *
+     * Kept for compatibility with the earlier versions, in which the @a run function returned a CSV string.
+     * The first column is the prefix, followed by the columns in ConformationSearch::columnNames.
+     *
+     * @param runtime_params The runtime parameters defined in the python script
+     * @param py_backbone The backbone defined in the python script
+     * @param py_bases A vector of the bases defined in the python script
+     * @param hp The helical parameters defined in the python script
+     * @param prefix A string the prepends the names of the output PDB files, default to "run"
+     * @param verbose Whether to print progress report to screen, default to true
+     *
+     * @returns A CSV string containing the properties of the accepted candidates
+     *
+     * @sa run
+     */
+    std::string run_csv(PNAB::RuntimeParameters runtime_params, PNAB::Backbone &py_backbone,
+                        std::vector<PNAB::Base*> py_bases, PNAB::HelicalParameters hp, std::string prefix="run", bool verbose=true) {
+        std::size_t num_columns;
+        std::vector<double> output = search(runtime_params, py_backbone, py_bases, hp, prefix, verbose, num_columns);
+
+        // Header
+        std::ostringstream csv;
+        csv << "# Prefix";
+        for (auto &name: ConformationSearch::columnNames(num_columns - ConformationSearch::columnNames(0).size()))
+            csv << ", " << name;
+        csv << std::endl;
+
+        for (std::size_t i=0; i < output.size(); i += num_columns) {
+            csv << prefix << ", " << static_cast<std::size_t>(output[i]);
+            for (std::size_t j=1; j < num_columns; j++)
+                csv << ", " << output[i + j];
+            csv << std::endl;
+        }
+
+        return csv.str();
+    }
+
     /**
      * @brief Exports certain classes to python to allow the user to run the code from python
      * 
      * This pybind11 scheme exports only the input runtime, helical, base, and backbone parameters.
-     * It exports a single run funtion that can be called from python to run the code.
+     * It exports a run funtion that can be called from python to run the code and returns a numpy array, a run_csv function
+     * that returns a CSV string instead, a function that returns the names of the columns of the array, and a stop token
+     * class that stops the searches of a run from other python threads.
      *
      * @sa RuntimeParameters
      * @sa HelicalParameters
      * @sa Base
      * @sa Backbone
      * @sa run
+     * @sa StopToken
      */ 
     PYBIND11_MODULE(bind, m) {
         m.doc() = "Nucleic Acid Builder";
@@ -62,17 +182,41 @@ namespace PNAB {
             .def_readwrite("num_steps", &PNAB::RuntimeParameters::num_steps)
             .def_readwrite("seed", &PNAB::RuntimeParameters::seed)
             .def_readwrite("dihedral_step", &PNAB::RuntimeParameters::dihedral_step)
+            .def_readwrite("start_index", &PNAB::RuntimeParameters::start_index)
+            .def_readwrite("stop_index", &PNAB::RuntimeParameters::stop_index)
             .def_readwrite("weighting_temperature", &PNAB::RuntimeParameters::weighting_temperature)
+            .def_readwrite("weights_cache", &PNAB::RuntimeParameters::weights_cache)
             .def_readwrite("monte_carlo_temperature", &PNAB::RuntimeParameters::monte_carlo_temperature)
+            .def_readwrite("num_replicas", &PNAB::RuntimeParameters::num_replicas)
+            .def_readwrite("max_replica_temperature", &PNAB::RuntimeParameters::max_replica_temperature)
+            .def_readwrite("exchange_interval", &PNAB::RuntimeParameters::exchange_interval)
+            .def_readwrite("proposal_mode", &PNAB::RuntimeParameters::proposal_mode)
+            .def_readwrite("num_rotations", &PNAB::RuntimeParameters::num_rotations)
+            .def_readwrite("proposal_step", &PNAB::RuntimeParameters::proposal_step)
+            .def_readwrite("target_acceptance", &PNAB::RuntimeParameters::target_acceptance)
+            .def_readwrite("adaptation_interval", &PNAB::RuntimeParameters::adaptation_interval)
+            .def_readwrite("elite_fraction", &PNAB::RuntimeParameters::elite_fraction)
+            .def_readwrite("adaptation_rate", &PNAB::RuntimeParameters::adaptation_rate)
+            .def_readwrite("refinement_distance", &PNAB::RuntimeParameters::refinement_distance)
+            .def_readwrite("refinement_iterations", &PNAB::RuntimeParameters::refinement_iterations)
+            .def_readwrite("closure_attempts", &PNAB::RuntimeParameters::closure_attempts)
             .def_readwrite("population_size", &PNAB::RuntimeParameters::population_size)
             .def_readwrite("mutation_rate", &PNAB::RuntimeParameters::mutation_rate)
             .def_readwrite("crossover_rate", &PNAB::RuntimeParameters::crossover_rate)
+            .def_readwrite("num_islands", &PNAB::RuntimeParameters::num_islands)
+            .def_readwrite("migration_interval", &PNAB::RuntimeParameters::migration_interval)
             .def_readwrite("strand", &PNAB::RuntimeParameters::strand)
             .def_readwrite("build_strand", &PNAB::RuntimeParameters::build_strand)
             .def_readwrite("strand_orientation", &PNAB::RuntimeParameters::strand_orientation)
             .def_readwrite("is_hexad", &PNAB::RuntimeParameters::is_hexad)
             .def_readwrite("glycosidic_bond_distance", &PNAB::RuntimeParameters::glycosidic_bond_distance)
             .def_readwrite("num_candidates", &PNAB::RuntimeParameters::num_candidates)
+            .def_readwrite("num_best", &PNAB::RuntimeParameters::num_best)
+            .def_readwrite("write_queue_size", &PNAB::RuntimeParameters::write_queue_size)
+            .def_readwrite("multi_model_file", &PNAB::RuntimeParameters::multi_model_file)
+            .def_readwrite("num_threads", &PNAB::RuntimeParameters::num_threads)
+            .def_readwrite("energy_mode", &PNAB::RuntimeParameters::energy_mode)
+            .def_readwrite("nonbonded_cutoff", &PNAB::RuntimeParameters::nonbonded_cutoff)
             ;
 
         py::class_<PNAB::HelicalParameters>(m, "HelicalParameters")
@@ -115,8 +259,23 @@ namespace PNAB {
             .def_readwrite("linker", &PNAB::Base::linker)
             ;        
 
+        py::class_<PNAB::StopToken, std::shared_ptr<PNAB::StopToken>>(m, "StopToken",
+                                                                      "A flag that stops the searches it is passed to from another thread")
+            .def(py::init())
+            .def("stop", &PNAB::StopToken::stop, py::arg("stop") = true,
+                 "Stop the searches (stop=True) or allow new searches to run (stop=False)")
+            .def_property_readonly("stopped", &PNAB::StopToken::stopped)
+            ;
+
         m.def("run", &PNAB::run, py::arg("runtime_params"), py::arg("backbone"), py::arg("bases"),
                                  py::arg("helical_params"), py::arg("prefix") = "run", py::arg("verbose") = true,
-                                 py::call_guard<py::scoped_ostream_redirect, py::scoped_estream_redirect>());
+                                 py::arg("callback") = py::none(), py::arg("batch_size") = 100, py::arg("stop_token") = py::none());
+
+        m.def("run_csv", &PNAB::run_csv, py::arg("runtime_params"), py::arg("backbone"), py::arg("bases"),
+                                         py::arg("helical_params"), py::arg("prefix") = "run", py::arg("verbose") = true,
+                                         py::call_guard<py::gil_scoped_release>());
+
+        m.def("column_names", &PNAB::ConformationSearch::columnNames, py::arg("num_dihedrals"),
+              "The names of the columns of the array returned by run for a backbone with num_dihedrals rotatable dihedral angles");
     }
 }
@@ -1,5 +1,12 @@
 from __future__ import division, absolute_import, print_function
 
+import os
+import glob
+from io import StringIO
+
+import numpy as np
+import pytest
+
 
 def test_binder_1():
     """
@@ -27,7 +34,13 @@ def test_binder_1():
                                'strand': list, 'is_hexad': bool, 'build_strand': list, 'strand_orientation': list,
                                'weighting_temperature': float, 'monte_carlo_temperature': float, 'mutation_rate': float,
                                'crossover_rate': float, 'population_size': int, 'glycosidic_bond_distance': float,
-                               'num_candidates': int}
+                               'num_candidates': int, 'num_best': int, 'write_queue_size': int, 'multi_model_file': bool, 'num_threads': int, 'energy_mode': str, 'nonbonded_cutoff': float,
+                               'start_index': int, 'stop_index': int, 'num_islands': int, 'migration_interval': int,
+                               'num_replicas': int, 'max_replica_temperature': float, 'exchange_interval': int,
+                               'proposal_mode': str, 'num_rotations': int, 'proposal_step': float, 'target_acceptance': float,
+                               'weights_cache': str, 'adaptation_interval': int, 'elite_fraction': float,
+                               'adaptation_rate': float, 'refinement_distance': float, 'refinement_iterations': int,
+                               'closure_attempts': int}
     assert all([i in runtime_parameters.__dir__() for i in runtime_parameters_attr])
     assert all([type(runtime_parameters.__getattribute__(k)) is val
                 for k, val in runtime_parameters_attr.items()])
@@ -85,7 +98,7 @@ def test_binder_2():
     rp.strand = ['Adenine']*5
     rp.num_candidates = 2
 
-    output = bind.run(rp, backbone, bases, hp, 'test')
+    output = bind.run_csv(rp, backbone, bases, hp, 'test')
     print(output)
 
 def test_helical_parameters():
@@ -140,7 +153,7 @@ def test_helical_parameters():
         hp.tip = p[0][4]
         hp.h_twist = p[0][5]
 
-        output_helical = bind.run(rp, backbone, bases, hp, 'test')
+        output_helical = bind.run_csv(rp, backbone, bases, hp, 'test')
 
         hp.is_helical = False
         hp.shift = p[1][0]
@@ -150,6 +163,584 @@ def test_helical_parameters():
         hp.roll = p[1][4]
         hp.twist = p[1][5]
 
-        output_step = bind.run(rp, backbone, bases, hp, 'test')
+        output_step = bind.run_csv(rp, backbone, bases, hp, 'test')
 
         assert output_helical == output_step
+
+## Directory of the input files of the tests
+_files_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'files')
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch):
+    """
+    Run the test in a temporary directory, so the structures of the candidates are not written in the tests directory.
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+def _search_input(**runtime_parameters):
+    """
+    Setup the input of a search for a strand of three RNA adenines.
+
+    By default, a random search of 100 steps accepts all the candidates. The given runtime parameters
+    replace the default values. The input files have absolute paths, so the search can run in any directory.
+
+    Returns the runtime parameters, the backbone, the bases, and the helical parameters.
+    """
+    from pnab import bind
+
+    backbone = bind.Backbone()
+    backbone.file_path = os.path.join(_files_dir, 'rna_bb.pdb')
+    backbone.interconnects = [10, 1]
+    backbone.linker = [13, 14]
+
+    base = bind.Base()
+    base.file_path = os.path.join(_files_dir, 'adenine.pdb')
+    base.code = 'A'
+    base.linker = [5, 11]
+    base.name = 'Adenine'
+    base.pair_name = 'Uracil'
+    bases = [base]
+
+    hp = bind.HelicalParameters()
+    hp.h_twist = 32.39
+    hp.h_rise = 2.53
+    hp.inclination = 22.9
+    hp.tip = 0.08
+    hp.x_displacement = -4.54
+    hp.y_displacement = -0.02
+
+    rp = bind.RuntimeParameters()
+    rp.search_algorithm = 'random search'
+    rp.num_steps = 100
+    rp.ff_type = 'GAFF'
+    rp.energy_filter = [1e10]*5
+    rp.max_distance = 1e10
+    rp.strand = ['Adenine']*3
+    rp.num_candidates = 100000
+    for name, value in runtime_parameters.items():
+        setattr(rp, name, value)
+
+    return rp, backbone, bases, hp
+
+def _candidates(rp, backbone, bases, hp):
+    """
+    Run the search and return the rows of the accepted candidates given by run_csv as a 2D array.
+    """
+    from pnab import bind
+
+    return np.genfromtxt(StringIO(bind.run_csv(rp, backbone, bases, hp, 'test', False)), delimiter=',', ndmin=2)
+
+def test_threads(run_dir):
+    """
+    Test running the C++ code from several python threads.
+
+    The C++ code releases the python global interpreter lock, so the runs are concurrent.
+    Every thread should give the same results as a serial run.
+    """
+    from concurrent import futures
+
+    from pnab import bind
+
+    rp, backbone, bases, hp = _search_input(search_algorithm='weighted random search', strand=['Adenine']*5,
+                                            num_candidates=10)
+
+    output_serial = bind.run(rp, backbone, bases, hp, 'test', False)
+
+    with futures.ThreadPoolExecutor(4) as pool:
+        jobs = [pool.submit(bind.run, rp, backbone, bases, hp, 'test_' + str(i), False) for i in range(4)]
+        outputs = [job.result() for job in jobs]
+
+    # The arrays do not include the prefix
+    assert all([np.array_equal(output, output_serial, equal_nan=True) for output in outputs])
+
+def test_stop_token(run_dir):
+    """
+    Test stopping searches from another thread through a stop token.
+
+    The token only stops the searches it is passed to; the other searches running in the same process are not affected.
+    """
+    from concurrent import futures
+
+    from pnab import bind
+
+    search = _search_input(num_steps=200)
+    output_serial = bind.run(*search, prefix='test', verbose=False)
+
+    token = bind.StopToken()
+    assert not token.stopped
+    token.stop()
+    assert token.stopped
+    assert len(bind.run(*search, prefix='stopped', verbose=False, stop_token=token)) == 0
+
+    # The long search stops its token once it accepts a candidate, while the other search runs to the end
+    token = bind.StopToken()
+    long_search = _search_input(num_steps=10000000)
+    with futures.ThreadPoolExecutor(2) as pool:
+        stopped = pool.submit(bind.run, *long_search, prefix='stopped', verbose=False,
+                              callback=lambda batch: token.stop(), batch_size=1, stop_token=token)
+        job = pool.submit(bind.run, *search, prefix='test', verbose=False, stop_token=bind.StopToken())
+        assert 0 < len(stopped.result()) < 100
+        assert np.array_equal(job.result(), output_serial, equal_nan=True)
+
+def test_num_threads(run_dir):
+    """
+    Test searching a single helical configuration with several threads.
+
+    The threads should stop once the requested number of candidates is found.
+    Without early stopping, the threads split the steps and the results are reproducible.
+    """
+    search = _search_input(num_steps=1000000, num_candidates=5, num_threads=3)
+    rp = search[0]
+
+    output = _candidates(*search)
+    assert len(output) == rp.num_candidates
+
+    rp.num_steps = 30
+    rp.num_candidates = 1000
+
+    output1 = _candidates(*search)
+    output2 = _candidates(*search)
+    output1 = output1[output1[:, 1].argsort()]
+    output2 = output2[output2[:, 1].argsort()]
+
+    # Every step has a unique index
+    assert len(np.unique(output1[:, 1])) == len(output1)
+    assert np.all(output1[:, 1] < rp.num_steps)
+    assert np.allclose(output1, output2, equal_nan=True)
+
+def test_energy_mode(run_dir):
+    """
+    Test the cell list and helical symmetry energy modes.
+
+    With a cutoff larger than the system, the cell list energies should match the openbabel energies.
+    The helical symmetry energies should match the openbabel energies for a homopolymer.
+    """
+    from pnab import bind
+
+    search = _search_input(num_steps=30, num_candidates=1000)
+    rp, backbone, bases, hp = search
+
+    for ff_type in ['GAFF', 'MMFF94']:
+        rp.ff_type = ff_type
+        rp.energy_mode = 'openbabel'
+        openbabel = _candidates(*search)
+        rp.energy_mode = 'cell list'
+        rp.nonbonded_cutoff = 1000.0
+        cell_list = _candidates(*search)
+        assert np.allclose(openbabel, cell_list, rtol=1e-5, equal_nan=True)
+        rp.energy_mode = 'helical symmetry'
+        helical_symmetry = _candidates(*search)
+        assert np.allclose(openbabel, helical_symmetry, rtol=1e-5, equal_nan=True)
+
+    # The helical symmetry requires the same nucleobase in all the nucleotides
+    guanine = bind.Base()
+    guanine.file_path = os.path.join(_files_dir, 'adenine.pdb')
+    guanine.code = 'G'
+    guanine.linker = [5, 11]
+    guanine.name = 'Guanine'
+    guanine.pair_name = 'Cytosine'
+    rp.strand = ['Adenine', 'Guanine', 'Adenine']
+    with pytest.raises(RuntimeError, match='same nucleobase'):
+        bind.run_csv(rp, backbone, bases + [guanine], hp, 'test', False)
+    rp.strand = ['Adenine']*3
+
+    rp.energy_mode = 'neighbor list'
+    with pytest.raises(RuntimeError):
+        bind.run_csv(rp, backbone, bases, hp, 'test', False)
+
+def test_systematic_shards(run_dir):
+    """
+    Test splitting a systematic search into shards.
+
+    The shards, searched separately and with several threads, should give the same candidates as the whole search.
+    """
+    from pnab import bind
+
+    search = _search_input(search_algorithm='systematic search', dihedral_step=60, max_distance=3.0)
+    rp, backbone, bases, hp = search
+
+    output = _candidates(*search)
+
+    rp.stop_index = 500
+    shard1 = _candidates(*search)
+    rp.start_index = 500
+    rp.stop_index = 0
+    rp.num_threads = 2
+    shard2 = _candidates(*search)
+
+    assert np.all(shard1[:, 1] < 500) and np.all(shard2[:, 1] >= 500)
+    shards = np.concatenate([shard1, shard2])
+    shards = shards[shards[:, 1].argsort()]
+    assert np.allclose(output[output[:, 1].argsort()], shards, equal_nan=True)
+
+    # The number of grid points overflows for small step sizes; the grid points can still be indexed
+    rp.dihedral_step = 1e-3
+    rp.start_index = 60000 * 360000
+    rp.stop_index = rp.start_index + 1
+    rp.max_distance = 1e10
+    rp.num_threads = 1
+    output = _candidates(*search)
+    assert output[0, 1] == rp.start_index
+    assert np.isclose(output[0, 9], 60.0)
+
+    rp.start_index = rp.stop_index
+    with pytest.raises(RuntimeError, match='start index'):
+        bind.run_csv(rp, backbone, bases, hp, 'test', False)
+
+
+def test_pruned_systematic_search(run_dir):
+    """
+    Test the pruned systematic search.
+
+    Skipping the blocks of grid points that cannot satisfy the distance threshold should not change the candidates.
+    """
+    search = _search_input(search_algorithm='systematic search', dihedral_step=30, max_distance=1.0)
+    rp = search[0]
+
+    output = _candidates(*search)
+
+    rp.search_algorithm = 'pruned systematic search'
+    rp.num_threads = 2
+    pruned = _candidates(*search)
+
+    assert len(output) > 0
+    assert np.allclose(output[output[:, 1].argsort()], pruned[pruned[:, 1].argsort()], equal_nan=True)
+
+
+def test_genetic_algorithm_islands(run_dir):
+    """
+    Test the genetic algorithm search with several islands.
+
+    The islands exchange individuals at fixed generations, so the search is reproducible for the same seed.
+    """
+    search = _search_input(search_algorithm='genetic algorithm search', num_steps=50, population_size=100,
+                           num_islands=3, migration_interval=5, max_distance=0.5)
+    rp = search[0]
+
+    output1 = _candidates(*search)
+    output2 = _candidates(*search)
+    assert np.allclose(output1, output2, equal_nan=True)
+
+    # Each island evolves for all the generations and names its candidates separately
+    islands = output1[:, 1] // (rp.num_steps * rp.population_size)
+    assert set(islands) == {0, 1, 2}
+
+    # The search stops in all the islands once enough candidates are found
+    rp.num_candidates = 3
+    output = _candidates(*search)
+    assert len(output) >= rp.num_candidates
+
+
+def test_replica_exchange_monte_carlo(run_dir):
+    """
+    Test the replica exchange Monte Carlo search.
+
+    The replicas exchange their states at fixed steps, so the search is reproducible for the same seed.
+    """
+    search = _search_input(search_algorithm='replica exchange monte carlo search', num_steps=5000, num_replicas=3,
+                           max_replica_temperature=3000, exchange_interval=50, max_distance=0.5)
+    rp = search[0]
+
+    output1 = _candidates(*search)
+    output2 = _candidates(*search)
+    assert np.allclose(output1, output2, equal_nan=True)
+
+    # Each replica runs all the steps and names its candidates separately
+    replicas = output1[:, 1] // rp.num_steps
+    assert set(replicas) == {0, 1, 2}
+
+    # The search stops in all the replicas once enough candidates are found
+    rp.search_algorithm = 'weighted replica exchange monte carlo search'
+    rp.num_candidates = 3
+    output = _candidates(*search)
+    assert len(output) >= rp.num_candidates
+
+
+def test_local_monte_carlo_steps(run_dir):
+    """
+    Test the local proposal mode of the Monte Carlo search.
+
+    The adaptive local steps should find more candidates than the global steps for the same number of steps.
+    """
+    search = _search_input(search_algorithm='monte carlo search', num_steps=10000, max_distance=0.5)
+    rp = search[0]
+
+    output_global = _candidates(*search)
+
+    rp.proposal_mode = 'local'
+    rp.num_rotations = 3
+    output_local = _candidates(*search)
+    assert len(output_local) > 2 * len(output_global)
+
+    rp.proposal_mode = 'unknown'
+    with pytest.raises(RuntimeError, match='proposal mode'):
+        _candidates(*search)
+
+
+def test_weights_cache(run_dir):
+    """
+    Test reusing the weighted distributions of the dihedral angles.
+
+    The distributions are saved in the cache directory, and the searches that reuse them give the same candidates.
+    """
+    cache = os.path.join(str(run_dir), 'cache')
+    os.mkdir(cache)
+    search = _search_input(search_algorithm='weighted monte carlo search', num_steps=10000, max_distance=0.5,
+                           weights_cache=cache)
+    rp = search[0]
+
+    output1 = _candidates(*search)
+    assert len(os.listdir(cache)) == 1
+    output2 = _candidates(*search)
+    assert np.allclose(output1, output2, equal_nan=True)
+
+    # A different temperature gives different distributions
+    rp.weighting_temperature = 500.0
+    _candidates(*search)
+    assert len(os.listdir(cache)) == 2
+
+
+def test_adaptive_sampling_search(run_dir):
+    """
+    Test the adaptive sampling search.
+
+    Refitting the distributions to the lowest distances should find more candidates than the random search
+    for the same number of steps, and the search should be reproducible.
+    """
+    search = _search_input(num_steps=20000, max_distance=0.5)
+    rp = search[0]
+
+    output_random = _candidates(*search)
+
+    # A quarter of the steps of the random search should find several times more candidates
+    rp.search_algorithm = 'adaptive sampling search'
+    rp.num_steps = 5000
+    rp.adaptation_interval = 500
+    rp.num_candidates = 5 * len(output_random)
+    output_adaptive = _candidates(*search)
+    assert len(output_adaptive) == rp.num_candidates
+    assert np.all(output_adaptive[:, 2] < rp.max_distance)
+
+    output_repeat = _candidates(*search)
+    assert np.allclose(output_adaptive, output_repeat, equal_nan=True)
+
+
+def test_closure_refinement(run_dir):
+    """
+    Test the refinement of the near misses.
+
+    Closing the gap of the near misses should find more candidates for the same number of steps,
+    all within the distance threshold, and the pruned systematic search should still give the same results.
+    """
+    from pnab import bind
+
+    search = _search_input(num_steps=5000, max_distance=0.5)
+    rp, backbone, bases, hp = search
+
+    output = _candidates(*search)
+
+    rp.refinement_distance = 1.5
+    output_refined = _candidates(*search)
+    assert len(output_refined) > 5 * len(output)
+    assert np.all(output_refined[:, 2] < rp.max_distance)
+
+    rp.refinement_iterations = 0
+    output_unrefined = _candidates(*search)
+    assert np.allclose(output, output_unrefined, equal_nan=True)
+
+    rp.refinement_iterations = 10
+    rp.search_algorithm = 'systematic search'
+    rp.dihedral_step = 40
+    output_systematic = bind.run_csv(rp, backbone, bases, hp, 'test', False)
+    rp.search_algorithm = 'pruned systematic search'
+    output_pruned = bind.run_csv(rp, backbone, bases, hp, 'test', False)
+    assert output_systematic == output_pruned
+
+
+def test_kinematic_closure_search(run_dir):
+    """
+    Test the kinematic closure search.
+
+    Solving the closure dihedral angles should bring most of the steps within the distance threshold,
+    many of them closed exactly. The random search finds about one candidate in a thousand steps.
+    """
+    search = _search_input(search_algorithm='kinematic closure search', num_steps=200, max_distance=0.5)
+    rp = search[0]
+
+    output = _candidates(*search)
+    assert len(output) > rp.num_steps / 2
+    assert np.all(output[:, 2] < rp.max_distance)
+    assert np.sum(output[:, 2] < 1e-4) > len(output) / 2
+    # The candidates are named by the step and the starting point of the closure dihedral angles
+    assert len(np.unique(output[:, 1])) == len(output)
+
+
+def test_quasi_random_search(run_dir):
+    """
+    Test the quasi-random search.
+
+    The points of the scrambled Halton sequence only depend on the seed, so the search should find the same
+    candidates on any number of threads, and different candidates for different seeds.
+    """
+    search = _search_input(num_steps=20000, max_distance=0.5)
+    rp = search[0]
+
+    for algorithm in ['quasi-random search', 'weighted quasi-random search']:
+        rp.search_algorithm = algorithm
+        rp.seed = 0
+        rp.num_threads = 1
+        output = _candidates(*search)
+        assert len(output) > 0
+        assert np.all(output[:, 2] < rp.max_distance)
+
+        rp.num_threads = 3
+        output_threads = _candidates(*search)
+        output_threads = output_threads[np.argsort(output_threads[:, 1])]
+        assert np.allclose(output, output_threads, equal_nan=True)
+
+        rp.seed = 1
+        output_seed = _candidates(*search)
+        assert not np.array_equal(output[:, 1], output_seed[:, 1])
+
+def test_structure_writer(run_dir, monkeypatch):
+    """
+    Test writing the structures on a background thread.
+
+    The writer thread should write the same files as the searching threads, also when the queue is
+    full after every structure.
+    """
+    search = _search_input(num_steps=300, num_threads=3)
+    rp = search[0]
+
+    outputs, structures = [], []
+    for write_queue_size in [0, 1, 64]:
+        os.mkdir(os.path.join(str(run_dir), str(write_queue_size)))
+        monkeypatch.chdir(os.path.join(str(run_dir), str(write_queue_size)))
+
+        rp.write_queue_size = write_queue_size
+        output = _candidates(*search)
+        outputs.append(output[output[:, 1].argsort()])
+        structures.append({f: open(f).read() for f in os.listdir('.')})
+
+    assert len(structures[0]) == len(outputs[0])
+    for output, structure in zip(outputs[1:], structures[1:]):
+        assert np.allclose(outputs[0], output, equal_nan=True)
+        assert structure == structures[0]
+
+def test_multi_model_file(run_dir, monkeypatch):
+    """
+    Test writing the structures to a single multi-model PDB file.
+
+    Each model, read through the offsets in the index file, should have the structure written to its own
+    file otherwise, also when the structures are written by the searching threads.
+    """
+    from openbabel import openbabel as ob
+
+    search = _search_input(num_steps=300, num_threads=3)
+    rp = search[0]
+
+    os.mkdir('files')
+    monkeypatch.chdir('files')
+    output = _candidates(*search)
+    structures = {f: open(f).read() for f in os.listdir('.')}
+
+    for write_queue_size in [0, 64]:
+        os.mkdir(os.path.join(str(run_dir), str(write_queue_size)))
+        monkeypatch.chdir(os.path.join(str(run_dir), str(write_queue_size)))
+
+        rp.multi_model_file = True
+        rp.write_queue_size = write_queue_size
+        output_models = _candidates(*search)
+        assert np.allclose(output[output[:, 1].argsort()], output_models[output_models[:, 1].argsort()], equal_nan=True)
+        assert sorted(os.listdir('.')) == ['test_models.csv', 'test_models.pdb']
+
+        index = np.genfromtxt('test_models.csv', delimiter=',', dtype=None, encoding=None)
+        assert sorted([i[0] for i in index]) == sorted(structures)
+        assert [i[1] for i in index] == list(range(1, len(index) + 1))
+
+        with open('test_models.pdb', 'rb') as f:
+            models = f.read()
+        assert sum([i[3] for i in index]) == len(models)
+
+        # Read the models in reverse order through the index
+        conv = ob.OBConversion()
+        conv.SetInFormat('PDB')
+        with open('test_models.pdb', 'rb') as f:
+            for name, model, offset, size in index[::-1]:
+                f.seek(offset)
+                contents = f.read(size).decode()
+                assert contents == 'MODEL     %4i\n' %model + structures[name][:-len('END\n')] + 'ENDMDL\n'
+
+                molecule, molecule_file = ob.OBMol(), ob.OBMol()
+                conv.ReadString(molecule, contents)
+                conv.ReadString(molecule_file, structures[name])
+                assert molecule.NumAtoms() == molecule_file.NumAtoms() > 0
+
+def test_run_array(run_dir):
+    """
+    Test the array of the properties of the accepted candidates returned by run.
+
+    The array should have the same values as the CSV string returned by run_csv, without the prefix column.
+    """
+    from pnab import bind
+
+    search = _search_input()
+    rp, backbone, bases, hp = search
+
+    output = bind.run(rp, backbone, bases, hp, 'test', False)
+    output_csv = _candidates(*search)
+
+    assert output.dtype == np.float64 and output.ndim == 2
+    assert len(output) > 0
+    assert output.shape[1] == len(bind.column_names(output.shape[1] - 7))
+    assert bind.column_names(0)[-1] == 'Total Energy (kcal/mol/nucleotide)'
+    assert np.allclose(output, output_csv[:, 1:], rtol=1e-5, atol=1e-6, equal_nan=True)
+
+    rp.max_distance = 0.0
+    output = bind.run(rp, backbone, bases, hp, 'test', False)
+    assert output.shape == (0, output_csv.shape[1] - 1)
+
+def test_callback(run_dir):
+    """
+    Test streaming the accepted candidates to a callback while the search runs.
+
+    The callback should receive all the accepted candidates, stop the search if it returns True,
+    and its exceptions should stop the search cleanly and be raised by run.
+    """
+    from pnab import bind
+
+    rp, backbone, bases, hp = _search_input(num_threads=3)
+
+    batches = []
+    output = bind.run(rp, backbone, bases, hp, 'test', False, batches.append, batch_size=7)
+    assert all([len(batch) <= 7 for batch in batches])
+    streamed = np.concatenate(batches)
+    assert np.array_equal(streamed[streamed[:, 0].argsort()], output[output[:, 0].argsort()], equal_nan=True)
+
+    # Stop after five candidates
+    rp.num_threads = 1
+    output = bind.run(rp, backbone, bases, hp, 'test', False, lambda batch: True, batch_size=5)
+    assert len(output) == 5
+
+    def callback(batch):
+        raise ValueError('Stop')
+
+    with pytest.raises(ValueError, match='Stop'):
+        bind.run(rp, backbone, bases, hp, 'test', False, callback)
+
+    # The exception stops all the threads; the structures of the accepted candidates are written, and the next search is not affected
+    # The kept structures with the lowest total energies are also written
+    for num_threads, num_best in [(3, 0), (1, 5), (3, 5)]:
+        rp.num_threads = num_threads
+        rp.num_best = num_best
+        prefix = 'stopped_%i_%i' %(num_threads, num_best)
+        with pytest.raises(ValueError, match='Stop'):
+            bind.run(rp, backbone, bases, hp, prefix, False, callback, batch_size=1)
+        structures = glob.glob(prefix + '_*.pdb')
+        assert len(structures) > 0
+        assert all([open(f).read().endswith('END\n') for f in structures])
+    rp.num_best = 0
+
+    output_repeat = bind.run(rp, backbone, bases, hp, 'test', False)
+    assert np.array_equal(output_repeat[output_repeat[:, 0].argsort()], streamed[streamed[:, 0].argsort()], equal_nan=True)
@@ -4,6 +4,7 @@ import os
 import platform
 import glob
 import numpy as np
+import pytest
 
 def test_options():
     """
@@ -54,3 +55,212 @@ def test_examples():
             ref_output = np.genfromtxt(os.path.join('files', f.split('.')[0] + '_mac.csv'), delimiter=',')
             
         assert np.allclose(run.results, ref_output, atol=1e-4)
+
+
+def test_threads_backend(tmp_path, monkeypatch):
+    """
+    test that running the helical configurations in threads gives the same results as in processes
+    """
+    import pnab
+
+    monkeypatch.chdir(tmp_path)
+
+    outputs = []
+    for backend in ['processes', 'threads']:
+        run = pnab.pNAB('RNA.yaml')
+        run.options['RuntimeParameters']['num_steps'] = 100
+        run.options['RuntimeParameters']['num_candidates'] = 10
+        run.options['RuntimeParameters']['max_distance'] = 1e10
+        run.options['RuntimeParameters']['energy_filter'] = [1e10]*5
+        run.options['RuntimeParameters']['strand'] = 'AAA'
+        run.options['HelicalParameters']['h_twist'] = [30.0, 35.0, 3]
+        run.run(number_of_cpus=2, verbose=False, backend=backend)
+
+        # Sort by prefix and conformer index; the order of the configurations is not deterministic
+        outputs.append(run.results[np.lexsort((run.results[:, 1], run.results[:, 0]))])
+
+    assert np.allclose(outputs[0], outputs[1])
+
+
+def test_num_best(tmp_path, monkeypatch):
+    """
+    test that only the structures with the lowest total energies across the helical configurations are written
+    """
+    import pnab
+
+    monkeypatch.chdir(tmp_path)
+
+    for backend in ['processes', 'threads']:
+        [os.remove(f) for f in glob.glob('[0-9]*_*.pdb')]
+
+        run = pnab.pNAB('RNA.yaml')
+        run.options['RuntimeParameters']['num_steps'] = 100
+        run.options['RuntimeParameters']['num_candidates'] = 10
+        run.options['RuntimeParameters']['num_best'] = 5
+        run.options['RuntimeParameters']['max_distance'] = 1e10
+        run.options['RuntimeParameters']['energy_filter'] = [1e10]*5
+        run.options['RuntimeParameters']['strand'] = 'AAA'
+        run.options['HelicalParameters']['h_twist'] = [30.0, 35.0, 3]
+        run.run(number_of_cpus=2, verbose=False, backend=backend)
+
+        best = run.results[run.results[:, 7].argsort()][:5]
+        assert sorted(glob.glob('[0-9]*_*.pdb')) == sorted(['%i_%i.pdb' %(i[0], i[1]) for i in best])
+
+
+def test_callback(tmp_path, monkeypatch):
+    """
+    test streaming the accepted candidates to a callback, and stopping the run from the callback
+    """
+    import pnab
+
+    monkeypatch.chdir(tmp_path)
+
+    for backend in ['processes', 'threads']:
+        run = pnab.pNAB('RNA.yaml')
+        run.options['RuntimeParameters']['num_steps'] = 100
+        run.options['RuntimeParameters']['num_candidates'] = 10
+        run.options['RuntimeParameters']['max_distance'] = 1e10
+        run.options['RuntimeParameters']['energy_filter'] = [1e10]*5
+        run.options['RuntimeParameters']['strand'] = 'AAA'
+        run.options['HelicalParameters']['h_twist'] = [30.0, 35.0, 3]
+
+        batches = []
+        run.run(number_of_cpus=2, verbose=False, backend=backend, callback=batches.append)
+
+        # Sort by prefix and conformer index; the order of the candidates is not deterministic
+        streamed = np.concatenate(batches)
+        streamed = streamed[np.lexsort((streamed[:, 1], streamed[:, 0]))]
+        results = run.results[np.lexsort((run.results[:, 1], run.results[:, 0]))]
+        assert np.allclose(streamed, results, atol=1e-4)
+
+        # Stop after the first batch
+        run.run(number_of_cpus=1, verbose=False, backend=backend, callback=lambda batch: True)
+        assert len(run.results) < 30
+
+def test_results_store(tmp_path, monkeypatch):
+    """
+    test that the results are stored in "results.dat" and indexed in "results_index.csv"
+    """
+    import pnab
+
+    monkeypatch.chdir(tmp_path)
+
+    run = pnab.pNAB('RNA.yaml')
+    run.options['RuntimeParameters']['num_steps'] = 100
+    run.options['RuntimeParameters']['num_candidates'] = 5
+    run.options['RuntimeParameters']['max_distance'] = 1e10
+    run.options['RuntimeParameters']['energy_filter'] = [1e10]*5
+    run.options['RuntimeParameters']['strand'] = 'AAA'
+    run.options['HelicalParameters']['h_twist'] = [30.0, 35.0, 3]
+    run.run(number_of_cpus=2, verbose=False)
+
+    assert isinstance(run.results, np.memmap)
+    assert run.results.shape[1] == len(run.header.split(','))
+
+    data = np.fromfile('results.dat', dtype=np.float64).reshape(run.results.shape)
+    assert np.array_equal(data, run.results)
+
+    # Each helical configuration has a contiguous block of rows
+    with open('results_index.csv') as f:
+        assert f.readline().startswith('#')
+        assert f.readline().strip() == '# ' + run.header
+    index = np.loadtxt('results_index.csv', delimiter=',', dtype=int)
+    assert sorted(index[:, 0]) == [int(p) for p in sorted(run.prefix)]
+    assert np.array_equal(index[:, 1], np.cumsum(np.append(0, index[:-1, 2])))
+    assert index[:, 2].sum() == len(run.results)
+    for prefix, start, count in index:
+        assert np.all(run.results[start:start+count, 0] == prefix)
+
+
+def test_multi_model_file(tmp_path, monkeypatch):
+    """
+    test reading the structures of the accepted candidates from the multi-model files of the helical configurations
+    """
+    import pnab
+    from pnab.driver.driver import read_structure
+
+    monkeypatch.chdir(tmp_path)
+
+    run = pnab.pNAB('RNA.yaml')
+    run.options['RuntimeParameters']['num_steps'] = 100
+    run.options['RuntimeParameters']['num_candidates'] = 5
+    run.options['RuntimeParameters']['max_distance'] = 1e10
+    run.options['RuntimeParameters']['energy_filter'] = [1e10]*5
+    run.options['RuntimeParameters']['strand'] = 'AAA'
+    run.options['RuntimeParameters']['multi_model_file'] = True
+    run.options['HelicalParameters']['h_twist'] = [30.0, 35.0, 3]
+    run.run(number_of_cpus=2, verbose=False)
+
+    assert glob.glob('*_*.pdb') == glob.glob('*_models.pdb')
+    assert sorted(glob.glob('*_models.pdb')) == sorted([p + '_models.pdb' for p in run.prefix])
+
+    for row in run.results:
+        structure = read_structure(int(row[0]), row[1])
+        assert structure.startswith('MODEL')
+        assert structure.endswith('ENDMDL\n')
+        assert 'TITLE     Total Energy (kcal/mol/nucleotide): %f' %row[7] in structure
+
+    assert read_structure(int(run.results[0, 0]), -1) is None
+
+    # The structures pushed out of the lowest total energies cannot be removed from the multi-model files
+    run.options['RuntimeParameters']['num_best'] = 5
+    with pytest.raises(Exception, match='num_best'):
+        run.run(number_of_cpus=2, verbose=False)
+
+
+def test_weights_cache(tmp_path, monkeypatch):
+    """
+    test that the weighted distributions are only saved in the requested cache directory
+    """
+    import pnab
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('HOME', str(tmp_path / 'home'))
+    os.mkdir(str(tmp_path / 'home'))
+
+    run = pnab.pNAB('RNA.yaml')
+    run.options['RuntimeParameters']['search_algorithm'] = 'weighted random search'
+    run.options['RuntimeParameters']['num_steps'] = 100
+    run.options['RuntimeParameters']['strand'] = 'AAA'
+    run.options['HelicalParameters']['h_twist'] = [30.0, 35.0, 2]
+    run.run(number_of_cpus=2, verbose=False)
+    assert os.listdir(str(tmp_path / 'home')) == []
+
+    run.options['RuntimeParameters']['weights_cache'] = os.path.join('~', 'cache')
+    run.run(number_of_cpus=2, verbose=False)
+    assert len(os.listdir(str(tmp_path / 'home' / 'cache'))) == 1
+
+
+def test_cell_list_examples(tmp_path, monkeypatch):
+    """
+    test that the cell list energies match the openbabel energies for provided option files at the default cutoff
+
+    The bonded energies do not depend on the cutoff, and the truncated van der Waals energies differ
+    by less than 1% in these systems. The electrostatic energies of the nucleotides farther than the cutoff
+    use their multipoles, so the total energies without the van der Waals energies differ by less than
+    1 kcal/mol, and the total energies differ by much less than 1%.
+    """
+    import pnab
+
+    monkeypatch.chdir(tmp_path)
+
+    # Hexad.yaml has a neutral backbone and DNA.yaml has a charged backbone
+    for f, num_steps in [('Hexad.yaml', 30), ('DNA.yaml', 300)]:
+        results = {}
+        for energy_mode in ['openbabel', 'cell list']:
+            run = pnab.pNAB(f)
+            run.options['RuntimeParameters']['num_steps'] = num_steps
+            run.options['RuntimeParameters']['max_distance'] = 1e10
+            run.options['RuntimeParameters']['energy_filter'] = [1e10]*5
+            run.options['RuntimeParameters']['energy_mode'] = energy_mode
+            if f == 'Hexad.yaml':
+                run.options['HelicalParameters']['h_twist'] = [30.0, 30.0, 1]
+            run.run(number_of_cpus=1, verbose=False)
+            results[energy_mode] = np.array(run.results)
+
+        openbabel, cell_list = results['openbabel'], results['cell list']
+        assert len(openbabel) > 0
+        assert np.array_equal(openbabel[:, :6], cell_list[:, :6])
+        assert np.allclose(openbabel[:, 6], cell_list[:, 6], rtol=1e-2, atol=0)
+        assert np.allclose(openbabel[:, 7] - openbabel[:, 6], cell_list[:, 7] - cell_list[:, 6], rtol=0, atol=1)
+        assert np.allclose(openbabel[:, 7], cell_list[:, 7], rtol=1e-3, atol=0)
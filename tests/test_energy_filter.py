@@ -43,14 +43,14 @@ def test_energy_filter():
     rp.max_distance = 1e100
     rp.strand = ['Adenine']*5
 
-    output1 = bind.run(rp, backbone, bases, hp, '1')
+    output1 = bind.run_csv(rp, backbone, bases, hp, '1')
     output1 = np.genfromtxt(StringIO(output1), delimiter=',')
 
     rp.num_steps = 1000000
     rp.energy_filter = [output1[3], output1[4], output1[5], output1[6], output1[7]]
     rp.max_distance = 0.05
 
-    output2 = bind.run(rp, backbone, bases, hp, '2')
+    output2 = bind.run_csv(rp, backbone, bases, hp, '2')
     output2 = np.genfromtxt(StringIO(output2), delimiter=',')
 
     if output2.size == 0: